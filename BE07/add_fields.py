@@ -1,12 +1,20 @@
-from pymongo import MongoClient
-import random
+from pymongo import MongoClient, UpdateOne
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "foodPlaces", "backend")) # Shared migration runner
+from migrations import run_migration_from_command_line
 
 client = MongoClient("mongodb://127.0.0.1:27017")
 db = client.bizDB
 businesses = db.biz
 
-for business in businesses.find():
-    businesses.update_one(
+# Function to remove the dummy field from a business
+def remove_dummy(business):
+    return UpdateOne(
         { "_id" : business['_id'] },
         { "$unset" : {"dummy" : ""} }
-    )
\ No newline at end of file
+    )
+
+run_migration_from_command_line(businesses, remove_dummy, "remove_dummy",
+                                query={ "dummy" : { "$exists" : True } }, projection={ "_id" : 1 })
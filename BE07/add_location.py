@@ -1,5 +1,10 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 import random
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "foodPlaces", "backend")) # Shared migration runner
+from migrations import run_migration_from_command_line
 
 locations = {
     "Coleraine" : [55.10653864221481, -6.703013870894064, 55.16083114339611, -6.640640630380869],
@@ -18,20 +23,24 @@ client = MongoClient("mongodb://127.0.0.1:27017")
 db = client.bizDB
 businesses = db.biz
 
-for location in locations:
-    for business in businesses.find( { "town" : location } ):
-        rand_x = locations[location][0] + ( (locations[location][2] - locations[location][0]) * (random.randint(0,100) / 100) )
-        rand_y = locations[location][1] + ( (locations[location][3] - locations[location][1]) * (random.randint(0,100) / 100) )
-        businesses.update_one(
-            { "_id" : business["_id"] },
-            { "$set" : 
-                { 
-                    "location" : 
-                        {
-                            "type" : "Point",
-                            "coordinates" : [rand_x, rand_y]
-                        }
+# Function to place a business at a random point inside its town
+def add_location(business):
+    location = business["town"]
+    rand_x = locations[location][0] + ( (locations[location][2] - locations[location][0]) * (random.randint(0,100) / 100) )
+    rand_y = locations[location][1] + ( (locations[location][3] - locations[location][1]) * (random.randint(0,100) / 100) )
+    return UpdateOne(
+        { "_id" : business["_id"] },
+        { "$set" : 
+            { 
+                "location" : 
+                    {
+                        "type" : "Point",
+                        "coordinates" : [rand_x, rand_y]
+                    }
 
-                }
             }
-        )
\ No newline at end of file
+        }
+    )
+
+run_migration_from_command_line(businesses, add_location, "add_location",
+                                query={ "town" : { "$in" : list(locations) } }, projection={ "town" : 1 })
@@ -1,15 +1,22 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 import random
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "foodPlaces", "backend")) # Shared migration runner
+from migrations import run_migration_from_command_line
 
 client = MongoClient("mongodb://127.0.0.1:27017")
 db = client.bizDB
 businesses = db.biz
 
-for business in businesses.find():
-    businesses.update_one(
+# Function to remove the dummy field and add the employee count and yearly profits of a business
+# $unset and $set go in the same update document, a third argument to update_one is read as upsert
+def add_fields(business):
+    return UpdateOne(
         {"_id" : business['_id'] },
-        {"$unset" : {"dummy" : ""} },
         {
+            "$unset" : {"dummy" : ""},
             "$set" : {
                 "num_employees" : random.randint(1, 100),
                 "profit" : [
@@ -27,4 +34,6 @@ for business in businesses.find():
                 ]
             }
         }
-    )
\ No newline at end of file
+    )
+
+run_migration_from_command_line(businesses, add_fields, "add_fields", projection={ "_id" : 1 })
@@ -5,6 +5,13 @@ import jwt
 import datetime
 from functools import wraps
 import bcrypt
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "foodPlaces", "backend")) # Shared index registry
+from indexes import reconcile_indexes_in_background
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "biz")) # Town summaries shared with biz/app.py
+from town_stats import mark_towns_changed
 
 client = MongoClient("mongodb://127.0.0.1:27017")
 db = client.bizDB #Selects the database
@@ -12,6 +19,7 @@ businesses = db.biz #Selects the collection name
 
 users = db.users
 blacklist = db.blacklist
+reconcile_indexes_in_background(db, "biz") # Builds missing indexes without delaying startup
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'mysecret'
@@ -190,6 +198,7 @@ def add_businesses(): #Defines function to add business
         
         #Inserts the new business into the 'businesses' collection
         new_business_id = businesses.insert_one(new_business) #Adds thew new business and assigns it to 'new_business_id'
+        mark_towns_changed(db, [new_business["town"]]) #The town summary is recomputed on the next refresh
         #Creates a link to the newly added business
         new_business_link = "http://127.0.0.1:2000/api/v1.0/businesses/" \
                             + str(new_business_id.inserted_id) #Adds the URL with the new business ID
@@ -205,15 +214,17 @@ def edit_businesses(id): #Defines function, takes id as input
     if  "name" in request.form and \
         "town" in request.form and \
         "rating" in request.form:
-        result = businesses.update_one(
+        previous = businesses.find_one_and_update(
             {"_id" : ObjectId(id)},
             {"$set" : {
                 "name" : request.form["name"],
                 "town" : request.form["town"],
                 "rating" : request.form["rating"]
-            }}
+            }},
+            projection = {"town" : 1} #Town before the edit
         )
-        if  result.matched_count == 1:
+        if  previous is not None:
+            mark_towns_changed(db, [previous.get("town"), request.form["town"]]) #Both towns if the business moved
             edited_business_link = "http://127.0.0.1:2000/api/v1.0/businesses/" + id
             return make_response( jsonify ({"url" : edited_business_link}), 200) #Output,      
         else:
@@ -226,8 +237,9 @@ def edit_businesses(id): #Defines function, takes id as input
 @jwt_required
 @admin_required
 def delete_businesses(id): #Defines function, takes id as input
-    result = businesses.delete_one( {"_id" : ObjectId(id)} )
-    if result.deleted_count == 1:
+    deleted = businesses.find_one_and_delete( {"_id" : ObjectId(id)}, projection = {"town" : 1} )
+    if deleted is not None:
+        mark_towns_changed(db, [deleted.get("town")]) #The town loses a business
         return make_response( jsonify ({}), 204)
     else:
         return make_response( jsonify ({"error" : "Invalid business ID"}), 404) #Output, returns error message with 404 status
@@ -1,12 +1,24 @@
 from flask import Flask, request, jsonify, make_response
 from pymongo import MongoClient
 from bson import ObjectId
+import base64
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "foodPlaces", "backend")) # Shared index registry
+from indexes import reconcile_indexes_in_background
+from projection import parse_fields
+from town_stats import STATS_COLLECTION, mark_towns_changed, refresh_town_stats
+from raw_json import raw_collection, raw_response, page_response, RawDocuments
 
 app = Flask(__name__)
 
 client = MongoClient("mongodb://127.0.0.1:27017")
 db = client.bizDB # Selects the database
 businesses = db.biz # Selects the collection
+raw_businesses = raw_collection(businesses) # Same collection read as raw BSON, for routes that only pass documents on
+BUSINESS_FIELDS = ['name', 'town', 'rating', 'reviews', 'location'] # Fields a client can select with 'fields'
+reconcile_indexes_in_background(db, "biz") # Builds missing indexes without delaying startup
 
 '''
 This function handles GET requests to fetch all business with pagination. It sets values for
@@ -26,26 +38,60 @@ def show_all_businesses(): # Defines function to show all businesses
     
     # Checks if 'ps' (page size) is provided in the query paramenters   
     if request.args.get('ps'): # Retreives the 'ps' paramter if it exists
-        page_num = int(request.args.get('ps')) # Converts the page number to an integer
+        page_size = int(request.args.get('ps')) # Converts the page size to an integer
+    if page_size < 1: # Pages hold at least one business
+        return make_response(jsonify({"error": "Page size must be at least 1"}), 400)
 
-    # Calculates the start index of the page    
+    # Checks if 'cursor' (next page token) is provided, it replaces 'pn'
+    query = {} # Matches all businesses
     page_start = (page_size * (page_num - 1)) #Calculates based on current page number and size
+    if request.args.get('cursor'): # Retreives the 'cursor' paramter if it exists
+        last_id = decode_cursor(request.args.get('cursor')) # ID of the last business of the previous page
+        if last_id is None: # If the cursor can't be read
+            return make_response(jsonify({"error": "Invalid cursor"}), 400)
+        query = {"_id": {"$gt": last_id}} # Starts right after the previous page
+        page_start = 0 # No documents to skip
+
+    # Checks if 'fields' (fields to return) is provided, only those fields are read
+    try:
+        projection = parse_fields(request.args.get('fields'), BUSINESS_FIELDS) # Converts the list of fields to a projection
+    except ValueError as err: # If a field is not allowed
+        return make_response(jsonify({"error": str(err)}), 400)
+
+    # Finds the last business of the page from the _id index alone, the cursor header is sent before the businesses
+    last_business = next(businesses.find(query, {"_id": 1}) \
+                    .sort("_id", 1) \
+                    .skip(page_start + page_size - 1) \
+                    .limit(1), None) # Only there when the page is full
+    if last_business is not None: # The page ends at that business even if businesses are added meanwhile
+        query = {"$and": [query, {"_id": {"$lte": last_business['_id']}}]}
+
+    # Queries the databse to get the businesses with pagination, ordered by _id so pages are stable, read as raw BSON
+    businesses_page = raw_businesses.find(query, projection) \
+                    .sort("_id", 1) \
+                    .skip(page_start) \
+                    .limit(page_size) # Skips to the start of the current page / Limits the results to the page size
 
-    # Empty list to store the results
-    data_to_return = [] # Assigs an empty list to 'data_to_return'
+    # Returns the results as a JSON response with a 200 status code, large pages are written while the cursor is read
+    response = page_response(RawDocuments(businesses_page), page_size, 200) # ObjectIds are written as strings
+    if last_business is not None: # A full page means there may be more businesses
+        response.headers['X-Next-Cursor'] = encode_cursor(last_business['_id']) # Token for the next page
+    return response
 
-    # Queries the databse to get the businesses with pagination
-    for business in businesses.find() \
-                    .skip(page_start) \
-                    .limit(page_size): # Skips to the start of the current page / Limits the results to the page size
-        business['_id'] = str(business['_id']) # Converts business ID to string
+'''
+These functions build and read the cursor used to get the next page of businesses. The cursor
+is the ID of the last business on a page, encoded so clients treat it as an opaque token
+'''
+#Builds a cursor from a business ID
+def encode_cursor(id):
+    return base64.urlsafe_b64encode(id.binary).decode() #Encodes the 12 bytes of the ObjectId
 
-        for review in business['reviews']: # Iterates over each review in the business
-            review['_id'] = str(review['_id']) # Converts review ID to string        
-        data_to_return.append(business) # Adds the business to the results list 'data_to_return'
-    
-    # Returns the results as a JSON response with a 200 status code
-    return make_response( jsonify(data_to_return), 200) # Converts the results list to JSON
+#Reads a cursor back into a business ID
+def decode_cursor(cursor):
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor.encode())) #Decodes the 12 bytes of the ObjectId
+    except Exception: #If the cursor is not valid
+        return None
 
 '''
 This function validates the ID by ensuring it's a 24 character hexadecimal string. It checks
@@ -81,14 +127,17 @@ def show_one_businesses(id): #Defines function to show one business which takes
     if not is_valid_objectid(id): #Validates the business ID
         return make_response(jsonify ({"error": "Invalid business ID"}), 400 ) #Returns error message if ID is invalid with 404 status code
 
-    #Queries the database to find the business with the given ID
-    business = businesses.find_one( {'_id' : ObjectId(id)} ) #Retrieves the business from the database
+    #Checks if 'fields' (fields to return) is provided, only those fields are read
+    try:
+        projection = parse_fields(request.args.get('fields'), BUSINESS_FIELDS) #Converts the list of fields to a projection
+    except ValueError as err: #If a field is not allowed
+        return make_response(jsonify({"error": str(err)}), 400)
+
+    #Queries the database to find the business with the given ID, as raw BSON
+    business = raw_businesses.find_one( {'_id' : ObjectId(id)}, projection ) #Retrieves the business from the database
     
     if business is not None: #Checks if the business exists
-        business['_id'] = str(business['_id']) #Converts business ObjectId to string
-        for review in business['reviews']: #Goes over each review in the business
-            review['_id'] = str(review['_id']) #Converts review ObjectId to string
-        return make_response( jsonify (business), 200) #Returns the business data as JSON with a 200 status code
+        return raw_response(business, 200) #Writes the business straight from BSON to JSON, ObjectIds as strings, with a 200 status code
     else: #If business doesn't exists
         return make_response( jsonify ({"error" : "Invalid business ID"}), 404) #Returns an error message with a 404 status code 
 
@@ -111,6 +160,7 @@ def add_businesses(): #Defines function to add business
         
         #Inserts the new business into the 'businesses' collection
         new_business_id = businesses.insert_one(new_business) #Adds thew new business and assigns it to 'new_business_id'
+        mark_towns_changed(db, [new_business["town"]]) #The town summary is recomputed on the next refresh
         #Creates a link to the newly added business
         new_business_link = "http://127.0.0.1:2000/api/v1.0/businesses/" \
                             + str(new_business_id.inserted_id) #Adds the URL with the new business ID
@@ -125,15 +175,17 @@ def edit_businesses(id): #Defines function, takes id as input
     if  "name" in request.form and \
         "town" in request.form and \
         "rating" in request.form:
-        result = businesses.update_one(
+        previous = businesses.find_one_and_update(
             {"_id" : ObjectId(id)},
             {"$set" : {
                 "name" : request.form["name"],
                 "town" : request.form["town"],
                 "rating" : request.form["rating"]
-            }}
+            }},
+            projection = {"town" : 1} #Town before the edit
         )
-        if  result.matched_count == 1:
+        if  previous is not None:
+            mark_towns_changed(db, [previous.get("town"), request.form["town"]]) #Both towns if the business moved
             edited_business_link = "http://127.0.0.1:2000/api/v1.0/businesses/" + id
             return make_response( jsonify ({"url" : edited_business_link}), 200) #Output,      
         else:
@@ -144,8 +196,9 @@ def edit_businesses(id): #Defines function, takes id as input
 #Deletes a business
 @app.route("/api/v1.0/businesses/<string:id>", methods = ["DELETE"]) #Root route, for DELETE method
 def delete_businesses(id): #Defines function, takes id as input
-    result = businesses.delete_one( {"_id" : ObjectId(id)} )
-    if result.deleted_count == 1:
+    deleted = businesses.find_one_and_delete( {"_id" : ObjectId(id)}, projection = {"town" : 1} )
+    if deleted is not None:
+        mark_towns_changed(db, [deleted.get("town")]) #The town loses a business
         return make_response( jsonify ({}), 204)
     else:
         return make_response( jsonify ({"error" : "Invalid business ID"}), 404) #Output, returns error message with 404 status
@@ -157,11 +210,6 @@ def add_new_review(id): #Defines function to add a new review, takes id as its p
     if not is_valid_objectid(id): #Checks if business ID is valid
         return make_response(jsonify ({"error": "Invalid business ID"}), 400) #Returns a error message if ID is invalid with 400 status code
     
-    #Checks if the business exists
-    business = businesses.find_one({'_id' : ObjectId(id)}) #Queries the databse to find the business by ID
-    if not business: #If the business does not exist
-        return make_response(jsonify ({"error" : "Business not found"}), 400) #Returns a error message if ID is invalid with 400 status code
-
     #Validates if there are form data to update
     if not ("username" in request.form and \
            "comment" in request.form and \
@@ -177,7 +225,9 @@ def add_new_review(id): #Defines function to add a new review, takes id as its p
     }
 
     #Updates the business document by pushing the new review into the 'reviews' array
-    businesses.update_one( {"_id" : ObjectId(id)}, {"$push": {"reviews" : new_review}} ) #Adds the 
+    result = businesses.update_one( {"_id" : ObjectId(id)}, {"$push": {"reviews" : new_review}} ) #Adds the review in the same request that finds the business
+    if result.matched_count == 0: #If the business does not exist
+        return make_response(jsonify ({"error" : "Business not found"}), 400) #Returns a error message if ID is invalid with 400 status code
 
     #Creates a link to the newly added review
     new_review_link =  "http://127.0.0.1:2000/api/v1.0/businesses/" \
@@ -194,24 +244,18 @@ def fetch_all_reviews(id): #Defines function to fetch all review of a specified
     if not is_valid_objectid(id): #Checks if business ID is valid
         return make_response(jsonify ({"error": "Invalid business ID"}), 400) #Returns a error message if ID is invalid with 400 status code
     
-    #Checks if the business exists
-    business = businesses.find_one({'_id' : ObjectId(id)}) #Queries the databse to find the business by ID
-    if not business: #If the business does not exist
-        return make_response(jsonify ({"error" : "Business not found"}), 400) #Returns a error message if ID is invalid with 400 status code
-
-    #Initialise a list    
-    data_to_return = [] #Empty list assigned to 'data_to_return'
-    
-    #Retrieves the reviews of a specific business by its ObjectId
-    business = businesses.find_one(
+    #Retrieves the reviews of a specific business by its ObjectId, as raw BSON
+    business = raw_businesses.find_one(
         {"_id" : ObjectId(id)}, \
         {"reviews" : 1, "_id" : 0 }) #Finds the business by its ObjectId and only retrieve its reviews
 
-    #For loop, loops through and proccesses each review    
-    for review in business["reviews"]: #Goes through each review in the business reviews
-        review["_id"] = str(review["_id"]) #Coverts the ID of each review into a string
-        data_to_return.append(review) #Adds the review to the list of data to return
-    return make_response(jsonify (data_to_return), 200 ) #Returns the list of reviews as a JSON response with a 200 status code 
+    #Checks if the business exists
+    if business is None: #If the business does not exist
+        return make_response(jsonify ({"error" : "Business not found"}), 400) #Returns a error message if ID is invalid with 400 status code
+
+    #Each review stays raw BSON until it is written, with its ID as a string
+    reviews = business.get("reviews", []) #Reviews of the business
+    return page_response(RawDocuments(reviews), len(reviews), 200) #Returns the list of reviews as a JSON response with a 200 status code, streamed when long
 
 #Gets one review
 @app.route("/api/v1.0/businesses/<bid>/reviews/<rid>", methods=["GET"])
@@ -224,12 +268,12 @@ def fetch_one_review(bid, rid): #Defines function to fetch one review, takes bid
     
     # Queries the database to find the business by ID and its review by review ID
     business = businesses.find_one(  #Queries the database to find the business with the given ID and the review with the given ID
-    {"_id": ObjectId(id), "reviews._id": ObjectId(rid)},  #Matches both the business ID and the review ID
-    {"_id": 0, "reviews.$": 1}  #Shows only the matched review
+    {"_id": ObjectId(bid)},  #Matches the business ID
+    {"_id": 0, "reviews": {"$elemMatch": {"_id": ObjectId(rid)}}}  #Shows only the matched review
     ) 
 
     #Checks if the business and review exists
-    if not business: #If the review doesn't exist within the business
+    if not business or not business.get('reviews'): #If the review doesn't exist within the business
         return make_response(jsonify ({"error" : "Review not found"}), 404) #Returns an error message with 404 status code
     
     #Converts the review ObjectId to a string
@@ -241,16 +285,23 @@ def fetch_one_review(bid, rid): #Defines function to fetch one review, takes bid
 #Edits a review
 @app.route("/api/v1.0/businesses/<bid>/reviews/<rid>", methods=["PUT"])
 def edit_review(bid, rid):
+    #Validates both business ID and review ID
+    if not is_valid_objectid(bid) or not is_valid_objectid(rid): #Checks if either ID is invalid
+        error_message = "Bad business ID" if not is_valid_objectid(bid) else "Bad review ID" # Sets a error message based on which ID is invalid
+        return make_response(jsonify ({"error" : error_message}), 400) #Returns the error message if either ID is invalid with 400 status code
+
     edited_review = {
         "reviews.$.username" : request.form["username"],
         "reviews.$.comment" : request.form["comment"],
         "reviews.$.stars" : request.form['stars']
         }
 
-    businesses.update_one(
-        { "reviews._id" : ObjectId(rid) },
+    result = businesses.update_one(
+        { "_id" : ObjectId(bid), "reviews._id" : ObjectId(rid) }, #Finds the business by its _id index and the review inside it
         { "$set" : edited_review }
         )
+    if result.matched_count == 0: #If the business or review doesn't exist
+        return make_response(jsonify ({"error" : "Review not found"}), 404)
 
     edit_review_url = "http://localhost:5000/api/v1.0/businesses/" + \
         bid + "/reviews/" + rid
@@ -258,14 +309,46 @@ def edit_review(bid, rid):
     return make_response(jsonify ({"url":edit_review_url}), 200)
 
 #Deletes a review
-@app.route("/api/v1.0/businesses/<bid>/reviews/<id>", methods=["DELETE"])
+@app.route("/api/v1.0/businesses/<bid>/reviews/<rid>", methods=["DELETE"])
 def delete_review(bid, rid): 
-    businesses.update_one(
-        {"_id" : ObjectId(bid)},
+    #Validates both business ID and review ID
+    if not is_valid_objectid(bid) or not is_valid_objectid(rid): #Checks if either ID is invalid
+        error_message = "Bad business ID" if not is_valid_objectid(bid) else "Bad review ID" # Sets a error message based on which ID is invalid
+        return make_response(jsonify ({"error" : error_message}), 400) #Returns the error message if either ID is invalid with 400 status code
+
+    result = businesses.update_one(
+        {"_id" : ObjectId(bid), "reviews._id" : ObjectId(rid)}, #Only matches if the review is there
         { "$pull" : { "reviews" : { "_id" : ObjectId(rid) } } }
         )
+    if result.modified_count == 0: #If nothing was removed
+        return make_response(jsonify ({"error" : "Review not found"}), 404)
     
     return make_response(jsonify ({}), 204)
 
+#Gets the precomputed summary of every town
+@app.route("/api/v1.0/stats/towns", methods=["GET"])
+def show_town_stats():
+    data_to_return = [] #Rows of town_stats, one per town
+    for row in db[STATS_COLLECTION].find({}, {"refreshed_at" : 0}).sort("_id", 1):
+        row["town"] = row.pop("_id") #The row ID is the town name
+        data_to_return.append(row)
+    return make_response(jsonify (data_to_return), 200)
+
+#Gets the precomputed summary of one town
+@app.route("/api/v1.0/stats/towns/<string:town>", methods=["GET"])
+def show_one_town_stats(town):
+    row = db[STATS_COLLECTION].find_one({"_id" : town}, {"refreshed_at" : 0})
+    if row is None: #No businesses in this town, or not refreshed yet
+        return make_response(jsonify ({"error" : "Town not found"}), 404)
+    row["town"] = row.pop("_id")
+    return make_response(jsonify (row), 200)
+
+#Refreshes the town summaries, only the changed towns unless 'full' is set
+@app.route("/api/v1.0/stats/towns/refresh", methods=["POST"])
+def refresh_stats():
+    full = request.args.get("full", "").lower() in ("1", "true", "yes") #Recomputes every town
+    refreshed = refresh_town_stats(db, full)
+    return make_response(jsonify ({"refreshed_towns" : refreshed}), 200)
+
 if __name__ == "__main__":
     app.run(debug = True, port = 2000)
\ No newline at end of file
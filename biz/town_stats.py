@@ -0,0 +1,96 @@
+# Materialized per-town summaries of bizDB.biz
+#
+# Usage: python town_stats.py [--uri mongodb://127.0.0.1:27017] [--db bizDB] [--full]
+#
+# town_stats holds one row per town with the number of businesses, their average
+# rating, the total number of employees and the gross profit of each year, so the
+# dashboard routes in app.py read a handful of precomputed rows instead of
+# aggregating every business. Rows are written by aggregation pipelines ending in
+# $merge, the data never leaves the server.
+#
+# The write routes of app.py record the towns they touch in town_stats_changes. An
+# incremental refresh recomputes only those towns, a full refresh recomputes every
+# town and is needed after changes made outside the app, such as the BE07 migrations.
+
+# Modules
+import argparse
+from datetime import datetime, timezone
+from pymongo import MongoClient, UpdateOne
+
+STATS_COLLECTION = "town_stats" # One row per town
+CHANGES_COLLECTION = "town_stats_changes" # Towns changed since their row was computed
+
+# Function to record that the businesses of some towns changed
+def mark_towns_changed(db, towns):
+    now = datetime.now(timezone.utc)
+    writes = [UpdateOne({"_id": town}, {"$set": {"changed_at": now}}, upsert=True) for town in set(towns) if town]
+    if writes:
+        db[CHANGES_COLLECTION].bulk_write(writes, ordered=False)
+
+# Function to build the pipelines that recompute the rows of the matched businesses' towns
+def stats_pipelines(match, refreshed_at):
+    totals = [ # Counts, average rating and employees, replaces the whole row
+        {"$match": match},
+        {"$group": {
+            "_id": "$town",
+            "business_count": {"$sum": 1},
+            "average_rating": {"$avg": {"$convert": {"input": "$rating", "to": "double", "onError": None, "onNull": None}}}, # Ratings from forms are strings
+            "total_employees": {"$sum": "$num_employees"}
+        }},
+        {"$set": {"average_rating": {"$round": ["$average_rating", 2]}, "profit": [], "refreshed_at": refreshed_at}},
+        {"$merge": {"into": STATS_COLLECTION, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+    profits = [ # Gross profit per year, added to the rows written above
+        {"$match": match},
+        {"$unwind": "$profit"},
+        {"$group": {"_id": {"town": "$town", "year": "$profit.year"}, "gross": {"$sum": "$profit.gross"}}},
+        {"$sort": {"_id.year": 1}},
+        {"$group": {"_id": "$_id.town", "profit": {"$push": {"year": "$_id.year", "gross": "$gross"}}}},
+        {"$merge": {"into": STATS_COLLECTION, "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+    ]
+    return totals, profits
+
+# Function to refresh town_stats, returns the number of towns recomputed
+def refresh_town_stats(db, full=False):
+    refreshed_at = datetime.now(timezone.utc) # Marks the rows written by this run
+    if full:
+        towns, match = None, {"town": {"$exists": True}}
+    else:
+        towns = [change["_id"] for change in db[CHANGES_COLLECTION].find({"changed_at": {"$lte": refreshed_at}}, {"_id": 1})]
+        if not towns: # Nothing changed since the last refresh
+            return 0
+        match = {"town": {"$in": towns}}
+
+    for pipeline in stats_pipelines(match, refreshed_at):
+        db.biz.aggregate(pipeline, allowDiskUse=True)
+
+    # Towns that no longer have businesses were not rewritten
+    stale = {"refreshed_at": {"$lt": refreshed_at}}
+    if towns is not None:
+        stale["_id"] = {"$in": towns}
+    db[STATS_COLLECTION].delete_many(stale)
+
+    # Changes made while the pipelines ran are left for the next refresh
+    done = {"changed_at": {"$lte": refreshed_at}}
+    if towns is not None:
+        done["_id"] = {"$in": towns}
+    db[CHANGES_COLLECTION].delete_many(done)
+    return len(towns) if towns is not None else db[STATS_COLLECTION].count_documents({})
+
+# Main function to refresh the town summaries
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the materialized town summaries")
+    parser.add_argument("--uri", default="mongodb://127.0.0.1:27017", help="MongoDB connection string")
+    parser.add_argument("--db", default="bizDB", help="Database name")
+    parser.add_argument("--full", action="store_true", help="Recompute every town instead of the changed ones")
+    args = parser.parse_args()
+
+    try:
+        count = refresh_town_stats(MongoClient(args.uri)[args.db], args.full)
+        print(f"Refreshed {count} towns")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# Compares the old and new JSON encoding of a large city response, and the raw BSON path
+#
+# Usage: python benchmark_json.py [--places 5000] [--reviews-max 50] [--repeat 20] [--seed 1]
+#
+# Builds a city with --places generated places, shaped like the response of
+# GET /api/cities/<city_id>?include_places=true, and times three ways of encoding it:
+#
+#   tree walk + json   the routes before BSONJSONProvider: every document copied by
+#                      convert_objectid_to_str, then Flask's default provider (sorted keys)
+#   provider (json)    BSONJSONProvider with the json module
+#   provider (orjson)  BSONJSONProvider with orjson, when it is installed
+#
+# It then starts from the BSON bytes a cursor receives and compares, with the peak
+# memory of each:
+#
+#   decoded cursor     every place decoded to a dict, as pymongo does, then jsonify
+#   raw passthrough    RawBSONDocuments written out by raw_json.raw_response
+#
+# No database is needed, the places come from generate_data.py.
+
+# Modules
+import argparse
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+import bson
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+import json_provider
+from generate_data import generate_place, zipf_weights, seeded_object_id, START_DATE, TOWNS
+from versions import new_version
+from raw_json import raw_response, RawDocuments
+
+# Function the routes used to turn ObjectIds into strings before jsonify, kept here to compare with
+def convert_objectid_to_str(document):
+    if isinstance(document, dict):
+        return {key: convert_objectid_to_str(value) for key, value in document.items()}
+    if isinstance(document, list):
+        return [convert_objectid_to_str(value) for value in document]
+    if isinstance(document, ObjectId):
+        return str(document)
+    return document
+
+# Function to build the response of a city with its places
+def build_city_response(args):
+    rng = random.Random(args.seed)
+    town = "Belfast"
+    city_id = seeded_object_id(rng, START_DATE)
+    generator_args = SimpleNamespace(words_min=5, words_max=40)
+    review_weights = zipf_weights(args.reviews_max + 1, 1.1)
+    places = []
+    for number in range(args.places):
+        for kind, document in generate_place(rng, city_id, town, TOWNS[town], number, generator_args, review_weights):
+            if kind == "places":
+                places.append(new_version(document)) # Dates as stored by the routes
+    return {
+        "data": {"_id": city_id, "city_id": "city_0", "city_name": town, "places": places},
+        "includes": {"places": True},
+        "filters_applied": None
+    }
+
+# Function to time an encoding, returns the best time in seconds and the body size
+def time_encoding(encode, response, repeat):
+    best, size = None, 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = len(encode(response))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+# Function to measure the peak memory of an encoding, in bytes
+def peak_memory(encode, response):
+    tracemalloc.start()
+    try:
+        encode(response)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Function to build the city response with other places
+def with_places(response, places):
+    return dict(response, data=dict(response["data"], places=places))
+
+# Main function to run the benchmark
+def main():
+    parser = argparse.ArgumentParser(description="Compare the old and new JSON encoding of a large city")
+    parser.add_argument("--places", type=int, default=5000, help="Number of places in the city")
+    parser.add_argument("--reviews-max", type=int, default=50, help="Most reviews of a place, their previews are in the response")
+    parser.add_argument("--repeat", type=int, default=20, help="Number of runs of each encoding, the best is kept")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the generated places")
+    args = parser.parse_args()
+
+    try:
+        response = build_city_response(args)
+        app = Flask(__name__)
+        old_provider = DefaultJSONProvider(app)
+        orjson_module = json_provider.orjson
+
+        encodings = [("tree walk + json", lambda value: old_provider.dumps(convert_objectid_to_str(value), separators=(",", ":")).encode())]
+        json_provider.orjson = None # json module backend
+        encodings.append(("provider (json)", json_provider.encode_json))
+        results = [(name, *time_encoding(encode, response, args.repeat)) for name, encode in encodings]
+        json_provider.orjson = orjson_module
+        if orjson_module is not None:
+            results.append(("provider (orjson)", *time_encoding(json_provider.encode_json, response, args.repeat)))
+
+        baseline = results[0][1]
+        print(f"City with {args.places} places, best of {args.repeat} runs")
+        for name, seconds, size in results:
+            print(f"{name:<20} {seconds * 1000:9.1f} ms  {size / 1024:9.0f} KiB  {baseline / seconds:5.1f}x")
+        if orjson_module is None:
+            print("orjson is not installed, pip install orjson to compare it")
+
+        # From the BSON a cursor receives
+        received = [bson.encode(place) for place in response["data"]["places"]]
+        decoded = lambda value: json_provider.encode_json(with_places(value, [bson.decode(raw) for raw in received]))
+        raw = lambda value: raw_response(with_places(value, RawDocuments(RawBSONDocument(raw) for raw in received))).get_data()
+        print(f"From {sum(len(raw) for raw in received) / 1024:.0f} KiB of BSON")
+        with app.app_context(): # raw_response builds a Flask response
+            paths = [(name, *time_encoding(encode, response, args.repeat), peak_memory(encode, response))
+                     for name, encode in [("decoded cursor", decoded), ("raw passthrough", raw)]]
+        baseline = paths[0][1]
+        for name, seconds, size, peak in paths:
+            print(f"{name:<20} {seconds * 1000:9.1f} ms  {size / 1024:9.0f} KiB  {baseline / seconds:5.1f}x  peak {peak / 1024 / 1024:6.1f} MiB")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+# File for the cache routes
+
+# Modules
+from flask import Blueprint, make_response, jsonify
+from decorators import jwt_required, admin_required
+from result_cache import results
+
+cache_bp = Blueprint("cache_bp", __name__)
+
+# Gets the counters of the response cache of this worker
+@cache_bp.route("/api/cache/stats", methods=["GET"])
+#@jwt_required
+#@admin_required
+def show_cache_stats():
+    return make_response(jsonify(results.stats()), 200)
+
+# Empties the response cache of this worker
+@cache_bp.route("/api/cache", methods=["DELETE"])
+#@jwt_required
+#@admin_required
+def clear_cache():
+    results.clear()
+    return make_response(jsonify({"message": "Cache cleared"}), 200)
@@ -4,30 +4,100 @@
 from flask import Blueprint, request, make_response, jsonify
 import globals # Import globals.py
 from decorators import jwt_required, admin_required
+from pagination import validate_pagination_params, validate_count_mode, apply_cursor, keyset_sort, read_page, total_pages, MAX_STREAMED_PAGE_SIZE
+from projection import parse_fields
+from result_cache import cached, invalidates_cache
+from blueprints.places.places import PLACE_FIELDS
+from place_data import normalize_city_name, geo_point
+from city_stats import STATS_FIELD, empty_stats, apply_stats_change, place_changes, merge_changes, reconcile_city_stats
+from versions import conditional, new_version, with_version, VERSION_UPDATE, VERSION_FIELD, UPDATED_FIELD
+from raw_json import raw_collection, raw_response, page_response, RawDocuments
 
 from flask import Flask, request, jsonify, make_response
 from pymongo import MongoClient
 from bson import ObjectId
 from datetime import datetime
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne, DeleteMany
 import jwt
 import datetime
 from functools import wraps
 import bcrypt
+import re
 
 cities_bp = Blueprint("cities_bp", __name__)
-places = globals.db.foodPlacesDB
+businesses = globals.db.foodPlacesDB # Cities collection
+places = globals.db.places # Places collection, keyed by city_id
+reviews = globals.db.reviews # Reviews collection
+raw_businesses = raw_collection(businesses) # Cities read as raw BSON, for the routes that only pass them on
+raw_places = raw_collection(places) # Places read as raw BSON, for the routes that only pass them on
+
+NAME_MATCH_MODES = ['prefix', 'contains'] # How the 'name' filter matches city names
+SORT_PATHS = { # Sort fields and the indexed field they sort on
+    'city_name': 'city_name_lc',
+    'place_count': STATS_FIELD + '.place_count',
+    'avg_rating': STATS_FIELD + '.average_rating'
+}
+CITY_FIELDS = ['city_id', 'city_name', STATS_FIELD] # Fields a client can select with fields=
+
+# Projection that shapes a place as show_one_city returns it, missing fields come back as null
+CITY_PLACE_PROJECTION = {
+    "_id": 0,
+    **{field: {"$ifNull": ["$" + field, None]} for field in ['place_id', 'info', 'location', 'business_hours', 'service_options', 'menu_options', 'amenities']},
+    "ratings": {
+        "average_rating": {"$ifNull": ["$ratings.average_rating", None]},
+        "review_count": {"$ifNull": ["$ratings.review_count", None]},
+        "recent_reviews": {"$ifNull": ["$ratings.recent_reviews", []]}
+    },
+    "media": {"$ifNull": ["$media", None]}
+}
+
+# Place fields kept up to date by the server, never taken from an update_city request
+# The ratings follow the reviews collection, so a place sent back as show_one_city
+# returned it (without rating_sum, review ids as strings) leaves them untouched.
+SERVER_PLACE_FIELDS = ("_id", "city_id", "ratings", VERSION_FIELD, UPDATED_FIELD)
+EMPTY_RATINGS = {"average_rating": 0, "review_count": 0, "rating_sum": 0, "recent_reviews": []} # Ratings of a place without reviews
+
+# Function to work out the changes between a stored place and the fields sent for it
+# Nested objects are compared field by field so only the changed paths are written,
+# other values (lists included) are replaced when they differ. Fields missing from a
+# sent object are removed, the same as replacing the object would do.
+def diff_fields(stored, incoming, prefix=''):
+    set_fields, unset_fields = {}, {}
+    for key, value in incoming.items(): # Each sent field
+        path = prefix + key
+        current = stored.get(key) if isinstance(stored, dict) else None
+        if isinstance(value, dict) and isinstance(current, dict) and value: # Compare inside the object
+            nested_set, nested_unset = diff_fields(current, value, path + '.')
+            set_fields.update(nested_set)
+            unset_fields.update(nested_unset)
+            for removed in current.keys() - value.keys(): # Fields left out of the sent object
+                unset_fields[f"{path}.{removed}"] = ""
+        elif not isinstance(stored, dict) or key not in stored or current != value: # New or changed value
+            set_fields[path] = value
+    return set_fields, unset_fields
+
+# Function to build the city name filter
+# 'prefix' is an anchored regex on city_name_lc, so it is answered from the index bounds.
+# 'contains' uses the text index on city_name and matches whole words anywhere in the name.
+def city_name_query(name, match):
+    if match == 'contains':
+        return {'$text': {'$search': name}}
+    return {'city_name_lc': {'$regex': '^' + re.escape(normalize_city_name(name))}} # User input is escaped
 # Gets all cities with pagination, optional filtering, and sorting
 @cities_bp.route("/api/cities", methods=["GET"]) # Route to cities, uses GET method
+@cached("cities", ttl=30)
 def show_all_cities(): # Function to show all cities
     try: # Try to handle potential errors
         # Get pagination parameters from request
         page_num, page_size = validate_pagination_params(
             request.args.get('pn'),
-            request.args.get('ps')
+            request.args.get('ps'),
+            MAX_STREAMED_PAGE_SIZE # Large pages are streamed
         )
         # Calculate pagination starting point
-        page_start = (page_num - 1) * page_size
+        cursor = request.args.get('cursor') # Cursor from the previous page, replaces pn
+        page_start = 0 if cursor else (page_num - 1) * page_size
+        count_mode = validate_count_mode(request.args.get('count')) # How total_items is worked out
 
         # Dictionary to store query filters
         query = {}  
@@ -35,45 +105,51 @@ def show_all_cities(): # Function to show all cities
         # Filters the database by city name if a 'name' parameter is provided in the query
         name = request.args.get('name') 
         if name: # Checks if a name filter is provided 
-            query['city_name'] = {'$regex': name, '$options': 'i'} # Case-insensitive regex for name
+            match = request.args.get('match', 'prefix').lower() # Defaults to names starting with 'name'
+            if match not in NAME_MATCH_MODES: # Must be a known mode
+                raise ValueError(f"Match must be one of: {NAME_MATCH_MODES}")
+            query.update(city_name_query(name, match))
 
         # Validates the sorting options
-        valid_sort_fields = ['city_name'] 
+        valid_sort_fields = list(SORT_PATHS) 
         sort_field = request.args.get('sort_by', 'city_name') # Defaults to 'city_name'
         if sort_field not in valid_sort_fields: 
             sort_field = 'city_name'  # Default to 'city_name' if invalid
+        sort_field = SORT_PATHS[sort_field] # Sorts on the indexed lower-case name or city stats
+        projection = parse_fields(request.args.get('fields'), CITY_FIELDS, required=[sort_field]) # Sort key is kept for the cursor
         
         # Determines the sorting and order fields
         sort_order = request.args.get('sort_order', 'asc')
         sort_direction = DESCENDING if sort_order.lower() == 'desc' else ASCENDING # Set sort based on the 'sort_order'
         
-        # Counts the total cities matching the query for pagination purposes
-        total_cities = businesses.count_documents(query) # Gets the total count of matching cities
-        if total_cities == 0:
-                return make_response(jsonify({"message": "No cities were found matching the criteria."}), 404)
-        
-        # Retrieve matching cities from the database with pagination and sorting
-        cities_taken = businesses.find(query) \
-            .sort(sort_field, sort_direction) \
-            .skip(page_start) \
-            .limit(page_size) # Applies sorting, pagination, and filters
+        # Restricts the query to the cities after the cursor
+        page_query = apply_cursor(query, cursor, sort_field, sort_direction) if cursor else query
 
-        # Converts to a list and ObjectId fields to strings using the helper function
-        data_to_return = [convert_objectid_to_str(city) for city in cities_taken]
+        # Retrieve matching cities from the database with pagination and sorting
+        cities_taken, total_cities, next_cursor = read_page( # Indexed page and total, large pages streamed as raw BSON
+            businesses, raw_businesses, query, page_query,
+            keyset_sort(sort_field, sort_direction),
+            page_start, page_size,
+            projection=projection,
+            count_mode=count_mode,
+            estimate_allowed=not query # The collection count is only right without filters
+        )
 
         # Returns a 404 status code if no cities found
-        if not data_to_return: # Checks if the data list is empty
+        if cities_taken is None: # Checks if the page is empty
             return make_response(jsonify({"message": "No cities were found matching the criteria."}), 404)
 
         # Returns the paginated results with city data as JSON response
-        return make_response(jsonify({
-            'cities': data_to_return, # List of cities with places and related data
+        return page_response({
+            'cities': cities_taken, # List of cities with places and related data
             'pagination': { # Pagination information
                 'current_page': page_num,
-                'total_pages': (total_cities + page_size - 1) // page_size, # Calculates the total pages
+                'total_pages': total_pages(total_cities, page_size), # Calculates the total pages
                 'page_size': page_size,
-                'total_items': total_cities 
-            }}), 200)
+                'total_items': total_cities,
+                'next': next_cursor # Cursor of the next page, None on the last page
+            }
+        }, page_size, 200)
 
     except ValueError as value_err: # Handles invalid parameter values
         return make_response(jsonify({"message": "Invalid parameter value", "error": str(value_err)}), 400)
@@ -83,76 +159,60 @@ def show_all_cities(): # Function to show all cities
 
 # Gets a specific city by ID with filters
 @cities_bp.route("/api/cities/<city_id>", methods=["GET"])
+@conditional(businesses, lambda city_id: {"_id": ObjectId(city_id)})
+@cached("city", ttl=60)
 def show_one_city(city_id): 
     try: 
         # Validates the ObjectId format
-        if not is_valid_objectid(city_id): # Check if ID format is valid
+        if not ObjectId.is_valid(city_id): # Check if ID format is valid
             return make_response(jsonify({ # Return error if invalid
                 "error": "Invalid ObjectId format"
             }), 400)
 
         # Gets city from database
-        city = businesses.find_one({"_id": ObjectId(city_id)}) # Find city by ID
+        city = businesses.find_one({"_id": ObjectId(city_id)}, {"city_id": 1, "city_name": 1, STATS_FIELD: 1}) # Find city by ID, only the returned fields
         if not city: # If city not found
             return make_response(jsonify({ # Return error response
                 "error": f"City with ID {city_id} not found"
             }), 404)
 
-        # Processes ObjectId fields
-        city = convert_objectid_to_str(city) # Convert ObjectIds to strings
-
         # Gets filter parameters
         include_places = request.args.get('include_places', 'false').lower() == 'true' # Whether to include places
         min_rating = float(request.args.get('min_rating', 0)) # Minimum rating filter
         max_rating = float(request.args.get('max_rating', 5)) # Maximum rating filter
         place_type = request.args.get('place_type') # Type of place filter
+        place_projection = parse_fields(request.args.get('fields'), PLACE_FIELDS) # Place fields to return
 
         # Returns basic city data if places not requested
         if not include_places: # If places not needed
             return make_response(jsonify({ # Return simple response
                 'data': {
                     'city_id': city.get('city_id'), # City identifier
-                    'city_name': city.get('city_name') # City name
+                    'city_name': city.get('city_name'), # City name
+                    'stats': city.get(STATS_FIELD) # Place and review counts
                 },
                 'includes': {'places': False}, # Indicates no places included
                 'filters_applied': None # No filters used
             }), 200)
 
-        # Processes and filters places
-        filtered_places = [] # Initialize filtered places list
-        for place in city.get('places', []): # Loop through each place
-            # Checks rating criteria
-            rating = place.get('ratings', {}).get('average_rating') # Get place rating
-            if rating is None or not (min_rating <= rating <= max_rating): # If rating doesn't match
-                continue # Skip this place
-
-            # Checks place type criteria
-            if place_type and place_type.lower() not in [t.lower() for t in place.get('info', {}).get('type', [])]:
-                continue # Skip if type doesn't match
-
-            # Creates place data object
-            place_data = { # Structure place information
-                'place_id': place.get('place_id'), # Place identifier
-                'info': place.get('info'), # Basic information
-                'location': place.get('location'), # Address and coordinates
-                'business_hours': place.get('business_hours'), # Operating hours
-                'service_options': place.get('service_options'), # Available services
-                'menu_options': place.get('menu_options'), # Menu details
-                'amenities': place.get('amenities'), # Available amenities
-                'ratings': { # Rating information
-                    'average_rating': rating, # Overall rating
-                    'review_count': place.get('ratings', {}).get('review_count'), # Number of reviews
-                    'recent_reviews': place.get('ratings', {}).get('recent_reviews', []) # Latest reviews
-                },
-                'media': place.get('media') # Photos and media
-            }
-            filtered_places.append(place_data) # Add to filtered list
+        # Filters places in the database
+        place_query = { # Places of this city within the rating range
+            "city_id": ObjectId(city_id),
+            "ratings.average_rating": {"$gte": min_rating, "$lte": max_rating}
+        }
+        if place_type: # Case-insensitive exact match on any of the place types
+            place_query["info.type"] = {"$regex": f"^{re.escape(place_type)}$", "$options": "i"}
+
+        # Reads the places as raw BSON, shaped by the server, they are written out without being looked at
+        projection = {**place_projection, "_id": 0} if place_projection else CITY_PLACE_PROJECTION # Only the selected fields
+        filtered_places = RawDocuments(raw_places.find(place_query, projection)) # Encoded one at a time by raw_response
 
         # Returns complete response
-        return make_response(jsonify({ # Create JSON response
+        return raw_response({ # Create JSON response
             'data': { # Main data object
                 'city_id': city.get('city_id'), # City identifier
                 'city_name': city.get('city_name'), # City name
+                'stats': city.get(STATS_FIELD), # Place and review counts
                 'places': filtered_places # Filtered places list
             },
             'includes': {'places': True}, # Indicates places included
@@ -161,7 +221,7 @@ def show_one_city(city_id):
                 'max_rating': max_rating if max_rating < 5 else None, # Maximum rating if set
                 'place_type': place_type # Place type if specified
             }
-        }), 200)
+        }, 200)
 
     except ValueError as err: # Handles value errors
         return make_response(jsonify({ # Return error response
@@ -179,6 +239,7 @@ def show_one_city(city_id):
 
 # Creates a new city
 @cities_bp.route("/api/cities", methods=["POST"])
+@invalidates_cache
 #@jwt_required 
 def create_new_city(): 
     try: 
@@ -198,8 +259,11 @@ def create_new_city():
         city_document = { # Initialize city document
             "city_id": city_data["city_id"], # Set city ID
             "city_name": city_data["city_name"], # Set city name
-            "places": [] # Empty places array
+            "city_name_lc": normalize_city_name(city_data["city_name"]), # Lower-case name for search and sort
+            STATS_FIELD: empty_stats() # Counted below as places are added
         }
+        new_version(city_document) # First version, for conditional GETs
+        city_places = [] # Places stored in the places collection
 
         # Processes places if provided
         if "places" in city_data: # If places included in request
@@ -220,6 +284,9 @@ def create_new_city():
                     coords["longitude"] = float(coords.get("longitude", 0)) # Convert longitude to float
                 except (ValueError, TypeError): # If conversion fails
                     return make_response(jsonify({"error": "Invalid coordinates format"}), 400) 
+                point = geo_point(coords) # GeoJSON point used by the near search
+                if point: # Only valid coordinates are indexed
+                    location["geo"] = point
 
                 # Creates clean place object
                 clean_place = { # Initialize clean place structure
@@ -237,6 +304,7 @@ def create_new_city():
                     "ratings": { 
                         "average_rating": 0, # Default rating
                         "review_count": 0, # Default review count
+                        "rating_sum": 0, # Default sum of ratings
                         "recent_reviews": [] # Empty reviews array
                     },
                     "media": {"photos": []} # Empty media array
@@ -247,17 +315,25 @@ def create_new_city():
                     ratings = place["ratings"] # Get ratings data
                     clean_place["ratings"]["average_rating"] = float(ratings.get("average_rating", 0)) # Set rating
                     clean_place["ratings"]["review_count"] = int(ratings.get("review_count", 0)) # Set count
+                    clean_place["ratings"]["rating_sum"] = clean_place["ratings"]["average_rating"] * clean_place["ratings"]["review_count"] # Set sum
                     clean_place["ratings"]["recent_reviews"] = ratings.get("recent_reviews", []) # Set reviews
 
                 # Processes media if provided
                 if "media" in place and "photos" in place["media"]: # If photos included
                     clean_place["media"]["photos"] = place["media"]["photos"] # Set photos
 
-                city_document["places"].append(clean_place) # Add clean place to city
+                city_places.append(new_version(clean_place)) # Add clean place to city
 
         # Inserts city into database
         result = businesses.insert_one(city_document) # Insert new city
 
+        # Inserts places into the places collection
+        if city_places: # If places were provided
+            for place in city_places: # Reference the new city from each place
+                place["city_id"] = result.inserted_id
+            places.insert_many(city_places) # Insert all places at once
+            apply_stats_change(businesses, result.inserted_id, merge_changes(*[place_changes(place) for place in city_places])) # Counts the places in the city stats
+
         # Returns success response
         return make_response(jsonify({ # Create success response
             "message": "City created successfully", # Success message
@@ -273,11 +349,12 @@ def create_new_city():
 
 # Updates an existing city
 @cities_bp.route("/api/cities/<city_id>", methods=["PUT"]) 
+@invalidates_cache
 #@jwt_required
 def update_city(city_id): 
     try: # Try to handle potential errors
         # Validates the ObjectId format
-        if not is_valid_objectid(city_id): # Check if ID format is valid
+        if not ObjectId.is_valid(city_id): # Check if ID format is valid
             return make_response(jsonify({"error": "Invalid ObjectId format"}), 400)
 
         # Gets update data from request
@@ -292,13 +369,24 @@ def update_city(city_id):
 
         # Creates update document
         update_fields = {} # Initialize update fields
+        place_operations = [] # Writes to the places collection
 
         # Updates basic city information
         if "city_name" in update_data: # If name update provided
             update_fields["city_name"] = update_data["city_name"] # Add name update
+            update_fields["city_name_lc"] = normalize_city_name(update_data["city_name"]) # Keep the search name in step
 
         # Updates places if provided
         if "places" in update_data: # If places update provided
+            place_ids = [place.get("place_id") for place in update_data["places"]] # Places listed in the request
+            stored_fields = {"place_id": 1} # Only the fields that were sent are read back to compare
+            for place in update_data["places"]:
+                stored_fields.update({key: 1 for key in place if key not in SERVER_PLACE_FIELDS and key != "place_id"})
+            stored_places = { # Current version of the listed places, by place_id
+                place["place_id"]: place
+                for place in places.find({"city_id": ObjectId(city_id), "place_id": {"$in": place_ids}}, stored_fields)
+            }
+
             for place in update_data["places"]: # Process each place
                 # Validates required place fields
                 if "place_id" not in place: # If place_id missing
@@ -316,7 +404,37 @@ def update_city(city_id):
                         coords["longitude"] = float(coords.get("longitude", 0)) # Convert longitude
                     except (ValueError, TypeError): # If conversion fails
                         return make_response(jsonify({ "error": "Invalid coordinates format"}), 400)
-
+                    point = geo_point(coords) # GeoJSON point used by the near search
+                    if point: # Only valid coordinates are indexed
+                        place["location"]["geo"] = point
+
+                place_fields = {key: value for key, value in place.items() if key not in SERVER_PLACE_FIELDS} # Place fields to store
+                stored_place = stored_places.get(place["place_id"])
+                if stored_place is None: # New place, stored whole
+                    place_fields["city_id"] = ObjectId(city_id) # Reference to the city
+                    place_operations.append(UpdateOne(
+                        {"city_id": ObjectId(city_id), "place_id": place["place_id"]},
+                        with_version({"$set": place_fields, "$setOnInsert": {"ratings": EMPTY_RATINGS}}), # Version 1 and no reviews when inserted
+                        upsert=True
+                    ))
+                    continue
+
+                set_fields, unset_fields = diff_fields(stored_place, place_fields) # Only the changed paths
+                if not set_fields and not unset_fields: # Unchanged place, nothing is written
+                    continue
+                changes = {}
+                if set_fields:
+                    changes["$set"] = set_fields
+                if unset_fields:
+                    changes["$unset"] = unset_fields
+                place_operations.append(UpdateOne({"_id": stored_place["_id"]}, with_version(changes))) # Point update on the place
+
+            # Removes places of the city that are no longer listed, their reviews go with them
+            removed_place_ids = [place["_id"] for place in places.find(
+                {"city_id": ObjectId(city_id), "place_id": {"$nin": place_ids}}, {"_id": 1}
+            )]
+            if removed_place_ids:
+                place_operations.append(DeleteMany({"_id": {"$in": removed_place_ids}}))
             update_fields["places"] = update_data["places"] # Add places update
 
         # Checks if any valid updates provided
@@ -324,19 +442,39 @@ def update_city(city_id):
             return make_response(jsonify({"error": "No valid update fields provided"}), 400)
 
         # Updates city in database
-        result = businesses.update_one( # Perform update
-            {"_id": ObjectId(city_id)}, # Find city by ID
-            {"$set": update_fields} # Set new values
-        )
+        city_fields = {key: value for key, value in update_fields.items() if key != "places"} # Fields stored on the city
+        if city_fields: # If the city itself changes
+            result = businesses.update_one( # Perform update
+                {"_id": ObjectId(city_id)}, # Find city by ID
+                {"$set": city_fields} # Set new values
+            )
+            city_found = result.matched_count > 0
+        else: # Only places change
+            city_found = businesses.count_documents({"_id": ObjectId(city_id)}, limit=1) > 0
 
         # Checks update result
-        if result.matched_count == 0: # If city not found
+        if not city_found: # If city not found
             return make_response(jsonify({"error": "City not found"}), 404)
 
+        # Updates places in the places collection
+        places_report = None # Place counts, only when places were sent
+        if "places" in update_data: # If places update provided
+            result = places.bulk_write(place_operations, ordered=True) if place_operations else None # Upserts run before the delete
+            if removed_place_ids: # Reviews of the removed places, as delete_place does
+                reviews.delete_many({"place_id": {"$in": removed_place_ids}})
+            places_report = {
+                "modified": result.modified_count if result else 0, # Existing places that changed
+                "added": result.upserted_count if result else 0, # New places
+                "removed": result.deleted_count if result else 0 # Places no longer listed
+            }
+            reconcile_city_stats(globals.db, [ObjectId(city_id)]) # Places were replaced wholesale, the city stats are recomputed
+        businesses.update_one({"_id": ObjectId(city_id)}, VERSION_UPDATE) # After every write, so the new version never comes with old data
+
         # Returns success response
         return make_response(jsonify({ # Return success response
             "message": "City updated successfully",
-            "updated_fields": list(update_fields.keys())
+            "updated_fields": list(update_fields.keys()),
+            "places": places_report # Number of places written
         }), 200)
 
     except ValueError as err: # Handles value errors
@@ -354,17 +492,21 @@ def update_city(city_id):
 
 # Deletes a city
 @cities_bp.route("/api/cities/<city_id>", methods=["DELETE"]) 
+@invalidates_cache
 #@jwt_required
 #@admin_required
 def delete_city(city_id): 
     try:
-        if not is_valid_objectid(city_id):
+        if not ObjectId.is_valid(city_id):
             return make_response(jsonify({"error": "Invalid ID format"}), 400)
         result = businesses.delete_one({"_id": ObjectId(city_id)}) # Delete city by ID
         
         # Check if city was found and deleted
         if result.deleted_count == 0: # If no document was deleted
             return make_response(jsonify({"error": "City not found"}), 404) 
+
+        places.delete_many({"city_id": ObjectId(city_id)}) # Delete the places of the city
+        reviews.delete_many({"city_id": ObjectId(city_id)}) # Delete the reviews of the city
         return make_response(jsonify({"message": "City deleted successfully"}), 200)    
         
     except Exception as err: # Handle any errors
@@ -0,0 +1,47 @@
+# File for the export routes
+
+# Modules
+from flask import Blueprint, request, make_response, jsonify, Response, stream_with_context
+import globals # Import globals.py
+from decorators import jwt_required, admin_required
+from export_data import EXPORT_COLLECTIONS, export_query, export_lines, export_chunks
+
+export_bp = Blueprint("export_bp", __name__)
+
+# Content types of the export formats
+EXPORT_MIMETYPES = {"ndjson": "application/x-ndjson", "json": "application/json"}
+
+# Streams a whole collection, one document per line
+@export_bp.route("/api/export/<collection>", methods=["GET"])
+#@jwt_required
+#@admin_required
+def export_collection(collection):
+    try:
+        if collection not in EXPORT_COLLECTIONS: # Only the foodPlaces collections
+            return make_response(jsonify({"error": f"Collection must be one of: {sorted(EXPORT_COLLECTIONS)}"}), 404)
+
+        export_format = request.args.get('format', 'ndjson').lower() # Defaults to NDJSON
+        compress = request.args.get('gzip', 'false').lower() == 'true' # Whether to gzip the stream
+        query = export_query(request.args.get('since')) # Documents created from this date
+        lines = export_lines(globals.db[EXPORT_COLLECTIONS[collection]], query, export_format)
+        first_line = next(lines, None) # Runs the query so errors are reported before streaming starts
+
+        def stream(): # Sends the lines as they are read from the cursor
+            if first_line is not None:
+                yield first_line
+            yield from lines
+
+        file_name = f"{collection}.{export_format}" + (".gz" if compress else "")
+        response = Response( # Chunked response, nothing is built in memory
+            stream_with_context(export_chunks(stream(), compress)),
+            mimetype="application/gzip" if compress else EXPORT_MIMETYPES[export_format]
+        )
+        response.headers["Content-Disposition"] = f"attachment; filename={file_name}"
+        return response
+
+    except ValueError as err: # Handles invalid parameter values
+        return make_response(jsonify({"error": "Invalid parameter value", "message": str(err)}), 400)
+
+    except Exception as err: # Handles unexpected errors
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({"error": "Server error", "message": str(err)}), 500)
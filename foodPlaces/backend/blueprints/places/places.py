@@ -4,23 +4,85 @@
 from flask import Blueprint, request, make_response, jsonify
 import globals # Import globals.py
 from decorators import jwt_required, admin_required
+from projection import parse_fields
+from result_cache import cached, invalidates_cache
+from versions import conditional, new_version, with_version, VERSION_STAGE
+from place_data import geo_point, GEO_FIELD, GEO_POINT_STAGE, SERVICE_FILTERS
+from raw_json import raw_collection, raw_response, page_response
+from bulk import read_bulk_items, write_in_batches
+from city_stats import apply_stats_change, info_changes, place_changes, merge_changes, place_rating_distribution
+from pagination import validate_pagination_params, validate_count_mode, apply_cursor, decode_cursor, keyset_sort, next_page, read_page, total_pages, MAX_STREAMED_PAGE_SIZE
 
 from flask import Flask, request, jsonify, make_response
 from pymongo import MongoClient
 from bson import ObjectId
 from datetime import datetime
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, InsertOne
 import jwt
 import datetime
 from functools import wraps
 import bcrypt
 
 places_bp = Blueprint("places_bp", __name__)
-places = globals.db.foodPlacesDB
+businesses = globals.db.foodPlacesDB # Cities collection
+places = globals.db.places # Places collection, keyed by city_id
+reviews = globals.db.reviews # Reviews collection
+raw_places = raw_collection(places) # Places read as raw BSON, for the routes that only pass them on
 
+DEFAULT_NEAR_RADIUS = 5000 # Search radius in metres when radius is not given
+MAX_NEAR_RADIUS = 50000 # Largest radius a client can ask for
+
+# Fields a client can select with fields=
+PLACE_FIELDS = ['place_id', 'city_id', 'info', 'location', 'business_hours', 'service_options', 'menu_options', 'amenities', 'ratings', 'media']
+
+# Function to build the type, rating and service filters shared by the place listings
+def place_filters(args):
+    match_conditions = [] # Initialize conditions list
+    filters_applied = {} # Track all applied filters
+
+    # Adds place type filter
+    place_type = args.get('type') # Get type parameter
+    if place_type: # If type provided
+        match_conditions.append({ # Add type condition
+            "info.type": place_type # Match place type
+        })
+        filters_applied['type'] = place_type # Track type filter
+
+    # Adds rating filter
+    min_rating = args.get('min_rating') # Get rating parameter
+    if min_rating: # If rating provided
+        try: # Try to convert rating
+            min_rating_float = float(min_rating) # Convert to float
+        except ValueError: # If rating conversion fails
+            raise ValueError("Invalid rating value")
+        match_conditions.append({ # Add rating condition
+            "ratings.average_rating": {
+                "$gte": min_rating_float # Match minimum rating
+            }
+        })
+        filters_applied['min_rating'] = min_rating_float # Track rating filter
+
+    # Processes service filters
+    for category, options in SERVICE_FILTERS.items(): # For each service category
+        category_filters = {} # Track filters for this category
+        for option, path in options.items(): # For each option in category
+            value = args.get(option, '').lower() # Get parameter value
+            if value in ['true', 'false']: # If valid boolean string
+                match_conditions.append({ # Add filter condition
+                    path: value == 'true' # Match boolean value
+                })
+                category_filters[option] = value == 'true' # Track filter value
+
+        if category_filters: # If any filters applied in this category
+            if 'service_options' not in filters_applied: # If first service filter
+                filters_applied['service_options'] = {} # Initialize service options
+            filters_applied['service_options'][category] = category_filters # Track category filters
+
+    return match_conditions, filters_applied
 
 # Gets all food places within a city
 @places_bp.route("/api/cities/<city_id>/places", methods=["GET"]) 
+@cached("places", ttl=30)
 def show_all_places(city_id): # Takes city_id as its parameter
     try: 
         if not ObjectId.is_valid(city_id): # Check if ID format is valid
@@ -29,93 +91,33 @@ def show_all_places(city_id): # Takes city_id as its parameter
         # Gets pagination parameters
         page_num, page_size = validate_pagination_params( # Get and validate pagination
             request.args.get('pn'), # Page number from request
-            request.args.get('ps') # Page size from request
+            request.args.get('ps'), # Page size from request
+            MAX_STREAMED_PAGE_SIZE # Large pages are streamed
         )
-        page_start = (page_size * (page_num - 1)) # Calculate pagination start point
+        cursor = request.args.get('cursor') # Cursor from the previous page, replaces pn
+        page_start = 0 if cursor else (page_size * (page_num - 1)) # Calculate pagination start point
+        count_mode = validate_count_mode(request.args.get('count')) # How total_items is worked out
         
-        # Sets up aggregation pipeline
-        pipeline = [] # Initialize pipeline list
-        pipeline.append({ # Add city matching stage
-            "$match": {"_id": ObjectId(city_id)} # Find specific city
-        })
-        pipeline.append({ # Add places unwinding stage
-            "$unwind": "$places" # Split places array
-        })
+        # Sets up the query, every index on places starts with city_id
+        query = {"city_id": ObjectId(city_id)} # Places of this city
         
         # Adds filters if provided
-        match_conditions = [] # Initialize conditions list
-        filters_applied = {} # Track all applied filters
-        
-        # Adds place type filter
-        place_type = request.args.get('type') # Get type parameter
-        if place_type: # If type provided
-            match_conditions.append({ # Add type condition
-                "places.info.type": place_type # Match place type
-            })
-            filters_applied['type'] = place_type # Track type filter
-            
-        # Adds rating filter
-        min_rating = request.args.get('min_rating') # Get rating parameter
-        if min_rating: # If rating provided
-            try: # Try to convert rating
-                min_rating_float = float(min_rating) # Convert to float
-                match_conditions.append({ # Add rating condition
-                    "places.ratings.average_rating": {
-                        "$gte": min_rating_float # Match minimum rating
-                    }
-                })
-                filters_applied['min_rating'] = min_rating_float # Track rating filter
-            except ValueError: # If rating conversion fails
-                return make_response(jsonify({ # Return error response
-                    "error": "Invalid rating value"
-                }), 400)
-        
-        # Sets up service filters
-        service_filters = { # Define available service options
-            'service_options': {
-                'dining': {
-                    'dine_in': 'service_options.dining.dine_in',
-                    'takeaway': 'service_options.dining.takeaway',
-                    'reservations': 'service_options.dining.reservations',
-                    'outdoor_seating': 'service_options.dining.outdoor_seating',
-                    'group_bookings': 'service_options.dining.group_bookings'
-                },
-                'meals': {
-                    'breakfast': 'service_options.meals.breakfast',
-                    'lunch': 'service_options.meals.lunch',
-                    'dinner': 'service_options.meals.dinner',
-                    'brunch': 'service_options.meals.brunch'
-                }
-            }
-        }
-        
-        # Processes service filters
-        for category, options in service_filters['service_options'].items(): # For each service category
-            category_filters = {} # Track filters for this category
-            for option, path in options.items(): # For each option in category
-                value = request.args.get(option, '').lower() # Get parameter value
-                if value in ['true', 'false']: # If valid boolean string
-                    match_conditions.append({ # Add filter condition
-                        f"places.{path}": value == 'true' # Match boolean value
-                    })
-                    category_filters[option] = value == 'true' # Track filter value
-            
-            if category_filters: # If any filters applied in this category
-                if 'service_options' not in filters_applied: # If first service filter
-                    filters_applied['service_options'] = {} # Initialize service options
-                filters_applied['service_options'][category] = category_filters # Track category filters
+        try: # Try to read the filters
+            match_conditions, filters_applied = place_filters(request.args)
+        except ValueError as err: # If a filter value is invalid
+            return make_response(jsonify({ # Return error response
+                "error": str(err)
+            }), 400)
             
-        # Adds match conditions to pipeline
+        # Adds match conditions to query
         if match_conditions: # If any conditions exist
-            pipeline.append({ # Add filter conditions
-                "$match": {"$and": match_conditions} # Must match all conditions
-            })
+            query["$and"] = match_conditions # Must match all conditions
             
         # Adds sorting stage
         valid_sort_fields = { # Define valid sort fields and their paths
-            'name': 'places.info.name', # Sort by place name
-            'rating': 'places.ratings.average_rating', # Sort by rating
-            'review_count': 'places.ratings.review_count' # Sort by number of reviews
+            'name': 'info.name', # Sort by place name
+            'rating': 'ratings.average_rating', # Sort by rating
+            'review_count': 'ratings.review_count' # Sort by number of reviews
         }
         
         # Gets requested sort field
@@ -125,30 +127,19 @@ def show_all_places(city_id): # Takes city_id as its parameter
         # Gets sort direction
         sort_order = request.args.get('sort_order', 'asc').lower() # Get sort order or default
         sort_direction = -1 if sort_order == 'desc' else 1 # Convert to MongoDB sort value
+        projection = parse_fields(request.args.get('fields'), PLACE_FIELDS, required=[sort_field]) # Sort key is kept for the cursor
         
-        # Adds sort to pipeline
-        pipeline.append({"$sort": {sort_field: sort_direction}})
-        
-        # Adds pagination stages
-        pipeline.append({"$skip": page_start}) # Skip to page start
-        pipeline.append({"$limit": page_size}) # Limit results per page
-        
-        # Executes pipeline
-        results = list(businesses.aggregate(pipeline)) # Run aggregation
-        
-        # Processes results
-        places = [] 
-        for result in results: # For each result
-            if 'places' in result: # If result has places
-                place = result['places'] # Get place data
-                place = convert_objectid_to_str(place) # Convert IDs to strings
-                places.append(place) # Add to places list
-            
-        # Gets total count for pagination
-        count_pipeline = pipeline[:-2] # Remove pagination stages
-        count_pipeline.append({"$count": "total"}) # Add count stage
-        total_count = list(businesses.aggregate(count_pipeline)) # Get total count
-        total_places = total_count[0]['total'] if total_count else 0 # Extract count
+        # Restricts the query to the places after the cursor
+        page_query = apply_cursor(query, cursor, sort_field, sort_direction) if cursor else query
+
+        # Runs the query, the sort is served by the (city_id, sort_field, _id) index
+        places_taken, total_places, next_cursor = read_page( # Indexed page and total, large pages streamed as raw BSON
+            places, raw_places, query, page_query,
+            keyset_sort(sort_field, sort_direction),
+            page_start, page_size,
+            projection=projection,
+            count_mode=count_mode
+        )
         
         # Adds sort to filters_applied
         filters_applied['sort'] = { # Track sort options
@@ -157,17 +148,102 @@ def show_all_places(city_id): # Takes city_id as its parameter
         }
         
         # Returns response
-        return make_response(jsonify({ 
-            'places': places, # List of places
+        return page_response({ 
+            'places': places_taken or [], # List of places
             'pagination': { # Pagination information
                 'current_page': page_num, # Current page number
-                'total_pages': (total_places + page_size - 1) // page_size, # Total pages
+                'total_pages': total_pages(total_places, page_size), # Total pages
                 'page_size': page_size, # Items per page
-                'total_items': total_places # Total items count
+                'total_items': total_places, # Total items count
+                'next': next_cursor # Cursor of the next page, None on the last page
             },
             'filters_applied': filters_applied # All applied filters including sort
+        }, page_size, 200)
+
+    except ValueError as err: # Handles invalid pagination values
+        return make_response(jsonify({"error": "Invalid parameter value", "message": str(err)}), 400)
+
+    except Exception as err:
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({ # Return error response
+            "error": "Server error",
+            "message": str(err)
+        }), 500)
+
+# Gets the food places nearest to a point, across all cities
+@places_bp.route("/api/places/near", methods=["GET"])
+def show_places_near():
+    try:
+        # Validates the point and radius
+        if not request.args.get('lat') or not request.args.get('lon'): # Both coordinates are required
+            return make_response(jsonify({"error": "lat and lon are required"}), 400)
+        point = geo_point({ # Searched point
+            'latitude': float(request.args.get('lat')),
+            'longitude': float(request.args.get('lon'))
+        })
+        if not point: # Outside valid coordinates
+            return make_response(jsonify({"error": "Invalid coordinates"}), 400)
+        radius = float(request.args.get('radius', DEFAULT_NEAR_RADIUS)) # Radius in metres
+        if not 0 < radius <= MAX_NEAR_RADIUS: # Radius must be within limits
+            raise ValueError(f"Radius must be between 0 and {MAX_NEAR_RADIUS} metres")
+
+        # Gets the page size, pages are only reached through the cursor
+        _, page_size = validate_pagination_params(None, request.args.get('ps'))
+        cursor = request.args.get('cursor') # Cursor from the previous page
+        projection = parse_fields(request.args.get('fields'), PLACE_FIELDS, required=['distance']) # Distance is kept for the cursor
+
+        # Adds filters if provided
+        try: # Try to read the filters
+            match_conditions, filters_applied = place_filters(request.args)
+        except ValueError as err: # If a filter value is invalid
+            return make_response(jsonify({ # Return error response
+                "error": str(err)
+            }), 400)
+
+        # Finds places by distance with the 2dsphere index, filters are applied inside $geoNear
+        geo_near = {
+            "near": point,
+            "key": GEO_FIELD,
+            "distanceField": "distance", # Distance in metres
+            "maxDistance": radius,
+            "spherical": True
+        }
+        if match_conditions: # If any conditions exist
+            geo_near["query"] = {"$and": match_conditions}
+        pipeline = [{"$geoNear": geo_near}]
+
+        # Starts after the cursor, sorted by distance with _id as tie-breaker
+        if cursor: # If a cursor is provided
+            geo_near["minDistance"] = decode_cursor(cursor, "distance", ASCENDING)[0] # Skips closer places in the index
+            pipeline.append({"$match": apply_cursor({}, cursor, "distance", ASCENDING)})
+        pipeline.append({"$sort": dict(keyset_sort("distance", ASCENDING))})
+        pipeline.append({"$limit": page_size + 1}) # One extra to find the next page
+        if projection: # Only the requested fields
+            pipeline.append({"$project": projection})
+
+        results, next_cursor = next_page(list(places.aggregate(pipeline)), page_size, "distance", ASCENDING) # Cursor of the next page
+
+        places_taken = results # ObjectIds are encoded by the app's JSON provider
+
+        filters_applied['near'] = { # Track the searched area
+            'lat': point['coordinates'][1],
+            'lon': point['coordinates'][0],
+            'radius': radius
+        }
+
+        # Returns response
+        return make_response(jsonify({
+            'places': places_taken, # List of places, nearest first
+            'pagination': { # Pagination information
+                'page_size': page_size, # Items per page
+                'next': next_cursor # Cursor of the next page, None on the last page
+            },
+            'filters_applied': filters_applied # All applied filters
         }), 200)
 
+    except ValueError as err: # Handles invalid parameter values
+        return make_response(jsonify({"error": "Invalid parameter value", "message": str(err)}), 400)
+
     except Exception as err:
         print(f"Error occurred: {err}") # Log the error
         return make_response(jsonify({ # Return error response
@@ -177,6 +253,8 @@ def show_all_places(city_id): # Takes city_id as its parameter
 
 # Gets a specific food place from a city
 @places_bp.route("/api/cities/<city_id>/places/<place_id>", methods=["GET"]) # Route to get specific place
+@conditional(places, lambda city_id, place_id: {"_id": ObjectId(place_id), "city_id": ObjectId(city_id)})
+@cached("place", ttl=60)
 def show_one_place(city_id, place_id): # Function to show single place details
     try: # Try to handle potential errors
         print(f"Received city_id: {city_id}, place_id: {place_id}") # Debug print to check IDs
@@ -185,40 +263,34 @@ def show_one_place(city_id, place_id): # Function to show single place details
             return make_response(jsonify({ # Return error response
                 "error": "Invalid city ID format"
             }), 404)
-            
-        # Find the city 
-        city = businesses.find_one({ # Find specific city
-            "_id": ObjectId(city_id) # Convert string to ObjectId
-        })
-        
-        if not city: # If city not found
-            return make_response(jsonify({ # Return error response
-                "error": "City not found"
-            }), 200)
 
-        # Find the specific place
-        place = None # Initialize place variable
-        for p in city.get('places', []): # Loop through places
-            if str(p.get('_id')) == place_id: # Compare as strings
-                place = p # Store found place
-                break # Exit loop
+        if not ObjectId.is_valid(place_id): # Check if place ID format is valid
+            return make_response(jsonify({ # Return error response
+                "error": "Place not found"
+            }), 404)
+            
+        # Find the specific place, as raw BSON
+        place = raw_places.find_one({ # Point lookup on the place
+            "_id": ObjectId(place_id), # Convert string to ObjectId
+            "city_id": ObjectId(city_id) # Place must belong to the city
+        }, parse_fields(request.args.get('fields'), PLACE_FIELDS)) # Only the requested fields
                 
-        if not place: # If place not found
+        if place is None: # If place not found
             return make_response(jsonify({ # Return error response
                 "error": "Place not found"
-            }), 200)
-
-        # Convert ObjectIds to strings
-        place = convert_objectid_to_str(place) # Convert IDs in response
+            }), 404) # Kept for NEGATIVE_TTL by the result cache
         
         # Return the place data
-        return make_response(jsonify({ # Create JSON response
-            "data": place, # Place details
+        return raw_response({ # Create JSON response
+            "data": place, # Place details, written from the raw BSON
             "links": { # Add HATEOAS links # Taken
                 "city": f"/api/cities/{city_id}", # Link to parent city
                 "self": f"/api/cities/{city_id}/places/{place_id}" # Link to this place
             }
-        }), 200)
+        }, 200)
+
+    except ValueError as err: # Handles invalid field selections
+        return make_response(jsonify({"error": "Invalid parameter value", "message": str(err)}), 400)
         
     except Exception as err: # Handles unexpected errors
         print(f"Error occurred: {err}") # Log the error
@@ -227,8 +299,117 @@ def show_one_place(city_id, place_id): # Function to show single place details
             "message": str(err)
         }), 500)
     
+# Function to validate a new place and fill in its defaults, used by the single and bulk routes
+# Returns the place document, or None and the error to report
+def prepare_place(place_data, city_id):
+    # Validates required fields
+    required_fields = { # Define required fields and their types
+        'place_id': str,
+        'info': {
+            'name': str,
+            'type': list,
+            'status': str
+        },
+        'location': {
+            'address': {
+                'street': str,
+                'city': str,
+                'postcode': str
+            },
+            'coordinates': {
+                'latitude': float,
+                'longitude': float
+            }
+        }
+    }
+    
+    # Checks if required fields exist
+    if not all(field in place_data for field in required_fields): # Check top-level fields
+        return None, { # Return error if missing fields
+            "error": "Missing required fields",
+            "required": list(required_fields.keys())
+        }
+        
+    # Validates nested structures
+    if 'info' in place_data: # Check info structure
+        if not all(field in place_data['info'] for field in required_fields['info']): # Check info fields
+            return None, { # Return error if missing info fields
+                "error": "Missing required info fields",
+                "required": list(required_fields['info'].keys())
+            }
+            
+    if 'location' in place_data: # Check location structure
+        if not all(field in place_data['location'] for field in ['address', 'coordinates']): # Check location fields
+            return None, { # Return error if missing location fields
+                "error": "Missing required location fields",
+                "required": ['address', 'coordinates']
+            }
+    
+    # Adds the GeoJSON point used by the near search
+    point = geo_point(place_data['location'].get('coordinates', {}))
+    if point: # Only valid coordinates are indexed
+        place_data['location']['geo'] = point
+
+    # Generates new ObjectId for the place
+    place_data['_id'] = ObjectId() # Create new MongoDB ID
+    place_data['city_id'] = ObjectId(city_id) # Reference to the city
+    new_version(place_data) # First version, for conditional GETs
+    
+    # Sets default values if not provided
+    place_data.setdefault('ratings', { # Initialize ratings
+        'average_rating': 0,
+        'review_count': 0,
+        'rating_sum': 0,
+        'recent_reviews': []
+    })
+    
+    place_data.setdefault('service_options', { # Initialize service options
+        'dining': {
+            'dine_in': False,
+            'takeaway': False,
+            'reservations': False,
+            'outdoor_seating': False,
+            'group_bookings': False
+        },
+        'meals': {
+            'breakfast': False,
+            'lunch': False,
+            'dinner': False,
+            'brunch': False
+        }
+    })
+    
+    place_data.setdefault('menu_options', { # Initialize menu options
+        'food': {
+            'vegetarian': False,
+            'kids_menu': False
+        },
+        'drinks': {
+            'coffee': False,
+            'beer': False,
+            'wine': False,
+            'cocktails': False
+        }
+    })
+    
+    place_data.setdefault('amenities', { # Initialize amenities
+        'facilities': {
+            'restrooms': False,
+            'wifi': False,
+            'parking': False
+        },
+        'accessibility': {
+            'wheelchair_access': False,
+            'accessible_restroom': False,
+            'accessible_seating': False
+        }
+    })
+
+    return place_data, None
+
 # Adds a new food place to a city
 @places_bp.route("/api/cities/<city_id>/places", methods=["POST"])
+@invalidates_cache
 #@jwt_required
 def add_new_place(city_id): 
     try: 
@@ -244,117 +425,24 @@ def add_new_place(city_id):
             
         place_data = request.json # Gets JSON data from request
         
-        # Validates required fields
-        required_fields = { # Define required fields and their types
-            'place_id': str,
-            'info': {
-                'name': str,
-                'type': list,
-                'status': str
-            },
-            'location': {
-                'address': {
-                    'street': str,
-                    'city': str,
-                    'postcode': str
-                },
-                'coordinates': {
-                    'latitude': float,
-                    'longitude': float
-                }
-            }
-        }
-        
-        # Checks if required fields exist
-        if not all(field in place_data for field in required_fields): # Check top-level fields
-            return make_response(jsonify({ # Return error if missing fields
-                "error": "Missing required fields",
-                "required": list(required_fields.keys())
-            }), 200)
-            
-        # Validates nested structures
-        if 'info' in place_data: # Check info structure
-            if not all(field in place_data['info'] for field in required_fields['info']): # Check info fields
-                return make_response(jsonify({ # Return error if missing info fields
-                    "error": "Missing required info fields",
-                    "required": list(required_fields['info'].keys())
-                }), 200)
-                
-        if 'location' in place_data: # Check location structure
-            if not all(field in place_data['location'] for field in ['address', 'coordinates']): # Check location fields
-                return make_response(jsonify({ # Return error if missing location fields
-                    "error": "Missing required location fields",
-                    "required": ['address', 'coordinates']
-                }), 200)
-        
-        # Generates new ObjectId for the place
-        place_data['_id'] = ObjectId() # Create new MongoDB ID
-        
-        # Sets default values if not provided
-        place_data.setdefault('ratings', { # Initialize ratings
-            'average_rating': 0,
-            'review_count': 0,
-            'recent_reviews': []
-        })
-        
-        place_data.setdefault('service_options', { # Initialize service options
-            'dining': {
-                'dine_in': False,
-                'takeaway': False,
-                'reservations': False,
-                'outdoor_seating': False,
-                'group_bookings': False
-            },
-            'meals': {
-                'breakfast': False,
-                'lunch': False,
-                'dinner': False,
-                'brunch': False
-            }
-        })
-        
-        place_data.setdefault('menu_options', { # Initialize menu options
-            'food': {
-                'vegetarian': False,
-                'kids_menu': False
-            },
-            'drinks': {
-                'coffee': False,
-                'beer': False,
-                'wine': False,
-                'cocktails': False
-            }
-        })
-        
-        place_data.setdefault('amenities', { # Initialize amenities
-            'facilities': {
-                'restrooms': False,
-                'wifi': False,
-                'parking': False
-            },
-            'accessibility': {
-                'wheelchair_access': False,
-                'accessible_restroom': False,
-                'accessible_seating': False
-            }
-        })
-        
-        # Adds the place to the city
-        result = businesses.update_one( # Update the city document
-            {"_id": ObjectId(city_id)}, # Find city by ID
-            {"$push": {"places": place_data}} # Add new place to array
-        )
-        
-        # Checks if city was found and updated
-        if result.matched_count == 0: # If city not found
+        place_data, error = prepare_place(request.json, city_id) # Validates and fills in defaults
+        if error: # If the place is not valid
+            return make_response(jsonify(error), 200)
+
+        # Checks if city exists
+        if not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1): # If city not found
             return make_response(jsonify({ # Return error response
                 "error": "City not found"
             }), 200)
+
+        # Adds the place to the places collection
+        result = places.insert_one(place_data) # Insert the new place
             
-        if result.modified_count == 0: # If update failed
+        if not result.acknowledged: # If insert failed
             return make_response(jsonify({ # Return error response
                 "error": "Failed to add place"
             }), 500)
+        apply_stats_change(businesses, ObjectId(city_id), place_changes(place_data)) # Counts the place in the city stats
         
         # Returns success response
         return make_response(jsonify({ # Create success response
@@ -369,8 +457,66 @@ def add_new_place(city_id):
             "message": str(err)
         }), 500)
 
+# Adds many food places to a city in one request
+@places_bp.route("/api/cities/<city_id>/places:bulk", methods=["POST"])
+@invalidates_cache
+#@jwt_required
+def add_places_bulk(city_id):
+    try:
+        # Validates city ID format
+        if not ObjectId.is_valid(city_id): # Check if ID format is valid
+            return make_response(jsonify({"error": "Invalid city ID format"}), 400)
+
+        items = read_bulk_items(request) # JSON array or NDJSON, one place per item
+
+        # Checks if city exists, once for the whole request
+        if not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1): # If city not found
+            return make_response(jsonify({"error": "City not found"}), 404)
+
+        # Validates each place with the same rules as add_new_place
+        results = [] # One result per item, in request order
+        operations = [] # (item index, insert) for the valid places
+        new_places = {} # Valid places by item index
+        for index, (place_data, error) in enumerate(items):
+            if not error: # Item is a JSON object
+                place_data, error = prepare_place(place_data, city_id)
+            if error: # Invalid items are reported and skipped
+                results.append({"index": index, "status": "error", "error": error})
+                continue
+            results.append({"index": index, "status": "created", "place_id": str(place_data['_id'])})
+            operations.append((index, InsertOne(place_data)))
+            new_places[index] = place_data
+
+        # Inserts the valid places, failed writes don't stop the others
+        for index, message in write_in_batches(places, operations).items():
+            results[index] = {"index": index, "status": "error", "error": {"error": message}}
+            del new_places[index]
+
+        # Counts the stored places in the city stats once for the whole request
+        if new_places: # If any place was stored
+            apply_stats_change(businesses, ObjectId(city_id), merge_changes(*[place_changes(place) for place in new_places.values()]))
+
+        created = sum(1 for result in results if result["status"] == "created") # Number of places stored
+        return make_response(jsonify({
+            "message": f"{created} of {len(results)} places added",
+            "created": created,
+            "failed": len(results) - created,
+            "results": results # Per item results
+        }), 200)
+
+    except ValueError as err: # Handles unreadable request bodies
+        return make_response(jsonify({"error": "Invalid request body", "message": str(err)}), 400)
+
+    except Exception as err: # Handles unexpected errors
+        print(f"Error occurred: {err}") # Log the error
+        return make_response(jsonify({
+            "error": "Server error",
+            "message": str(err)
+        }), 500)
+
 # Updates a food place in a city
 @places_bp.route("/api/cities/<city_id>/places/<place_id>", methods=["PUT"]) 
+@invalidates_cache
 #@jwt_required
 def update_place(city_id, place_id):
     try: 
@@ -395,7 +541,7 @@ def update_place(city_id, place_id):
         if 'info' in update_data: # If info updates provided
             for field in ['name', 'type', 'status']: # For each info field
                 if field in update_data['info']: # If field provided
-                    update_fields[f"places.$.info.{field}"] = update_data['info'][field]
+                    update_fields[f"info.{field}"] = update_data['info'][field]
                     
         # Updates location if provided
         if 'location' in update_data: # If location updates provided
@@ -403,11 +549,11 @@ def update_place(city_id, place_id):
             if 'address' in location: # If address provided
                 for field in ['street', 'city', 'postcode', 'full_address']: # For each address field
                     if field in location['address']: # If field provided
-                        update_fields[f"places.$.location.address.{field}"] = location['address'][field]
+                        update_fields[f"location.address.{field}"] = location['address'][field]
             if 'coordinates' in location: # If coordinates provided
                 for field in ['latitude', 'longitude']: # For each coordinate
                     if field in location['coordinates']: # If coordinate provided
-                        update_fields[f"places.$.location.coordinates.{field}"] = float(location['coordinates'][field])
+                        update_fields[f"location.coordinates.{field}"] = float(location['coordinates'][field])
                         
         # Updates business hours if provided
         if 'business_hours' in update_data: # If hours updates provided
@@ -415,7 +561,7 @@ def update_place(city_id, place_id):
             for day in ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']: # For each day
                 if day in hours: # If day provided
                     if 'open' in hours[day] and 'close' in hours[day]: # If both times provided
-                        update_fields[f"places.$.business_hours.{day}"] = hours[day]
+                        update_fields[f"business_hours.{day}"] = hours[day]
                         
         # Updates service options if provided
         if 'service_options' in update_data: # If service updates provided
@@ -423,7 +569,7 @@ def update_place(city_id, place_id):
             for category in ['dining', 'meals']: # For each category
                 if category in services: # If category provided
                     for option, value in services[category].items(): # For each option
-                        update_fields[f"places.$.service_options.{category}.{option}"] = bool(value)
+                        update_fields[f"service_options.{category}.{option}"] = bool(value)
                         
         # Updates menu options if provided
         if 'menu_options' in update_data: # If menu updates provided
@@ -431,7 +577,7 @@ def update_place(city_id, place_id):
             for category in ['food', 'drinks']: # For each category
                 if category in menu: # If category provided
                     for option, value in menu[category].items(): # For each option
-                        update_fields[f"places.$.menu_options.{category}.{option}"] = bool(value)
+                        update_fields[f"menu_options.{category}.{option}"] = bool(value)
                         
         # Updates amenities if provided
         if 'amenities' in update_data: # If amenities updates provided
@@ -439,28 +585,52 @@ def update_place(city_id, place_id):
             for category in ['facilities', 'accessibility']: # For each category
                 if category in amenities: # If category provided
                     for option, value in amenities[category].items(): # For each option
-                        update_fields[f"places.$.amenities.{category}.{option}"] = bool(value)
+                        update_fields[f"amenities.{category}.{option}"] = bool(value)
 
         # Checks if any updates were provided
         if not update_fields: # If no valid updates
             return make_response(jsonify({"error": "No valid update fields provided"}), 200)
 
-        # Updates the place
-        result = businesses.update_one( # Update the document
-            {
-                "_id": ObjectId(city_id), # Find city by ID
-                "places._id": ObjectId(place_id) # Find place by ID
-            },
-            {"$set": update_fields} # Update specified fields
+        # Rebuilds the GeoJSON point in the same write when coordinates change, and moves the version
+        update = with_version({"$set": update_fields}) # Update specified fields
+        if any(field.startswith("location.coordinates.") for field in update_fields): # If coordinates changed
+            update = [
+                {"$set": {field: {"$literal": value} for field, value in update_fields.items()}}, # Values taken as is
+                GEO_POINT_STAGE, # Point from the new coordinates
+                VERSION_STAGE
+            ]
+
+        place_query = {
+            "_id": ObjectId(place_id), # Find place by ID
+            "city_id": ObjectId(city_id) # Place must belong to the city
+        }
+
+        # Reads the type and status the update replaces, they are counted in the city stats
+        info_fields = {field: value for field, value in update_fields.items() if field in ("info.type", "info.status")}
+        old_place = places.find_one(place_query, {"info.type": 1, "info.status": 1}) if info_fields else None # Only when the type or status is sent
+
+        # Updates the place, only when a field changes so the version doesn't move on a no-op update
+        result = places.update_one( # Update the document
+            {**place_query, "$expr": {"$or": [ # Exact comparison, as the server decides a write changed nothing
+                {"$ne": [f"${field}", {"$literal": value}]} for field, value in update_fields.items()
+            ]}},
+            update
         )
 
         # Checks if place was found and updated
-        if result.matched_count == 0: # If no document matched
-            return make_response(jsonify({"error": "Place or city not found"}), 404)
-            
-        if result.modified_count == 0: # If no document modified
+        if result.matched_count == 0: # Missing, or already holds the sent values
+            if not places.count_documents(place_query, limit=1): # If no document matched
+                return make_response(jsonify({"error": "Place or city not found"}), 404)
             return make_response(jsonify({"error": "No changes made to place"}), 400)
 
+        # Moves the place to its new type and status in the city stats, and the city to a new version
+        stats_changes = {}
+        if old_place is not None: # If the type or status was sent
+            old_info = old_place.get("info", {})
+            new_info = {**old_info, **{field.split(".")[1]: value for field, value in info_fields.items()}}
+            stats_changes = merge_changes(info_changes(old_info, -1), info_changes(new_info))
+        apply_stats_change(businesses, ObjectId(city_id), stats_changes) # The city shows its places
+
         # Returns success response
         return make_response(jsonify({
             "message": "Place updated successfully",
@@ -477,6 +647,7 @@ def update_place(city_id, place_id):
 
 # Deletes a place from a city
 @places_bp.route("/api/cities/<city_id>/places/<place_id>", methods=["DELETE"]) 
+@invalidates_cache
 #@jwt_required
 #@admin_required
 def delete_place(city_id, place_id):
@@ -487,33 +658,27 @@ def delete_place(city_id, place_id):
         if not ObjectId.is_valid(place_id): # Check if place ID is valid
             return make_response(jsonify({ "error": "Invalid place ID format"}), 200)
         
-        # Checks if city exists first
-        city = businesses.find_one({ # Find the city
-            "_id": ObjectId(city_id) # Using city ID
-        })
-        if not city: # If city not found
-            return make_response(jsonify({"error": "City not found"}), 404)
-            
-        # Checks if place exists in city
-        place_exists = any( # Check places array
-            str(place.get('_id')) == str(ObjectId(place_id)) # Compare place IDs
-            for place in city.get('places', []) # Loop through places
-        )
-        
-        if not place_exists: # If place not found
-            return make_response(jsonify({"error": "Place not found in city"}), 200)
-
-        # Deletes the place
-        result = businesses.update_one( # Update city document
-            {"_id": ObjectId(city_id)}, # Find city by ID
+        # Deletes the place, the deleted version gives what to take off the city stats
+        deleted_place = places.find_one_and_delete( # Delete place document
             {
-                "$pull": { "places": {"_id": ObjectId(place_id)}}
-            } # Match place by I
+                "_id": ObjectId(place_id), # Match place by ID
+                "city_id": ObjectId(city_id) # Place must belong to the city
+            },
+            projection={"info.type": 1, "info.status": 1, "ratings.review_count": 1, "ratings.rating_sum": 1, "ratings.average_rating": 1}
         )
     
         # Checks if operation was successful
-        if result.modified_count == 0: # If no document was modified
-            return make_response(jsonify({"error": "Failed to delete place"}), 500)
+        if deleted_place is None: # If no document was deleted
+            if not businesses.count_documents({"_id": ObjectId(city_id)}, limit=1): # If city not found
+                return make_response(jsonify({"error": "City not found"}), 404)
+            return make_response(jsonify({"error": "Place not found in city"}), 200)
+
+        # Takes the place and its reviews off the city stats
+        distribution = place_rating_distribution(reviews, ObjectId(place_id)) # Stars of the reviews about to be deleted
+        apply_stats_change(businesses, ObjectId(city_id), merge_changes(
+            place_changes(deleted_place, -1), {path: -count for path, count in distribution.items()}
+        ))
+        reviews.delete_many({"place_id": ObjectId(place_id)}) # Delete the reviews of the place
         return make_response(jsonify({"message": "Place deleted successfully"}), 200) # Returns success response
         
     except Exception as err: # Handles unexpected errors
@@ -525,6 +690,7 @@ def delete_place(city_id, place_id):
 
 # Updates place status (open/closed/temporary closed)
 @places_bp.route("/api/cities/<city_id>/places/<place_id>/status", methods=["PATCH"]) # Route to update place status
+@invalidates_cache
 #@jwt_required
 #@admin_required
 def update_place_status(city_id, place_id): # Function to update place status
@@ -561,27 +727,33 @@ def update_place_status(city_id, place_id): # Function to update place status
                 "valid_statuses": valid_statuses
             }), 400)
         
-        # Updates the place status
-        result = businesses.update_one( # Update the document
-            {
-                "_id": ObjectId(city_id), # Find city by ID
-                "places._id": ObjectId(place_id) # Find place by ID
-            },
-            {
-                "$set": {"places.$.info.status": status} # Update status in info object
-            }
+        # Updates the place status, the old version gives the status it replaces
+        place_query = {
+            "_id": ObjectId(place_id), # Find place by ID
+            "city_id": ObjectId(city_id) # Place must belong to the city
+        }
+        old_place = places.find_one_and_update( # Update the document
+            {**place_query, "info.status": {"$ne": status}}, # Same status, nothing written and no new version
+            with_version({
+                "$set": {"info.status": status} # Update status in info object
+            }),
+            projection={"info.status": 1}
         )
         
         # Checks if place was found and updated
-        if result.matched_count == 0: # If no document matched
+        if old_place is None: # If no document matched
+            if places.count_documents(place_query, limit=1): # Place exists, the status was already set
+                return make_response(jsonify({ # Return error response
+                    "error": "Status is already set to " + status
+                }), 400)
             return make_response(jsonify({ # Return error response
                 "error": "Place or city not found"
             }), 404)
             
-        if result.modified_count == 0: # If no document modified
-            return make_response(jsonify({ # Return error response
-                "error": "Status is already set to " + status
-            }), 400)
+        old_status = old_place.get("info", {}).get("status")
+        apply_stats_change(businesses, ObjectId(city_id), merge_changes( # Moves the place to its new status in the city stats
+            info_changes({"status": old_status}, -1), info_changes({"status": status})
+        ))
         
         # Returns success response
         return make_response(jsonify({ # Return success response
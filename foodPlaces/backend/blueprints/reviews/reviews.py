@@ -4,68 +4,150 @@
 from flask import Blueprint, request, make_response, jsonify
 import globals # Import globals.py
 from decorators import jwt_required, admin_required
+from projection import parse_fields
+from result_cache import cached, invalidates_cache
+from bulk import read_bulk_items, write_in_batches
+from city_stats import apply_stats_change, review_changes, merge_changes, reconcile_city_stats
+from versions import VERSION_STAGE, VERSION_UPDATE, with_version
+from place_data import RECENT_REVIEWS_LIMIT, to_recent_review
+from pagination import validate_pagination_params, validate_count_mode, apply_cursor, keyset_sort, next_page, find_page, total_pages
 
 from flask import Flask, request, jsonify, make_response
 from pymongo import MongoClient
 from bson import ObjectId
 from datetime import datetime
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, InsertOne
 import jwt
 import datetime
 from functools import wraps
 import bcrypt
 
 reviews_bp = Blueprint("reviews_bp", __name__)
-places = globals.db.foodPlacesDB
+businesses = globals.db.foodPlacesDB # Cities collection
+places = globals.db.places # Places collection, keyed by city_id
+reviews = globals.db.reviews # Reviews collection, one document per review
+
+# Fields returned for a review, the place and city references are left out
+REVIEW_PROJECTION = {"place_id": 0, "city_id": 0}
+REVIEW_FIELDS = ['review_id', 'rating', 'author_name', 'content', 'date_posted', 'language'] # Fields a client can select with fields=
+
+# Current rating sum of a place, places stored before rating_sum existed fall back to average x count
+RATING_SUM = {"$ifNull": ["$ratings.rating_sum", {"$multiply": [
+    {"$ifNull": ["$ratings.average_rating", 0]},
+    {"$ifNull": ["$ratings.review_count", 0]}
+]}]}
+REVIEW_COUNT = {"$ifNull": ["$ratings.review_count", 0]} # Current review count of a place
+RECENT_REVIEWS = {"$ifNull": ["$ratings.recent_reviews", []]} # Current recent reviews of a place
+
+# Pipeline stage that derives average_rating from rating_sum and review_count
+AVERAGE_RATING_STAGE = {"$set": {"ratings.average_rating": {"$cond": [
+    {"$gt": ["$ratings.review_count", 0]}, # If the place has reviews
+    {"$round": [{"$divide": ["$ratings.rating_sum", "$ratings.review_count"]}, 1]},
+    0 # No reviews
+]}}}
+
+# Applies a change to the ratings of a place in one atomic update
+def apply_rating_change(city_id, place_id, rating_change, count_change, recent_reviews):
+    return places.update_one(
+        {
+            "_id": ObjectId(place_id),
+            "city_id": ObjectId(city_id)
+        },
+        [ # Pipeline update, every field is computed from the stored values
+            {"$set": {
+                "ratings.rating_sum": {"$add": [RATING_SUM, rating_change]},
+                "ratings.review_count": {"$add": [REVIEW_COUNT, count_change]},
+                "ratings.recent_reviews": recent_reviews
+            }},
+            AVERAGE_RATING_STAGE,
+            VERSION_STAGE # The place shows its ratings
+        ]
+    )
+
+# Builds the recent reviews of a place without a deleted review, refilled from the newest reviews read after the delete
+# The stored preview is filtered in the update itself, so reviews added at the same time are kept.
+def recent_reviews_without(review_id, newest_reviews):
+    return {"$let": {
+        "vars": {"kept": {"$filter": {"input": RECENT_REVIEWS, "as": "review", "cond": {"$ne": ["$$review._id", review_id]}}}},
+        "in": {"$slice": [
+            {"$concatArrays": ["$$kept", {"$filter": { # Older reviews fill the freed place
+                "input": {"$literal": newest_reviews},
+                "as": "review",
+                "cond": {"$not": [{"$in": ["$$review._id", {"$map": {"input": "$$kept", "in": "$$this._id"}}]}]}
+            }}]},
+            RECENT_REVIEWS_LIMIT
+        ]}
+    }}
+
+# Calculates the average rating, review count and rating sum of a place from the reviews collection
+def get_rating_summary(place_id):
+    pipeline = [ # Uses the (place_id, rating) index
+        {"$match": {"place_id": ObjectId(place_id)}}, # Reviews of this place only
+        {"$group": {
+            "_id": None,
+            "average": {"$avg": "$rating"}, # Average rating
+            "count": {"$sum": 1}, # Number of reviews
+            "total": {"$sum": "$rating"} # Sum of ratings
+        }}
+    ]
+    result = list(reviews.aggregate(pipeline)) # Run aggregation
+    if not result: # If the place has no reviews
+        return 0, 0, 0
+    return round(result[0]['average'], 1), result[0]['count'], result[0]['total']
+
+# Gets the most recent reviews of a place for the recent_reviews cache
+def get_recent_reviews(place_id):
+    recent = reviews.find( # Uses the (place_id, date_posted) index
+        {"place_id": ObjectId(place_id)},
+        REVIEW_PROJECTION
+    ).sort("date_posted", DESCENDING).limit(RECENT_REVIEWS_LIMIT)
+    return list(recent)
+
+# Rebuilds the ratings of a place (average, count, sum and recent reviews) from the reviews collection
+def refresh_place_ratings(city_id, place_id):
+    average_rating, review_count, rating_sum = get_rating_summary(place_id) # Full recompute
+    result = places.update_one(
+        {
+            "_id": ObjectId(place_id),
+            "city_id": ObjectId(city_id)
+        },
+        with_version({
+            "$set": {
+                "ratings.average_rating": average_rating,
+                "ratings.review_count": review_count,
+                "ratings.rating_sum": rating_sum,
+                "ratings.recent_reviews": get_recent_reviews(place_id)
+            }
+        })
+    )
+    return result, average_rating, review_count
 
 # Gets all reviews for a specific food place
 @reviews_bp.route("/api/cities/<city_id>/places/<place_id>/reviews", methods=["GET"]) 
+@cached("reviews", ttl=30)
 def show_all_reviews(city_id, place_id): 
     try: 
         # Validates IDs format
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
             return make_response(jsonify({ "error": "Invalid city ID format"}), 400)
-            
+
         if not ObjectId.is_valid(place_id): # Check if place ID is valid
-            return make_response(jsonify({"error": "Invalid place ID format"}), 400)
-            
+            return make_response(jsonify({"error": "Invalid place ID format"}), 400)   
+
         # Gets pagination parameters
         page_num, page_size = validate_pagination_params( # Get and validate pagination
             request.args.get('pn'), # Page number from request
             request.args.get('ps') # Page size from request
         )
-        page_start = (page_size * (page_num - 1)) # Calculate pagination start point
-
-        # Sets up aggregation pipeline
-        pipeline = [ # Initialize pipeline stages
-            { # Match the specific city
-                "$match": {
-                    "_id": ObjectId(city_id) # Find by city ID
-                }
-            },
-            { # Unwind places array
-                "$unwind": "$places"
-            },
-            { # Match specific place
-                "$match": {
-                    "places._id": ObjectId(place_id) # Find by place ID
-                }
-            },
-            { # Unwind reviews array
-                "$unwind": "$places.ratings.recent_reviews"
-            },
-            { # Project review fields
-                "$project": {
-                    "review_id": "$places.ratings.recent_reviews.review_id",
-                    "rating": "$places.ratings.recent_reviews.rating",
-                    "author_name": "$places.ratings.recent_reviews.author_name",
-                    "content": "$places.ratings.recent_reviews.content",
-                    "date_posted": "$places.ratings.recent_reviews.date_posted",
-                    "language": "$places.ratings.recent_reviews.language",
-                    "_id": { "$toString": "$places.ratings.recent_reviews._id" }
-                }
-            }
-        ]
+        cursor = request.args.get('cursor') # Cursor from the previous page, replaces pn
+        page_start = 0 if cursor else (page_size * (page_num - 1)) # Calculate pagination start point
+        count_mode = validate_count_mode(request.args.get('count')) # How total_items is worked out
+
+        # Sets up the query, every filter is scoped to the place
+        query = { # Initialize query
+            "city_id": ObjectId(city_id), # Reviews of this city
+            "place_id": ObjectId(place_id) # Reviews of this place
+        }
 
         # Adds rating filter if provided
         min_rating = request.args.get('min_rating') # Get rating parameter
@@ -74,30 +156,19 @@ def show_all_reviews(city_id, place_id):
                 min_rating_value = float(min_rating) # Convert to float
                 if not 0 <= min_rating_value <= 5: # Validate rating range
                     return make_response(jsonify({"error": "Rating must be between 0 and 5"}), 400)
-                pipeline.append({ # Add rating filter
-                    "$match": {
-                        "rating": {"$gte": min_rating_value} # Match minimum rating
-                    }
-                })
+                query["rating"] = {"$gte": min_rating_value} # Match minimum rating
             except ValueError: # If conversion fails
                 return make_response(jsonify({"error": "Invalid rating format"}), 400)
 
         # Adds date filters if provided
         start_date = request.args.get('start_date') # Get start date parameter
-        if start_date: # If start date provided
-            pipeline.append({ # Add start date filter
-                "$match": {
-                    "date_posted": {"$gte": start_date}
-                }
-            })
-
         end_date = request.args.get('end_date') # Get end date parameter
-        if end_date: # If end date provided
-            pipeline.append({ # Add end date filter
-                "$match": {
-                    "date_posted": {"$lte": end_date}
-                }
-            })
+        if start_date or end_date: # If any date provided
+            query["date_posted"] = {} # Initialize date range
+            if start_date: # If start date provided
+                query["date_posted"]["$gte"] = start_date
+            if end_date: # If end date provided
+                query["date_posted"]["$lte"] = end_date
 
         # Adds sorting stage
         valid_sort_fields = ['date_posted', 'rating'] # Define valid sort fields
@@ -107,113 +178,86 @@ def show_all_reviews(city_id, place_id):
 
         sort_order = request.args.get('sort_order', 'desc').lower() # Get sort order or default
         sort_direction = -1 if sort_order == 'desc' else 1 # Convert to MongoDB sort value
+        projection = parse_fields(request.args.get('fields'), REVIEW_FIELDS, required=[sort_field]) # Sort key is kept for the cursor
+
+        # Restricts the query to the reviews after the cursor
+        page_query = apply_cursor(query, cursor, sort_field, sort_direction) if cursor else query
+
+        # Runs the query, the sort is served by the (place_id, sort_field, _id) index
+        reviews_taken, total_reviews = find_page( # Indexed page and total
+            reviews, query, page_query,
+            keyset_sort(sort_field, sort_direction),
+            page_start, page_size,
+            projection=projection or REVIEW_PROJECTION,
+            count_mode=count_mode
+        )
+        reviews_taken, next_cursor = next_page(reviews_taken, page_size, sort_field, sort_direction) # Cursor of the next page
 
-        # Adds sort and pagination
-        pipeline.extend([ # Add final stages
-            {"$sort": {sort_field: sort_direction}}, # Sort reviews
-            {"$skip": page_start}, # Skip to page start
-            {"$limit": page_size} # Limit results
-        ])
-
-        # Executes pipeline
-        reviews = list(businesses.aggregate(pipeline)) # Run aggregation
-        
-        # Gets total count for pagination
-        count_pipeline = pipeline[:-2] # Remove pagination stages
-        count_pipeline.append({"$count": "total"}) # Add count stage
-        total_count = list(businesses.aggregate(count_pipeline)) # Get total count
-        total_reviews = total_count[0]['total'] if total_count else 0 # Extract count
+        data_to_return = reviews_taken # ObjectIds are encoded by the app's JSON provider
 
         # Returns response
         response_data = { # Create response object
-            'reviews': reviews, # List of reviews
+            'reviews': data_to_return, # List of reviews
             'pagination': { # Pagination information
                 'current_page': page_num, # Current page number
-                'total_pages': (total_reviews + page_size - 1) // page_size, # Total pages
+                'total_pages': total_pages(total_reviews, page_size), # Total pages
                 'page_size': page_size, # Items per page
-                'total_items': total_reviews # Total reviews count
+                'total_items': total_reviews, # Total reviews count
+                'next': next_cursor # Cursor of the next page, None on the last page
             },
             'filters_applied': { # Applied filters
                 'min_rating': float(min_rating) if min_rating else None,
-                'start_date': start_date if 'start_date' in locals() else None,
-                'end_date': end_date if 'end_date' in locals() else None,
+                'start_date': start_date,
+                'end_date': end_date,
                 'sort': {
                     'field': sort_field,
                     'direction': sort_order
                 }
             }
         }
-        
+
         # Returns JSON response
         return make_response(jsonify(response_data), 200)
 
+    except ValueError as err: # Handles invalid pagination values
+        return make_response(jsonify({"error": "Invalid parameter value", "message": str(err)}), 400)
+
     except Exception as err: # Handles unexpected errors
         print(f"Error occurred: {err}") # Log the error
         return make_response(jsonify({ # Return error response
             "error": "Server error",
             "message": str(err)
         }), 500)
-    
+
 # Gets a specific review for a food place
 @reviews_bp.route("/api/cities/<city_id>/places/<place_id>/reviews/<review_id>", methods=["GET"]) # Route to get specific review
+@cached("review", ttl=60)
 def show_one_review(city_id, place_id, review_id): # Function to show single review
     try: # Try to handle potential errors
         # Validates IDs format
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
             return make_response(jsonify({"error": "Invalid city ID format"}), 400)
-            
+
         if not ObjectId.is_valid(place_id): # Check if place ID is valid
             return make_response(jsonify({"error": "Invalid place ID format"}), 200)
-            
+
         if not ObjectId.is_valid(review_id): # Check if review ID is valid
             return make_response(jsonify({"error": "Invalid review ID format"}), 200)
 
-        # Sets up aggregation pipeline
-        pipeline = [ # Initialize pipeline stages
-            { # Match the specific city
-                "$match": {
-                    "_id": ObjectId(city_id) # Find by city ID
-                }
-            },
-            { # Unwind places array
-                "$unwind": "$places"
-            },
-            { # Match specific place
-                "$match": {
-                    "places._id": ObjectId(place_id) # Find by place ID
-                }
-            },
-            { # Unwind reviews array
-                "$unwind": "$places.ratings.recent_reviews"
-            },
-            { # Match specific review
-                "$match": {
-                    "places.ratings.recent_reviews._id": ObjectId(review_id) # Find by review ID
-                }
+        # Finds the review by its ID
+        review = reviews.find_one( # Point lookup on _id
+            {
+                "_id": ObjectId(review_id), # Find by review ID
+                "city_id": ObjectId(city_id), # Review must belong to the city
+                "place_id": ObjectId(place_id) # Review must belong to the place
             },
-            { # Project review fields
-                "$project": {
-                    "review_id": "$places.ratings.recent_reviews.review_id",
-                    "rating": "$places.ratings.recent_reviews.rating",
-                    "author_name": "$places.ratings.recent_reviews.author_name",
-                    "content": "$places.ratings.recent_reviews.content",
-                    "date_posted": "$places.ratings.recent_reviews.date_posted",
-                    "language": "$places.ratings.recent_reviews.language",
-                    "_id": { "$toString": "$places.ratings.recent_reviews._id" }
-                }
-            }
-        ]
+            parse_fields(request.args.get('fields'), REVIEW_FIELDS) or REVIEW_PROJECTION # Requested fields, never the references
+        )
 
-        # Executes pipeline
-        result = list(businesses.aggregate(pipeline)) # Run aggregation
-        
         # Checks if review was found
-        if not result: # If no review found
+        if not review: # If no review found
             return make_response(jsonify({"error": "Review not found"}), 404)
 
-        # Gets review data
-        review = result[0] # Get first (and only) result
-        
         # Returns the review
         return make_response(jsonify({ # Create JSON response
             "data": review, # Review details
@@ -224,12 +268,44 @@ def show_one_review(city_id, place_id, review_id): # Function to show single rev
             }
         }), 200)
 
+    except ValueError as err: # Handles invalid field selections
+        return make_response(jsonify({"error": "Invalid parameter value", "message": str(err)}), 400)
+
     except Exception as err: # Handles unexpected errors
         print(f"Error occurred: {err}") # Log the error
         return make_response(jsonify({"error": "Server error","message": str(err)}), 500)
-    
+
+# Validates a new review and builds its document, used by the single and bulk routes
+# Returns the review, or None and the error to report
+def prepare_review(review_data, city_id, place_id):
+    required_fields = ['rating', 'author_name', 'content'] # Required fields
+    for field in required_fields: # Check all fields
+        if field not in review_data:
+            return None, f"Missing required field: {field}"
+
+    try: # Check rating value
+        rating = float(review_data['rating'])
+    except (ValueError, TypeError):
+        return None, "Rating must be a number"
+    if not 1 <= rating <= 5:
+        return None, "Rating must be between 1 and 5"
+
+    new_review = { # Create review object
+        "_id": ObjectId(),
+        "review_id": f"rev_{str(ObjectId())[-6:]}",
+        "city_id": ObjectId(city_id),
+        "place_id": ObjectId(place_id),
+        "rating": rating,
+        "author_name": review_data['author_name'],
+        "content": review_data['content'],
+        "date_posted": datetime.datetime.now(datetime.UTC).isoformat(),
+        "language": review_data.get('language', 'en')
+    }
+    return new_review, None
+
 # Adds a new review
 @reviews_bp.route("/api/cities/<city_id>/places/<place_id>/reviews", methods=["POST"]) # Route to add review
+@invalidates_cache
 #@jwt_required # Requires valid token
 def add_new_review(city_id, place_id): # Function to add review
     try: # Try to handle potential errors
@@ -242,100 +318,38 @@ def add_new_review(city_id, place_id): # Function to add review
             return make_response(jsonify({
                 "error": "Invalid place ID format"
             }), 400)
-            
+
         if not request.is_json: # Check for JSON
             return make_response(jsonify({
                 "error": "Request must be JSON"
             }), 400)
-            
-        review_data = request.json # Get review data
-        
-        required_fields = ['rating', 'author_name', 'content'] # Required fields
-        for field in required_fields: # Check all fields
-            if field not in review_data:
-                return make_response(jsonify({
-                    "error": f"Missing required field: {field}"
-                }), 400)
-                
-        try: # Check rating value
-            rating = float(review_data['rating'])
-            if not 1 <= rating <= 5:
-                return make_response(jsonify({
-                    "error": "Rating must be between 1 and 5"
-                }), 400)
-        except ValueError:
+
+        new_review, error = prepare_review(request.json, city_id, place_id) # Validates and builds the review
+        if error: # If the review is not valid
             return make_response(jsonify({
-                "error": "Rating must be a number"
+                "error": error
             }), 400)
-
-        new_review = { # Create review object
-            "_id": ObjectId(),
-            "review_id": f"rev_{str(ObjectId())[-6:]}",
-            "rating": rating,
-            "author_name": review_data['author_name'],
-            "content": review_data['content'],
-            "date_posted": datetime.datetime.now(datetime.UTC).isoformat(),
-            "language": review_data.get('language', 'en')
-        }
-
-        result = businesses.update_one( # Add review to place
-            {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
-            },
-            {
-                "$push": {
-                    "places.$.ratings.recent_reviews": new_review
-                }
-            }
-        )
+        rating = new_review["rating"]
+
+        reviews.insert_one(new_review) # Stored first, so the place never counts a review that doesn't exist
+        try:
+            result = apply_rating_change( # Count the review, add it to the capped cache and update the average
+                city_id, place_id, rating, 1,
+                {"$slice": [ # Keep only the last N reviews
+                    {"$concatArrays": [{"$literal": [to_recent_review(new_review)]}, RECENT_REVIEWS]}, # Newest first
+                    RECENT_REVIEWS_LIMIT
+                ]}
+            )
+        except Exception:
+            reviews.delete_one({"_id": new_review["_id"]}) # Not counted, so not kept
+            raise
 
         if result.matched_count == 0: # Check if place exists
+            reviews.delete_one({"_id": new_review["_id"]}) # No place to attach it to
             return make_response(jsonify({
                 "error": "City or place not found"
             }), 404)
-            
-        if result.modified_count == 0: # Check if update worked
-            return make_response(jsonify({
-                "error": "Failed to add review"
-            }), 500)
-
-        businesses.update_one( # Update review count
-            {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
-            },
-            {
-                "$inc": {
-                    "places.$.ratings.review_count": 1
-                }
-            }
-        )
-
-        pipeline = [ # Calculate new rating
-            {"$match": {"_id": ObjectId(city_id)}},
-            {"$unwind": "$places"},
-            {"$match": {"places._id": ObjectId(place_id)}},
-            {"$unwind": "$places.ratings.recent_reviews"},
-            {"$group": {
-                "_id": None,
-                "average": {"$avg": "$places.ratings.recent_reviews.rating"}
-            }}
-        ]
-        
-        avg_result = list(businesses.aggregate(pipeline)) # Get new average
-        if avg_result: # Update average rating
-            businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
-                {
-                    "$set": {
-                        "places.$.ratings.average_rating": round(avg_result[0]['average'], 1)
-                    }
-                }
-            )
+        apply_stats_change(businesses, ObjectId(city_id), review_changes(rating), new_review["date_posted"]) # Counts the review in the city stats
 
         return make_response(jsonify({ # Return success
             "message": "Review added successfully",
@@ -352,24 +366,95 @@ def add_new_review(city_id, place_id): # Function to add review
             "message": str(err)
         }), 500)
 
+# Adds many reviews to a food place in one request
+@reviews_bp.route("/api/cities/<city_id>/places/<place_id>/reviews:bulk", methods=["POST"])
+@invalidates_cache
+#@jwt_required # Requires valid token
+def add_reviews_bulk(city_id, place_id):
+    try:
+        if not ObjectId.is_valid(city_id): # Check if city ID is valid
+            return make_response(jsonify({"error": "Invalid city ID format"}), 400)
+
+        if not ObjectId.is_valid(place_id): # Check if place ID is valid
+            return make_response(jsonify({"error": "Invalid place ID format"}), 400)
+
+        items = read_bulk_items(request) # JSON array or NDJSON, one review per item
+
+        # Checks if the place exists, once for the whole request
+        if not places.count_documents({"_id": ObjectId(place_id), "city_id": ObjectId(city_id)}, limit=1):
+            return make_response(jsonify({"error": "City or place not found"}), 404)
+
+        # Validates each review with the same rules as add_new_review
+        results = [] # One result per item, in request order
+        new_reviews = {} # Valid reviews by item index
+        for index, (review_data, error) in enumerate(items):
+            if not error: # Item is a JSON object
+                review_data, error = prepare_review(review_data, city_id, place_id)
+            if error: # Invalid items are reported and skipped
+                results.append({"index": index, "status": "error", "error": error})
+                continue
+            results.append({"index": index, "status": "created", "id": str(review_data['_id']), "review_id": review_data['review_id']})
+            new_reviews[index] = review_data
+
+        # Inserts the valid reviews, failed writes don't stop the others
+        failed = write_in_batches(reviews, [(index, InsertOne(review)) for index, review in new_reviews.items()])
+        for index, message in failed.items():
+            results[index] = {"index": index, "status": "error", "error": message}
+            del new_reviews[index]
+
+        # Updates the ratings of the place once for all stored reviews
+        if new_reviews: # If any review was stored
+            newest_first = [to_recent_review(review) for _, review in sorted(new_reviews.items(), reverse=True)] # Later items are newer
+            apply_rating_change(
+                city_id, place_id,
+                sum(review["rating"] for review in new_reviews.values()), len(new_reviews),
+                {"$slice": [ # Keep only the last N reviews
+                    {"$concatArrays": [{"$literal": newest_first[:RECENT_REVIEWS_LIMIT]}, RECENT_REVIEWS]},
+                    RECENT_REVIEWS_LIMIT
+                ]}
+            )
+            apply_stats_change( # Counts the reviews in the city stats
+                businesses, ObjectId(city_id),
+                merge_changes(*[review_changes(review["rating"]) for review in new_reviews.values()]),
+                max(review["date_posted"] for review in new_reviews.values())
+            )
+
+        return make_response(jsonify({
+            "message": f"{len(new_reviews)} of {len(results)} reviews added",
+            "created": len(new_reviews),
+            "failed": len(results) - len(new_reviews),
+            "results": results # Per item results
+        }), 200)
+
+    except ValueError as err: # Handles unreadable request bodies
+        return make_response(jsonify({"error": "Invalid request body", "message": str(err)}), 400)
+
+    except Exception as err: # Handle any errors
+        print(f"Error occurred: {err}")
+        return make_response(jsonify({
+            "error": "Server error",
+            "message": str(err)
+        }), 500)
+
 @reviews_bp.route("/api/cities/<city_id>/places/<place_id>/reviews/<review_id>", methods=["PUT"]) # Route to update review
+@invalidates_cache
 #@jwt_required # Requires valid token
 def update_review(city_id, place_id, review_id): # Function to update review
     try: # Try to handle potential errors
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
             return make_response(jsonify({"error": "Invalid city ID format"}), 400)
-            
+
         if not ObjectId.is_valid(place_id): # Check if place ID is valid
-            return make_response(jsonify({"error": "Invalid place ID format"}), 400)
-            
+            return make_response(jsonify({"error": "Invalid place ID format"}), 400)   
+
         if not ObjectId.is_valid(review_id): # Check if review ID is valid
             return make_response(jsonify({"error": "Invalid review ID format"}), 400)
-            
+
         if not request.is_json: # Check for JSON data
             return make_response(jsonify({"error": "Request must be JSON"}), 400)
-            
+
         review_data = request.json # Get update data
-        
+
         # Validate required fields
         if 'rating' in review_data: # Validate rating if provided
             try: # Convert rating to float
@@ -378,72 +463,61 @@ def update_review(city_id, place_id, review_id): # Function to update review
                     return make_response(jsonify({"error": "Rating must be between 1 and 5"}), 400)
             except ValueError: # If conversion fails
                 return make_response(jsonify({"error": "Rating must be a number"}), 400)
-        
+
         # Build update fields
         update_fields = {} 
-        
+
         if 'rating' in review_data: # Add rating if provided
-            update_fields['places.$.ratings.recent_reviews.$[review].rating'] = rating
-            
+            update_fields['rating'] = rating
+
         if 'content' in review_data: # Add content if provided
-            update_fields['places.$.ratings.recent_reviews.$[review].content'] = review_data['content']
-            
+            update_fields['content'] = review_data['content']
+
         if 'author_name' in review_data: # Add author if provided
-            update_fields['places.$.ratings.recent_reviews.$[review].author_name'] = review_data['author_name']
-            
+            update_fields['author_name'] = review_data['author_name']
+
         # Update timestamp
-        update_fields['places.$.ratings.recent_reviews.$[review].date_posted'] = \
-            datetime.datetime.now(datetime.UTC).isoformat()
-        
-        # Update the review
-        result = businesses.update_one(
+        update_fields['date_posted'] = datetime.datetime.now(datetime.UTC).isoformat()
+
+        # Update the review, the old version gives the rating it replaces
+        old_review = reviews.find_one_and_update(
             {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
+                "_id": ObjectId(review_id),
+                "city_id": ObjectId(city_id),
+                "place_id": ObjectId(place_id)
             },
             {"$set": update_fields},
-            array_filters=[{"review._id": ObjectId(review_id)}]
+            projection={"rating": 1},
+            return_document=ReturnDocument.BEFORE
         )
-        
-        if result.matched_count == 0: # Check if found
-            return make_response(jsonify({
-                "error": "City or place not found"
-            }), 404)
-            
-        if result.modified_count == 0: # Check if updated
+
+        if old_review is None: # Check if found
             return make_response(jsonify({
-                "error": "Review not found or no changes made"
+                "error": "Review not found"
             }), 404)
-            
-        # Update average rating if rating changed
-        if 'rating' in review_data: # Recalculate if rating changed
-            pipeline = [ # Calculate new rating
-                {"$match": {"_id": ObjectId(city_id)}},
-                {"$unwind": "$places"},
-                {"$match": {"places._id": ObjectId(place_id)}},
-                {"$unwind": "$places.ratings.recent_reviews"},
-                {"$group": {
-                    "_id": None,
-                    "average": {"$avg": "$places.ratings.recent_reviews.rating"}
-                }}
-            ]
-            
-            avg_result = list(businesses.aggregate(pipeline)) # Get new average
-            if avg_result: # Update average rating
-                businesses.update_one(
-                    {
-                        "_id": ObjectId(city_id),
-                        "places._id": ObjectId(place_id)
-                    },
-                    {
-                        "$set": {
-                            "places.$.ratings.average_rating": round(avg_result[0]['average'], 1)
-                        }
-                    }
-                )
-            
+
+        # Adjust the rating sum and the cached copy in one update
+        rating_change = rating - old_review['rating'] if 'rating' in review_data else 0 # Difference in rating
+        apply_rating_change(
+            city_id, place_id, rating_change, 0,
+            {"$map": { # Update the cached copy if the review is one of the recent reviews
+                "input": RECENT_REVIEWS,
+                "as": "review",
+                "in": {"$cond": [
+                    {"$eq": ["$$review._id", ObjectId(review_id)]},
+                    {"$mergeObjects": ["$$review", {"$literal": update_fields}]},
+                    "$$review"
+                ]}
+            }}
+        )
+        apply_stats_change( # Moves the review to its new rating in the city stats, it was posted again just now
+            businesses, ObjectId(city_id),
+            merge_changes(review_changes(old_review['rating'], -1), review_changes(update_fields.get('rating', old_review['rating']))),
+            update_fields['date_posted']
+        )
+
         return make_response(jsonify({"message": "Review updated successfully"}), 200)
-        
+
     except Exception as err: # Handle any errors
         print(f"Error occurred: {err}")
         return make_response(jsonify({
@@ -453,6 +527,7 @@ def update_review(city_id, place_id, review_id): # Function to update review
 
 # Deletes a review from a food place
 @reviews_bp.route("/api/cities/<city_id>/places/<place_id>/reviews/<review_id>", methods=["DELETE"]) # Route to delete review
+@invalidates_cache
 #@jwt_required # Requires valid token
 #@admin_required # Requires admin privileges
 def delete_review(city_id, place_id, review_id): # Function to delete review
@@ -463,81 +538,33 @@ def delete_review(city_id, place_id, review_id): # Function to delete review
             return make_response(jsonify({"error": "Invalid place ID format"}), 400)   
         if not ObjectId.is_valid(review_id): # Check if review ID is valid
             return make_response(jsonify({"error": "Invalid review ID format"}), 400)
-            
-        # Remove the review
-        result = businesses.update_one(
+
+        # Remove the review, the deleted version gives the rating to take off
+        deleted_review = reviews.find_one_and_delete(
             {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
+                "_id": ObjectId(review_id),
+                "city_id": ObjectId(city_id),
+                "place_id": ObjectId(place_id)
             },
-            {
-                "$pull": {
-                    "places.$.ratings.recent_reviews": {
-                        "_id": ObjectId(review_id)
-                    }
-                }
-            }
+            projection={"rating": 1}
         )
-        
-        if result.matched_count == 0: # Check if place exists
-            return make_response(jsonify({"error": "City or place not found"}), 404)
-        if result.modified_count == 0: # Check if review was deleted
+
+        if deleted_review is None: # Check if review was deleted
             return make_response(jsonify({"error": "Review not found"  }), 404)
-            
-        # Update review count
-        businesses.update_one(
-            {
-                "_id": ObjectId(city_id),
-                "places._id": ObjectId(place_id)
-            },
-            {
-                "$inc": {
-                    "places.$.ratings.review_count": -1
-                }
-            }
+
+        # Update count, sum and average and take the review out of the recent reviews cache in one update
+        update_result = apply_rating_change(
+            city_id, place_id, -deleted_review['rating'], -1,
+            recent_reviews_without(deleted_review['_id'], get_recent_reviews(place_id)) # Refilled from a bounded read of the newest N reviews
         )
-        
-        # Recalculate average rating
-        pipeline = [ # Calculate new rating
-            {"$match": {"_id": ObjectId(city_id)}},
-            {"$unwind": "$places"},
-            {"$match": {"places._id": ObjectId(place_id)}},
-            {"$unwind": "$places.ratings.recent_reviews"},
-            {"$group": {
-                "_id": None,
-                "average": {"$avg": "$places.ratings.recent_reviews.rating"}
-            }}
-        ]
-        
-        avg_result = list(businesses.aggregate(pipeline)) # Get new average
-        if avg_result: # Update average rating
-            businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
-                {
-                    "$set": {
-                        "places.$.ratings.average_rating": round(avg_result[0]['average'], 1)
-                    }
-                }
-            )
-        else: # If no reviews left
-            businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
-                {
-                    "$set": {
-                        "places.$.ratings.average_rating": 0
-                    }
-                }
-            )  
+        if update_result.matched_count == 0: # Check if place exists
+            return make_response(jsonify({"error": "City or place not found"}), 404)
+        apply_stats_change(businesses, ObjectId(city_id), review_changes(deleted_review['rating'], -1)) # Takes the review off the city stats
+
         return make_response(jsonify({ # Return success
             "message": "Review deleted successfully"
         }), 200)
-        
+
     except Exception as err: # Handle any errors
         print(f"Error occurred: {err}")
         return make_response(jsonify({
@@ -547,77 +574,35 @@ def delete_review(city_id, place_id, review_id): # Function to delete review
 
 # Update place rating
 @reviews_bp.route("/api/cities/<city_id>/places/<place_id>/update-rating", methods=["POST"]) # Route to update rating
+@invalidates_cache
 #@jwt_required # Requires valid token
 def update_place_rating(city_id, place_id): # Function to update place rating
     try: # Try to handle potential errors
         if not ObjectId.is_valid(city_id): # Check if city ID is valid
             return make_response(jsonify({"error": "Invalid city ID format"}), 400)
-            
+
         if not ObjectId.is_valid(place_id): # Check if place ID is valid
-            return make_response(jsonify({"error": "Invalid place ID format"}), 400)
+            return make_response(jsonify({"error": "Invalid place ID format"}), 400)   
 
-        # Calculate new rating
-        pipeline = [ # Aggregation pipeline
-            {"$match": {"_id": ObjectId(city_id)}}, # Match city
-            {"$unwind": "$places"}, # Unwind places
-            {"$match": {"places._id": ObjectId(place_id)}}, # Match place
-            {"$unwind": "$places.ratings.recent_reviews"}, # Unwind reviews
-            {
-                "$group": { # Group and calculate
-                    "_id": "$places._id", # Group by place
-                    "average_rating": {"$avg": "$places.ratings.recent_reviews.rating"}, # Average rating
-                    "review_count": {"$sum": 1} # Count reviews
-                }
-            }
-        ]
+        # Recalculates ratings and the recent reviews cache from the reviews collection
+        update_result, average_rating, review_count = refresh_place_ratings(city_id, place_id)
 
-        result = list(businesses.aggregate(pipeline)) # Run pipeline
-        
-        if result: # If reviews exist
-            # Update place ratings
-            update_result = businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
-                {
-                    "$set": {
-                        "places.$.ratings.average_rating": round(result[0]['average_rating'], 1),
-                        "places.$.ratings.review_count": result[0]['review_count']
-                    }
-                }
-            )
-            
-            if update_result.matched_count == 0: # Check if place exists
-                return make_response(jsonify({"error": "City or place not found"}), 404)
+        if update_result.matched_count == 0: # Check if place exists
+            return make_response(jsonify({"error": "City or place not found"}), 404)
+        if not reconcile_city_stats(globals.db, [ObjectId(city_id)]): # The city totals follow the recalculated place
+            businesses.update_one({"_id": ObjectId(city_id)}, VERSION_UPDATE) # Totals unchanged, the city still shows the place
 
+        if review_count: # If reviews exist
             # Return updated ratings
             return make_response(jsonify({
                 "message": "Rating updated successfully",
                 "ratings": {
-                    "average_rating": round(result[0]['average_rating'], 1),
-                    "review_count": result[0]['review_count']
+                    "average_rating": average_rating,
+                    "review_count": review_count
                 }
             }), 200)
-            
-        else: # If no reviews
-            # Reset ratings to zero
-            update_result = businesses.update_one(
-                {
-                    "_id": ObjectId(city_id),
-                    "places._id": ObjectId(place_id)
-                },
-                {
-                    "$set": {
-                        "places.$.ratings.average_rating": 0,
-                        "places.$.ratings.review_count": 0
-                    }
-                }
-            )
-            
-            if update_result.matched_count == 0: # Check if place exists
-                return make_response(jsonify({"error": "City or place not found"}), 404)
 
+        else: # If no reviews
             # Return reset ratings
             return make_response(jsonify({
                 "message": "Rating reset to zero (no reviews found)",
@@ -626,7 +611,7 @@ def update_place_rating(city_id, place_id): # Function to update place rating
                     "review_count": 0
                 }
             }), 200)
-    
+
     except Exception as err: # Handle any errors
         print(f"Error occurred: {err}")
         return make_response(jsonify({"error": "Server error","message": str(err)}), 500)
\ No newline at end of file
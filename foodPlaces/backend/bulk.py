@@ -0,0 +1,51 @@
+# Helpers shared by the bulk write routes
+#
+# Bulk routes take either a JSON array or an NDJSON body (one JSON object per line,
+# Content-Type application/x-ndjson). Each item is validated on its own, the valid ones
+# are written with unordered bulk_write batches, and the response reports a result per
+# item in the order they were sent, so one bad item never stops the rest.
+
+# Modules
+import json
+from pymongo.errors import BulkWriteError
+
+MAX_BULK_ITEMS = 10000 # Largest number of items in one request
+BULK_BATCH_SIZE = 1000 # Number of writes sent to MongoDB at a time
+NDJSON_TYPES = ['application/x-ndjson', 'application/ndjson', 'application/jsonl'] # Content types read line by line
+
+# Function to read the items of a bulk request as a list of (item, error)
+# A line that is not valid JSON becomes an item with an error, the other lines are kept
+def read_bulk_items(request):
+    if request.mimetype in NDJSON_TYPES: # One JSON document per line
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip(): # Blank lines are skipped
+                continue
+            try:
+                items.append((json.loads(line), None))
+            except ValueError:
+                items.append((None, "Invalid JSON"))
+    else: # JSON array
+        body = request.get_json(silent=True)
+        if not isinstance(body, list):
+            raise ValueError("Request must be a JSON array or NDJSON")
+        items = [(item, None) for item in body]
+
+    if not items: # Nothing to write
+        raise ValueError("Request has no items")
+    if len(items) > MAX_BULK_ITEMS: # Too many items for one request
+        raise ValueError(f"A bulk request can have at most {MAX_BULK_ITEMS} items")
+    return [(item, error or (None if isinstance(item, dict) else "Item must be a JSON object")) for item, error in items]
+
+# Function to run writes as unordered bulk_write batches
+# operations is a list of (item index, write), returns {item index: error message} for failed writes
+def write_in_batches(collection, operations):
+    errors = {}
+    for start in range(0, len(operations), BULK_BATCH_SIZE): # Each batch
+        batch = operations[start:start + BULK_BATCH_SIZE]
+        try:
+            collection.bulk_write([write for _, write in batch], ordered=False) # Failures don't stop the batch
+        except BulkWriteError as err: # Some writes failed, the others were applied
+            for write_error in err.details.get("writeErrors", []):
+                errors[batch[write_error["index"]][0]] = write_error.get("errmsg", "Write failed")
+    return errors
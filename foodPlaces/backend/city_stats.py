@@ -0,0 +1,187 @@
+# Per-city summary kept in the stats field of each city
+#
+# Usage: python city_stats.py [--every SECONDS]
+#
+# stats holds the number of places of the city, their counts by type and by status,
+# the number of reviews, their rating sum and average, how many reviews fall on each
+# star (1 to 5) and when the last review was posted. The place and review routes
+# update it in the same request as their own write, with one pipeline update on the
+# city, so listings can show and sort by it without reading any places.
+#
+# Writes made outside the routes (import_data.py, generate_data.py, the migrations)
+# and concurrent requests can leave the counters off. reconcile_city_stats recomputes
+# them from the places and reviews collections, this script runs it once or every
+# --every seconds.
+
+# Modules
+import argparse
+import time
+from pymongo import UpdateOne
+import globals # Import globals.py
+from versions import VERSION_STAGE, with_version
+
+STATS_FIELD = "stats" # Field of the city document
+RATING_BUCKETS = ["1", "2", "3", "4", "5"] # Keys of rating_distribution
+RECONCILE_BATCH_SIZE = 500 # Cities recomputed at a time
+
+# Function to turn a type or status into a field name, dots and dollars are not allowed in keys
+def stat_key(value):
+    return str(value).replace(".", "_").replace("$", "_") if value else "unknown"
+
+# Function to find the star a rating counts under, 4.5 counts as 4
+def rating_bucket(rating):
+    return str(min(5, max(1, int(rating))))
+
+# Function to build the stats of a city without places
+def empty_stats():
+    return {
+        "place_count": 0,
+        "places_by_type": {},
+        "places_by_status": {},
+        "review_count": 0,
+        "rating_sum": 0,
+        "average_rating": 0,
+        "rating_distribution": {bucket: 0 for bucket in RATING_BUCKETS},
+        "last_review_at": None
+    }
+
+# Function to build the type and status counter changes for a place's info added (sign 1) or removed (sign -1)
+def info_changes(info, sign=1):
+    types = (info or {}).get("type") or []
+    changes = {f"places_by_status.{stat_key((info or {}).get('status'))}": sign}
+    for place_type in set(types if isinstance(types, list) else [types]): # A place counts once under each of its types
+        changes[f"places_by_type.{stat_key(place_type)}"] = sign
+    return changes
+
+# Function to build the counter changes for a place added (sign 1) or removed (sign -1)
+# The review totals come from the place ratings, the distribution of its reviews is added
+# separately because a place does not hold it.
+def place_changes(place, sign=1):
+    ratings = place.get("ratings") or {}
+    review_count = ratings.get("review_count") or 0
+    rating_sum = ratings.get("rating_sum", (ratings.get("average_rating") or 0) * review_count) or 0
+    return merge_changes(info_changes(place.get("info"), sign), {
+        "place_count": sign,
+        "review_count": sign * review_count,
+        "rating_sum": sign * rating_sum
+    })
+
+# Function to build the counter changes for a review added (sign 1) or removed (sign -1)
+def review_changes(rating, sign=1):
+    return {
+        "review_count": sign,
+        "rating_sum": sign * rating,
+        f"rating_distribution.{rating_bucket(rating)}": sign
+    }
+
+# Function to add up several sets of counter changes
+def merge_changes(*all_changes):
+    merged = {}
+    for changes in all_changes:
+        for path, change in changes.items():
+            merged[path] = merged.get(path, 0) + change
+    return merged
+
+# Function to apply counter changes to the stats of a city in one atomic update
+# last_review_at only moves forward, the average is derived from the new totals. The
+# city's version moves even without changes, callers use it when the places shown with
+# the city change.
+def apply_stats_change(cities, city_id, changes, last_review_at=None):
+    counters = {
+        f"{STATS_FIELD}.{path}": {"$add": [{"$ifNull": [f"${STATS_FIELD}.{path}", 0]}, change]}
+        for path, change in changes.items() if change
+    }
+    derived = {f"{STATS_FIELD}.average_rating": {"$cond": [
+        {"$gt": [f"${STATS_FIELD}.review_count", 0]},
+        {"$round": [{"$divide": [f"${STATS_FIELD}.rating_sum", f"${STATS_FIELD}.review_count"]}, 2]},
+        0
+    ]}}
+    if last_review_at:
+        derived[f"{STATS_FIELD}.last_review_at"] = {"$max": [f"${STATS_FIELD}.last_review_at", {"$literal": last_review_at}]}
+    pipeline = ([{"$set": counters}] if counters else []) + [{"$set": derived}, VERSION_STAGE]
+    return cities.update_one({"_id": city_id}, pipeline)
+
+# Function to count the reviews of a place by star, used when the place is removed
+def place_rating_distribution(reviews, place_id):
+    distribution = {}
+    for row in reviews.aggregate([ # Uses the (place_id, rating) index
+        {"$match": {"place_id": place_id}},
+        {"$group": {"_id": "$rating", "count": {"$sum": 1}}}
+    ]):
+        path = f"rating_distribution.{rating_bucket(row['_id'])}"
+        distribution[path] = distribution.get(path, 0) + row["count"]
+    return distribution
+
+# Function to recompute the stats of some cities, or all of them, from the places and reviews collections
+def reconcile_city_stats(db, city_ids=None):
+    if city_ids is None: # Every city
+        city_ids = [city["_id"] for city in db.foodPlacesDB.find({}, {"_id": 1})]
+    reconciled = 0
+    for start in range(0, len(city_ids), RECONCILE_BATCH_SIZE):
+        batch = city_ids[start:start + RECONCILE_BATCH_SIZE]
+        stats = {city_id: empty_stats() for city_id in batch}
+        match = {"$match": {"city_id": {"$in": batch}}} # Uses the city_id prefix of the indexes
+
+        for row in db.places.aggregate([match, {"$group": { # Places, their reviews and rating sums by status
+            "_id": {"city_id": "$city_id", "status": "$info.status"},
+            "count": {"$sum": 1},
+            "review_count": {"$sum": {"$ifNull": ["$ratings.review_count", 0]}},
+            "rating_sum": {"$sum": {"$ifNull": ["$ratings.rating_sum", {"$multiply": [
+                {"$ifNull": ["$ratings.average_rating", 0]}, {"$ifNull": ["$ratings.review_count", 0]}
+            ]}]}}
+        }}]):
+            city = stats[row["_id"]["city_id"]]
+            city["place_count"] += row["count"]
+            by_status, key = city["places_by_status"], stat_key(row["_id"].get("status"))
+            by_status[key] = by_status.get(key, 0) + row["count"] # Missing and empty statuses both count as unknown
+            city["review_count"] += row["review_count"]
+            city["rating_sum"] += row["rating_sum"]
+
+        for row in db.places.aggregate([match, {"$unwind": "$info.type"}, {"$group": { # Places by type
+            "_id": {"city_id": "$city_id", "type": "$info.type"},
+            "count": {"$sum": 1}
+        }}]):
+            by_type = stats[row["_id"]["city_id"]]["places_by_type"]
+            key = stat_key(row["_id"]["type"])
+            by_type[key] = by_type.get(key, 0) + row["count"]
+
+        for row in db.reviews.aggregate([match, {"$group": { # Reviews by rating
+            "_id": {"city_id": "$city_id", "rating": "$rating"},
+            "count": {"$sum": 1},
+            "last_review_at": {"$max": "$date_posted"}
+        }}]):
+            city = stats[row["_id"]["city_id"]]
+            bucket = rating_bucket(row["_id"]["rating"])
+            city["rating_distribution"][bucket] += row["count"]
+            if row["last_review_at"] and (city["last_review_at"] is None or row["last_review_at"] > city["last_review_at"]):
+                city["last_review_at"] = row["last_review_at"]
+
+        current = {city["_id"]: city.get(STATS_FIELD) for city in db.foodPlacesDB.find({"_id": {"$in": batch}}, {STATS_FIELD: 1})}
+        writes = []
+        for city_id, city in stats.items():
+            city["average_rating"] = round(city["rating_sum"] / city["review_count"], 2) if city["review_count"] else 0
+            if current.get(city_id) != city: # Unchanged cities keep their version
+                writes.append(UpdateOne({"_id": city_id}, with_version({"$set": {STATS_FIELD: city}})))
+        if writes:
+            db.foodPlacesDB.bulk_write(writes, ordered=False)
+        reconciled += len(writes)
+    return reconciled # Cities whose stats were off
+
+# Main function to reconcile the city stats once or on a schedule
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the stats of every city")
+    parser.add_argument("--every", type=int, help="Run again every this many seconds")
+    args = parser.parse_args()
+
+    while True:
+        try:
+            print(f"Corrected the stats of {reconcile_city_stats(globals.db)} cities")
+        except Exception as e:
+            print(f"An error occurred: {e}")
+        if not args.every: # Single run
+            break
+        time.sleep(args.every)
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+# Streams a collection out as NDJSON or a JSON array of Extended JSON documents
+#
+# Usage: python export_data.py cities|places|reviews [--format ndjson|json] [--gzip]
+#            [--since 2024-01-01] [--output FILE] [--uri mongodb://127.0.0.1:27017] [--db foodPlacesDB]
+#
+# The same generator backs GET /api/export/<collection>. Documents are read from a
+# cursor in batches of EXPORT_BATCH_SIZE and encoded one at a time, so memory stays
+# flat whatever the size of the collection. The output uses relaxed Extended JSON like
+# mongoexport, so it can be loaded back with import_data.py. --format json writes a
+# JSON array for the asset files, --gzip compresses the stream as it is written.
+
+# Modules
+import argparse
+import datetime
+import os
+import sys
+import zlib
+from bson import ObjectId, json_util
+from pymongo import MongoClient
+
+# Collections that can be exported and their name in foodPlacesDB
+EXPORT_COLLECTIONS = {"cities": "foodPlacesDB", "places": "places", "reviews": "reviews"}
+EXPORT_FORMATS = ["ndjson", "json"] # One document per line, or a JSON array
+EXPORT_BATCH_SIZE = 1000 # Documents fetched per round trip
+
+# Function to build the query of an export, since keeps documents created from that date
+# Documents have no modified date, their _id holds the time they were created
+def export_query(since=None):
+    if not since:
+        return {}
+    try:
+        since_date = datetime.datetime.fromisoformat(since)
+    except ValueError:
+        raise ValueError("Since must be an ISO date such as 2024-01-31")
+    if since_date.tzinfo is None: # Dates without a timezone are taken as UTC
+        since_date = since_date.replace(tzinfo=datetime.timezone.utc)
+    return {"_id": {"$gte": ObjectId.from_datetime(since_date)}}
+
+# Function to encode the documents of a query, yields the output a line at a time
+def export_lines(collection, query, export_format="ndjson"):
+    if export_format not in EXPORT_FORMATS: # Must be a known format
+        raise ValueError(f"Format must be one of: {EXPORT_FORMATS}")
+    cursor = collection.find(query).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE) # Walks the _id index
+    if export_format == "ndjson":
+        for document in cursor:
+            yield json_util.dumps(document) + "\n"
+        return
+
+    separator = "[\n" # Array layout of mongoexport --jsonArray
+    for document in cursor:
+        yield separator + json_util.dumps(document)
+        separator = ",\n"
+    yield "[]\n" if separator == "[\n" else "\n]\n"
+
+# Function to turn the lines into bytes, compressed with gzip when asked
+def export_chunks(lines, compress=False):
+    if not compress:
+        for line in lines:
+            yield line.encode("utf-8")
+        return
+    compressor = zlib.compressobj(wbits=31) # gzip container
+    for line in lines:
+        chunk = compressor.compress(line.encode("utf-8"))
+        if chunk: # zlib buffers small inputs
+            yield chunk
+    yield compressor.flush()
+
+# Main function to run an export from the command line
+def main():
+    parser = argparse.ArgumentParser(description="Export a collection as NDJSON or a JSON array")
+    parser.add_argument("collection", choices=sorted(EXPORT_COLLECTIONS), help="Collection to export")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson", help="Output layout")
+    parser.add_argument("--gzip", action="store_true", help="Compress the output")
+    parser.add_argument("--since", help="Only documents created from this ISO date")
+    parser.add_argument("--output", help="File to write, defaults to standard output")
+    parser.add_argument("--uri", default="mongodb://127.0.0.1:27017", help="MongoDB connection string")
+    parser.add_argument("--db", default="foodPlacesDB", help="Database name")
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    collection = client[args.db][EXPORT_COLLECTIONS[args.collection]]
+    output = None
+    try:
+        query = export_query(args.since) # Checked before any output is written
+        output = open(args.output, "wb") if args.output else sys.stdout.buffer
+        lines = export_lines(collection, query, args.format)
+        for chunk in export_chunks(lines, args.gzip):
+            output.write(chunk)
+        if args.output:
+            output.close()
+    except Exception as e:
+        print(f"An error occurred: {e}", file=sys.stderr)
+        if args.output and output is not None: # Removes the partial file, it would look like a complete export
+            output.close()
+            os.remove(args.output)
+        sys.exit(1) # Lets scripts and cron jobs see the export failed
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
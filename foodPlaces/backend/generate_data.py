@@ -0,0 +1,245 @@
+# Generates a synthetic foodPlaces dataset for load testing
+#
+# Usage: python generate_data.py [--cities 10] [--places-min 50] [--places-max 500]
+#            [--reviews-max 2000] [--zipf 1.1] [--words-min 5] [--words-max 80]
+#            [--seed 1] [--workers 4] [--output DIR | --uri mongodb://127.0.0.1:27017 [--db foodPlacesDB]]
+#            [--batch-size 1000]
+#
+# Cities, places and reviews are generated in the layout the routes use: cities in
+# foodPlacesDB, places in places with a city_id reference, and reviews in reviews with
+# the place ratings and recent_reviews preview worked out from them.
+#
+# Every city is generated from its own random generator seeded with (seed, city number),
+# so the same arguments always give the same data, _ids included, whatever the number
+# of workers. The number of reviews of a place follows a Zipf distribution, so most
+# places have a few reviews and a few places have very many, like real cities.
+#
+# Cities are shared between worker processes. Each worker streams its documents either
+# to NDJSON files in DIR (cities-NN.ndjson, places-NN.ndjson, reviews-NN.ndjson, which
+# import_data.py loads with --schema cities, places and reviews) or straight into
+# MongoDB in batches, so memory stays flat however many reviews are generated.
+
+# Modules
+import argparse
+import bisect
+import datetime
+import itertools
+import os
+import random
+from multiprocessing import Pool
+from bson import ObjectId, json_util
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+from place_data import normalize_city_name, geo_point, to_recent_review, SERVICE_FILTERS, RECENT_REVIEWS_LIMIT
+
+# Towns and the bounding box places are spread over (south, west, north, east)
+TOWNS = {
+    "Coleraine": [55.10653864221481, -6.703013870894064, 55.16083114339611, -6.640640630380869],
+    "Banbridge": [54.32805966474902, -6.29894073802459, 54.36914017698541, -6.238287009221747],
+    "Belfast": [54.556250355557616, -6.028115456708859, 54.641284967038544, -5.81672407568025],
+    "Lisburn": [54.493341788077785, -6.112005038731509, 54.53555188930533, -6.014228381824925],
+    "Ballymena": [54.83568393536063, -6.332311942061101, 54.88626160226742, -6.223396172342375],
+    "Derry": [54.98342225503688, -7.36866298220212, 55.036414352973814, -7.249238544803166],
+    "Newry": [54.15120498618891, -6.380223593570023, 54.20399608371601, -6.301172915614019],
+    "Enniskillen": [54.32563285593699, -7.677972259020914, 54.3681652508206, -7.585746468072241],
+    "Omagh": [54.58310436623075, -7.338966458054591, 54.61803538619165, -7.252314753372047],
+    "Ballymoney": [55.05519711336693, -6.5368047498203925, 55.08479180123714, -6.48359756273462]
+}
+
+PLACE_TYPES = ["restaurant", "cafe", "bar", "pub", "bakery", "takeaway", "fast_food", "bistro"]
+NAME_WORDS = ["The", "Golden", "Olive", "Harbour", "Corner", "Red", "Lantern", "Kitchen", "Table", "Grill", "House", "Garden", "Mill", "Bridge", "Market"]
+STREETS = ["Main Street", "High Street", "Church Lane", "Bridge Street", "Market Square", "Castle Street", "Queen Street", "Mill Road"]
+REVIEW_WORDS = ["great", "food", "service", "friendly", "staff", "lovely", "coffee", "slow", "busy", "cosy", "portion", "price", "tasty", "fresh", "would", "recommend", "again", "atmosphere", "menu", "dessert", "cold", "warm", "clean", "noisy", "quick"]
+AUTHORS = ["Alex", "Sam", "Jordan", "Casey", "Riley", "Morgan", "Taylor", "Jamie", "Quinn", "Avery"]
+LANGUAGES = ["en"] * 8 + ["ga", "pl"] # Mostly English
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+MENU_OPTIONS = {"food": ["vegetarian", "kids_menu"], "drinks": ["coffee", "beer", "wine", "cocktails"]}
+AMENITIES = {"facilities": ["restrooms", "wifi", "parking"], "accessibility": ["wheelchair_access", "accessible_restroom", "accessible_seating"]}
+
+START_DATE = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc) # Oldest generated date
+DATE_RANGE = 7 * 365 * 24 * 3600 # Dates are spread over seven years, in seconds
+
+# Function to build a reproducible ObjectId with its time part set to a date
+def seeded_object_id(rng, date):
+    return ObjectId(int(date.timestamp()).to_bytes(4, "big") + rng.randbytes(8))
+
+# Function to pick a random date
+def random_date(rng):
+    return START_DATE + datetime.timedelta(seconds=rng.randrange(DATE_RANGE))
+
+# Function to build the cumulative weights of a Zipf distribution over 1..size
+def zipf_weights(size, exponent):
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, size + 1)))
+
+# Function to draw from cumulative weights, returns a value from 0 to len(weights) - 1
+def draw(rng, cumulative_weights):
+    return bisect.bisect(cumulative_weights, rng.random() * cumulative_weights[-1])
+
+# Function to build a place and its reviews, reviews are yielded before the place so ratings can be worked out
+def generate_place(rng, city_id, town, box, number, args, review_weights):
+    place_id = seeded_object_id(rng, random_date(rng))
+    latitude = rng.uniform(box[0], box[2])
+    longitude = rng.uniform(box[1], box[3])
+    street = rng.choice(STREETS)
+    postcode = f"BT{rng.randint(1, 99)} {rng.randint(1, 9)}{rng.choice('ABDEFGHJLNPQRSTUWXYZ')}{rng.choice('ABDEFGHJLNPQRSTUWXYZ')}"
+
+    place = {
+        "_id": place_id,
+        "city_id": city_id,
+        "place_id": f"place_{number}",
+        "info": {
+            "name": " ".join(rng.sample(NAME_WORDS, 2)),
+            "type": rng.sample(PLACE_TYPES, rng.randint(1, 2)),
+            "status": "open" if rng.random() < 0.95 else "closed"
+        },
+        "location": {
+            "address": {
+                "street": f"{rng.randint(1, 200)} {street}",
+                "city": town,
+                "postcode": postcode,
+                "full_address": f"{street}, {town}, {postcode}"
+            },
+            "coordinates": {"latitude": latitude, "longitude": longitude}
+        },
+        "business_hours": {
+            day: {"open": f"{rng.randint(7, 11):02d}:00", "close": f"{rng.randint(17, 23):02d}:00"}
+            for day in DAYS if rng.random() < 0.9
+        },
+        "service_options": {
+            category: {option: rng.random() < 0.5 for option in options}
+            for category, options in SERVICE_FILTERS.items()
+        },
+        "menu_options": {category: {option: rng.random() < 0.5 for option in options} for category, options in MENU_OPTIONS.items()},
+        "amenities": {category: {option: rng.random() < 0.5 for option in options} for category, options in AMENITIES.items()},
+        "media": {"photos": []}
+    }
+    point = geo_point(place["location"]["coordinates"]) # Point used by the near search
+    if point:
+        place["location"]["geo"] = point
+
+    review_count = draw(rng, review_weights) # Zipf skewed, 0 reviews is the most common
+    bias = rng.uniform(-1.5, 1.5) # Some places are better liked than others
+    rating_sum, recent = 0, []
+    for _ in range(review_count):
+        date_posted = random_date(rng)
+        review = {
+            "_id": seeded_object_id(rng, date_posted),
+            "review_id": f"rev_{rng.randbytes(3).hex()}",
+            "city_id": city_id,
+            "place_id": place_id,
+            "rating": float(min(5, max(1, round(rng.gauss(3.5 + bias, 1))))),
+            "author_name": f"{rng.choice(AUTHORS)} {rng.randint(1, 9999)}",
+            "content": " ".join(rng.choices(REVIEW_WORDS, k=rng.randint(args.words_min, args.words_max))).capitalize() + ".",
+            "date_posted": date_posted.isoformat(),
+            "language": rng.choice(LANGUAGES)
+        }
+        rating_sum += review["rating"]
+        recent.append(to_recent_review(review))
+        if len(recent) > RECENT_REVIEWS_LIMIT * 2: # Keeps the preview candidates small
+            recent = sorted(recent, key=lambda item: item["date_posted"], reverse=True)[:RECENT_REVIEWS_LIMIT]
+        yield "reviews", review
+
+    place["ratings"] = {
+        "average_rating": round(rating_sum / review_count, 1) if review_count else 0,
+        "review_count": review_count,
+        "rating_sum": rating_sum,
+        "recent_reviews": sorted(recent, key=lambda item: item["date_posted"], reverse=True)[:RECENT_REVIEWS_LIMIT]
+    }
+    yield "places", place
+
+# Function to build a city, its places and their reviews
+def generate_city(number, args, review_weights):
+    rng = random.Random(f"{args.seed}:{number}") # Same city for the same seed whatever the worker
+    town = list(TOWNS)[number % len(TOWNS)]
+    city_name = town if number < len(TOWNS) else f"{town} {number // len(TOWNS) + 1}" # Names stay unique
+    city_id = seeded_object_id(rng, START_DATE)
+    yield "cities", {
+        "_id": city_id,
+        "city_id": f"city_{number}",
+        "city_name": city_name,
+        "city_name_lc": normalize_city_name(city_name)
+    }
+    for place_number in range(rng.randint(args.places_min, args.places_max)):
+        yield from generate_place(rng, city_id, town, TOWNS[town], f"{number}_{place_number}", args, review_weights)
+
+# Class that sends generated documents to NDJSON files or to MongoDB in batches
+class Writer:
+    def __init__(self, args, worker):
+        self.args = args
+        self.batches = {"cities": [], "places": [], "reviews": []} # Documents waiting to be written
+        self.counts = {kind: 0 for kind in self.batches}
+        if args.output: # One file per kind for this worker
+            self.files = {kind: open(os.path.join(args.output, f"{kind}-{worker:02d}.ndjson"), "w") for kind in self.batches}
+        else: # Straight into the database
+            self.db = MongoClient(args.uri)[args.db]
+
+    def write(self, kind, document):
+        self.counts[kind] += 1
+        if self.args.output:
+            self.files[kind].write(json_util.dumps(document) + "\n")
+            return
+        self.batches[kind].append(document)
+        if len(self.batches[kind]) >= self.args.batch_size: # Writes a full batch
+            self.flush(kind)
+
+    def flush(self, kind):
+        if not self.batches[kind]:
+            return
+        collection = self.db["foodPlacesDB" if kind == "cities" else kind]
+        try:
+            collection.insert_many(self.batches[kind], ordered=False)
+        except BulkWriteError as err: # Same seed run again, the documents are already there
+            if any(error["code"] != 11000 for error in err.details["writeErrors"]):
+                raise
+        self.batches[kind] = []
+
+    def close(self):
+        for kind in self.batches:
+            if self.args.output:
+                self.files[kind].close()
+            else:
+                self.flush(kind)
+
+# Function run by each worker process, generates every workers-th city
+def generate_share(task):
+    args, worker = task
+    review_weights = zipf_weights(args.reviews_max + 1, args.zipf) # Draw k means k reviews
+    writer = Writer(args, worker)
+    for number in range(worker, args.cities, args.workers):
+        for kind, document in generate_city(number, args, review_weights):
+            writer.write(kind, document)
+    writer.close()
+    return writer.counts
+
+# Main function to generate the dataset
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic foodPlaces dataset")
+    parser.add_argument("--cities", type=int, default=10, help="Number of cities")
+    parser.add_argument("--places-min", type=int, default=50, help="Fewest places in a city")
+    parser.add_argument("--places-max", type=int, default=500, help="Most places in a city")
+    parser.add_argument("--reviews-max", type=int, default=2000, help="Most reviews of a place")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of the reviews per place, higher is more skewed")
+    parser.add_argument("--words-min", type=int, default=5, help="Fewest words in a review")
+    parser.add_argument("--words-max", type=int, default=80, help="Most words in a review")
+    parser.add_argument("--seed", type=int, default=1, help="Seed, the same seed gives the same data")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--output", help="Directory for NDJSON files, instead of writing to MongoDB")
+    parser.add_argument("--uri", default="mongodb://127.0.0.1:27017", help="MongoDB connection string")
+    parser.add_argument("--db", default="foodPlacesDB", help="Database name")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of documents per insert")
+    args = parser.parse_args()
+
+    try:
+        if args.output:
+            os.makedirs(args.output, exist_ok=True)
+        with Pool(args.workers) as pool: # Cities are shared between the workers
+            counts = pool.map(generate_share, [(args, worker) for worker in range(args.workers)])
+        for kind in ["cities", "places", "reviews"]:
+            print(f"Generated {sum(count[kind] for count in counts)} {kind}")
+        print("Data generated successfully!")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+# Streams a mongoexport or NDJSON file into MongoDB
+#
+# Usage: python import_data.py FILE --schema cities|places|reviews|biz|users|blacklist
+#            [--uri mongodb://127.0.0.1:27017] [--db NAME] [--collection NAME] [--key a,b]
+#            [--batch-size 1000] [--workers 4] [--restart]
+#
+# The file can be a JSON array (mongoexport --jsonArray) or one document per line, and
+# may use Extended JSON such as {"$oid": ...}. Documents are decoded one at a time and
+# written in unordered batches by a pool of writer threads, with at most two batches
+# per writer in memory, so files of any size load with bounded memory.
+#
+# Each document is upserted on a natural key with $setOnInsert, so documents already in
+# the database are left untouched and an import can be replayed safely. After every
+# batch the byte offset reached is saved to FILE.checkpoint, and a crashed import
+# resumes from there when it is started again. --restart ignores the checkpoint.
+# Documents the server rejects, such as a duplicate on a unique index, are reported and
+# skipped, the rest of the batch is still written. In a cities batch the places and
+# reviews of a rejected city go with it. The script exits with status 1 when any
+# document was rejected.
+#
+# Schemas:
+# - cities: nested foodPlaces cities. Each city is stored without its places, the places
+#   go to the places collection keyed on (city_id, place_id) and their embedded reviews
+#   to the reviews collection, the same layout the migrate_*.py scripts produce.
+# - places, reviews: flat documents already in that layout, such as the files written
+#   by generate_data.py, keyed on (city_id, place_id) and _id.
+# - biz, users, blacklist: flat bizDB documents keyed on _id, username and token.
+
+# Modules
+import argparse
+import codecs
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from bson import ObjectId, json_util
+from pymongo import MongoClient, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from place_data import normalize_city_name, geo_point, RECENT_REVIEWS_LIMIT
+
+# Default database, collection and natural key of each schema
+SCHEMAS = {
+    "cities": {"db": "foodPlacesDB", "collection": "foodPlacesDB", "key": ["city_id"]},
+    "places": {"db": "foodPlacesDB", "collection": "places", "key": ["city_id", "place_id"]},
+    "reviews": {"db": "foodPlacesDB", "collection": "reviews", "key": ["_id"]},
+    "biz": {"db": "bizDB", "collection": "biz", "key": ["_id"]},
+    "users": {"db": "bizDB", "collection": "users", "key": ["username"]},
+    "blacklist": {"db": "bizDB", "collection": "blacklist", "key": ["token"]},
+}
+
+PLACE_KEY = ["city_id", "place_id"] # Natural key of the places written by the cities schema
+
+CHUNK_SIZE = 1 << 20 # Bytes read from the file at a time
+MAX_DOCUMENT_SIZE = 64 << 20 # Characters of one document, more means the JSON is broken
+
+# Function to read the documents of a file one at a time, with the byte offset after each
+# A JSON array and whitespace separated documents are read the same way, the array
+# brackets and commas between documents are skipped.
+def read_documents(path, offset=0):
+    decoder = json.JSONDecoder(object_hook=json_util.object_hook) # Extended JSON to BSON types
+    text_decoder = codecs.getincrementaldecoder("utf-8")() # Keeps characters split across chunks
+    with open(path, "rb") as file:
+        file.seek(offset) # Resumes after the last saved document
+        buffer = "" # Text not yet turned into documents, starts at byte offset
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            buffer += text_decoder.decode(chunk, final=not chunk)
+            position = 0 # Where decoding continues in buffer, offset is the byte at this position
+            while True:
+                end = position
+                while end < len(buffer) and (buffer[end].isspace() or buffer[end] in "[,]"): # Separators
+                    end += 1
+                offset += len(buffer[position:end].encode("utf-8"))
+                position = end
+                if position == len(buffer): # Needs more text
+                    break
+                try:
+                    document, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError: # Document continues in the next chunk
+                    if not chunk: # Nothing left to read
+                        raise ValueError(f"Invalid JSON near byte {offset}")
+                    if len(buffer) - position > MAX_DOCUMENT_SIZE: # Too long to be a document, the JSON is broken
+                        raise ValueError(f"Invalid JSON near byte {offset}, no document ends within {MAX_DOCUMENT_SIZE} characters")
+                    break
+                offset += len(buffer[position:end].encode("utf-8")) # Bytes of the document
+                position = end
+                yield document, offset
+            buffer = buffer[position:] # Keeps the unfinished document
+            if not chunk: # End of file
+                return
+
+# Function to build the filter of a document on the natural key, None when a key field is missing
+def key_query(document, key):
+    if not all(field in document for field in key):
+        return None
+    return {field: document[field] for field in key}
+
+# Function to build the idempotent write of a document
+def upsert(document, key):
+    query = key_query(document, key)
+    if query is None: # No natural key, inserted as is
+        return InsertOne(document)
+    return UpdateOne(query, {"$setOnInsert": document}, upsert=True)
+
+# Function to write a batch of flat documents, returns the number of rejected documents
+def write_flat(db, collection_name, key, documents):
+    return len(write_unordered(db[collection_name], [upsert(document, key) for document in documents], f"{collection_name} document"))
+
+# Function to run unordered writes, returns the positions of the writes the server rejected
+# The other writes are still applied, the rejected ones are reported.
+def write_unordered(collection, writes, name):
+    if not writes:
+        return set()
+    try:
+        collection.bulk_write(writes, ordered=False)
+        return set()
+    except BulkWriteError as err:
+        errors = err.details["writeErrors"]
+        for error in errors[:5]: # A few examples, a whole batch often fails the same way
+            print(f"Skipped a {name}: {error['errmsg']}")
+        print(f"Skipped {len(errors)} of {len(writes)} {name} writes")
+        return {error["index"] for error in errors}
+
+# Function to build a hashable value from the natural key of a document
+def key_value(document, key):
+    return json_util.dumps([document.get(field) for field in key])
+
+# Function to find the _id of stored documents, by the key_value of their natural key
+def stored_ids(collection, key, documents):
+    queries = [key_query(document, key) for document in documents]
+    if not queries:
+        return {}
+    return {key_value(row, key): row["_id"] for row in collection.find({"$or": queries}, {field: 1 for field in key})}
+
+# Function to write a batch of nested foodPlaces cities into the cities, places and reviews collections
+# Each collection gets one unordered bulk write per batch. Places of cities that failed
+# to write, and reviews of places that failed to write, are reported and skipped.
+# Returns the number of rejected cities, places and reviews.
+def write_cities(db, collection_name, key, cities):
+    city_writes, city_places = [], [] # Writes for the cities, and the places of each
+    for city in cities:
+        city_places.append(city.pop("places", None) or []) # Places are stored in their own collection
+        if "city_name" in city:
+            city["city_name_lc"] = normalize_city_name(city["city_name"]) # Search name used by the city routes
+        query = key_query(city, key) or {"_id": city.setdefault("_id", ObjectId())}
+        city_writes.append(UpdateOne(query, {"$setOnInsert": city}, upsert=True))
+    failed = write_unordered(db[collection_name], city_writes, "city")
+    rejected = len(failed)
+
+    # Existing cities keep their _id, so the ids are read back on the key each city was written with
+    city_keys = [key if key_query(city, key) else ["_id"] for city in cities]
+    city_ids = {}
+    for lookup_key in {tuple(city_key) for city_key in city_keys}:
+        written = [city for number, city in enumerate(cities) if number not in failed and tuple(city_keys[number]) == lookup_key]
+        city_ids.update(stored_ids(db[collection_name], list(lookup_key), written))
+
+    place_writes, place_reviews = [], {} # Writes for the places, and the embedded reviews of each place key
+    skipped_places = 0
+    for city, city_key, places in zip(cities, city_keys, city_places):
+        city_id = city_ids.get(key_value(city, city_key))
+        if city_id is None: # City wasn't written
+            skipped_places += len(places)
+            continue
+        for place in places:
+            place["city_id"] = city_id # Reference to the city
+            ratings = place.setdefault("ratings", {})
+            embedded_reviews = ratings.get("recent_reviews", [])
+            ratings["recent_reviews"] = sorted(embedded_reviews, key=lambda review: review.get("date_posted", ""), reverse=True)[:RECENT_REVIEWS_LIMIT]
+            ratings.setdefault("rating_sum", ratings.get("average_rating", 0) * ratings.get("review_count", 0))
+            point = geo_point(place.get("location", {}).get("coordinates", {})) # Point used by the near search
+            if point:
+                place["location"]["geo"] = point
+            place_writes.append(upsert(place, PLACE_KEY))
+            if "place_id" in place: # Reviews are only copied for places that can be found again
+                place_reviews[key_value(place, PLACE_KEY)] = (city_id, embedded_reviews)
+    if skipped_places:
+        print(f"Skipped {skipped_places} places of cities that failed to write")
+    rejected += len(write_unordered(db.places, place_writes, "place"))
+
+    # Reviews reference the stored place, which may have been imported before
+    place_ids = stored_ids(db.places, PLACE_KEY, [dict(zip(PLACE_KEY, json_util.loads(value))) for value in place_reviews])
+    review_writes, skipped_reviews = [], 0
+    for place_key, (city_id, embedded_reviews) in place_reviews.items():
+        if place_key not in place_ids: # Place wasn't written
+            skipped_reviews += len(embedded_reviews)
+            continue
+        for review in embedded_reviews:
+            review.update({"city_id": city_id, "place_id": place_ids[place_key]})
+            review_key = ["_id"] if "_id" in review else ["place_id", "review_id"]
+            review_writes.append(upsert(review, review_key))
+    if skipped_reviews:
+        print(f"Skipped {skipped_reviews} reviews of places that failed to write")
+    rejected += len(write_unordered(db.reviews, review_writes, "review"))
+    return rejected
+
+# Function to save how far the import got
+def save_checkpoint(path, offset, imported):
+    with open(path + ".tmp", "w") as file:
+        json.dump({"offset": offset, "imported": imported}, file)
+    os.replace(path + ".tmp", path) # Never leaves a half written checkpoint
+
+# Function to read a saved checkpoint
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return 0, 0
+    with open(path) as file:
+        checkpoint = json.load(file)
+    return checkpoint["offset"], checkpoint["imported"]
+
+# Function to import a file with a pool of writers, returns the number of rejected documents
+def import_file(db, path, schema, collection_name, key, batch_size, workers, restart):
+    write = write_cities if schema == "cities" else write_flat
+    checkpoint_path = path + ".checkpoint"
+    offset, imported = (0, 0) if restart else load_checkpoint(checkpoint_path)
+    if offset:
+        print(f"Resuming after {imported} documents at byte {offset}")
+
+    rejected = 0 # Documents the server refused, over every batch
+    pending = deque() # (future, end offset, size) of the batches in flight, in file order
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def finish_batches(wait):
+            nonlocal imported, rejected
+            while pending and (wait or pending[0][0].done() or len(pending) >= workers * 2):
+                future, end, size = pending.popleft()
+                rejected += future.result() # Raises the error of a failed batch
+                imported += size
+                save_checkpoint(checkpoint_path, end, imported) # Earlier batches are all written
+                print(f"Imported {imported} documents")
+
+        batch = []
+        for document, end in read_documents(path, offset):
+            batch.append(document)
+            if len(batch) >= batch_size: # Hands a full batch to a writer
+                pending.append((pool.submit(write, db, collection_name, key, batch), end, len(batch)))
+                batch = []
+                finish_batches(wait=False)
+        if batch: # Last batch
+            pending.append((pool.submit(write, db, collection_name, key, batch), end, len(batch)))
+        finish_batches(wait=True)
+
+    if os.path.exists(checkpoint_path): # Finished, the next run starts from the beginning
+        os.remove(checkpoint_path)
+    print(f"Imported {imported} documents into {db.name}.{collection_name}")
+    return rejected
+
+# Main function to run the import
+def main():
+    parser = argparse.ArgumentParser(description="Stream a JSON or NDJSON file into MongoDB")
+    parser.add_argument("file", help="mongoexport JSON array or NDJSON file")
+    parser.add_argument("--schema", choices=sorted(SCHEMAS), required=True, help="Layout of the documents")
+    parser.add_argument("--uri", default="mongodb://127.0.0.1:27017", help="MongoDB connection string")
+    parser.add_argument("--db", help="Database name, defaults to the schema database")
+    parser.add_argument("--collection", help="Collection name, defaults to the schema collection")
+    parser.add_argument("--key", help="Comma separated natural key, defaults to the schema key")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of documents per bulk write")
+    parser.add_argument("--workers", type=int, default=4, help="Number of parallel writers")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the beginning")
+    args = parser.parse_args()
+
+    schema = SCHEMAS[args.schema]
+    client = MongoClient(args.uri, maxPoolSize=args.workers + 1) # One connection per writer
+    db = client[args.db or schema["db"]]
+    key = args.key.split(",") if args.key else schema["key"]
+
+    try:
+        rejected = import_file(db, args.file, args.schema, args.collection or schema["collection"], key,
+                               args.batch_size, args.workers, args.restart)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        sys.exit(1) # Lets scripts and cron jobs see the import failed
+    if rejected: # The rest of the file was imported
+        print(f"{rejected} documents were rejected, see the messages above")
+        sys.exit(1)
+    print("Data imported successfully!")
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# Index registry for foodPlacesDB and bizDB
+#
+# Usage: python indexes.py foodPlaces|biz [--uri mongodb://127.0.0.1:27017] [--db NAME] [--dry-run]
+#
+# Every index the apps rely on is declared once in INDEXES. reconcile_indexes compares
+# the declared indexes with the live ones, builds the missing ones and reports indexes
+# that are not declared, never used, or made redundant by a longer index with the
+# same prefix. Nothing is dropped automatically.
+#
+# The foodPlaces backend runs the reconciliation when main_app.py starts and the biz
+# apps do the same in biz/app.py and BE08/edited_app.py, all in a background thread so
+# startup is not held up by index builds.
+
+# Modules
+import argparse
+import threading
+from pymongo import MongoClient, ASCENDING, DESCENDING, GEOSPHERE, TEXT
+
+# Declared indexes per app, then per collection
+# Each index has its keys and optional create_index options such as unique
+INDEXES = {
+    "foodPlaces": {
+        "foodPlacesDB": [ # Cities
+            {"keys": [("city_name_lc", ASCENDING), ("_id", ASCENDING)]}, # Prefix name filter and sort, cursor paging
+            {"keys": [("city_name", TEXT)]}, # match=contains name filter
+            {"keys": [("stats.place_count", ASCENDING), ("_id", ASCENDING)]}, # sort_by=place_count, cursor paging
+            {"keys": [("stats.average_rating", ASCENDING), ("_id", ASCENDING)]}, # sort_by=avg_rating, cursor paging
+        ],
+        "places": [ # _id ends the sorted indexes for cursor paging
+            {"keys": [("city_id", ASCENDING), ("info.name", ASCENDING), ("_id", ASCENDING)]}, # Listing by name
+            {"keys": [("city_id", ASCENDING), ("ratings.average_rating", DESCENDING), ("_id", DESCENDING)]}, # Listing and filtering by rating
+            {"keys": [("city_id", ASCENDING), ("ratings.review_count", DESCENDING), ("_id", DESCENDING)]}, # Listing by number of reviews
+            {"keys": [("city_id", ASCENDING), ("info.type", ASCENDING)]}, # Filtering by type
+            {"keys": [("location.geo", GEOSPHERE)]}, # $geoNear in the places near search
+        ],
+        "reviews": [
+            {"keys": [("place_id", ASCENDING), ("date_posted", DESCENDING), ("_id", DESCENDING)]}, # Listing by date, recent reviews
+            {"keys": [("place_id", ASCENDING), ("rating", ASCENDING), ("_id", ASCENDING)]}, # Rating filters and averages
+            {"keys": [("city_id", ASCENDING)]}, # Deleting the reviews of a city
+        ],
+        "users": [
+            {"keys": [("username", ASCENDING)], "unique": True}, # Login and registration checks
+            {"keys": [("email", ASCENDING)], "unique": True}, # Registration checks
+        ],
+        "blacklist": [
+            {"keys": [("token", ASCENDING)]}, # Checked on every authenticated request
+        ],
+    },
+    "biz": {
+        "biz": [
+            {"keys": [("reviews._id", ASCENDING)]}, # edit_review finds the business by review ID
+            {"keys": [("town", ASCENDING)]}, # Town filters in the BE07 aggregation scripts and the town_stats refresh
+            {"keys": [("location", GEOSPHERE)]}, # $geoNear in BE07/neighbours.py
+        ],
+        "users": [
+            {"keys": [("username", ASCENDING)], "unique": True}, # Login
+        ],
+        "blacklist": [
+            {"keys": [("token", ASCENDING)]}, # Checked on every authenticated request
+        ],
+    },
+}
+
+DEFAULT_DATABASES = {"foodPlaces": "foodPlacesDB", "biz": "bizDB"} # Database used by each app
+
+# Function to turn index keys into a comparable tuple
+def key_tuple(keys):
+    return tuple((field, direction) for field, direction in keys)
+
+# Function to read the keys of a live index as they were declared
+# Text indexes are stored as _fts/_ftsx keys, the indexed fields are in the weights
+def declared_keys_of(info):
+    keys = []
+    for field, direction in info["key"]:
+        if field == "_fts": # Text part, one key per weighted field
+            keys.extend((text_field, TEXT) for text_field in sorted(info.get("weights", {})))
+        elif field != "_ftsx":
+            keys.append((field, direction))
+    return key_tuple(keys)
+
+# Function to read the live indexes of a collection as {keys: (name, options)}
+def live_indexes(collection):
+    live = {}
+    for name, info in collection.index_information().items(): # For each existing index
+        options = {"unique": info.get("unique", False)} # Only options the registry declares
+        live[declared_keys_of(info)] = (name, options)
+    return live
+
+# Function to find indexes whose keys are a prefix of another index on the same collection
+def redundant_indexes(live):
+    redundant = []
+    for keys, (name, options) in live.items():
+        if name == "_id_" or options["unique"]: # The _id index and unique indexes are never redundant
+            continue
+        for other_keys, (other_name, other_options) in live.items():
+            if other_keys != keys and other_keys[:len(keys)] == keys: # Longer index with the same prefix
+                redundant.append((name, other_name))
+                break
+    return redundant
+
+# Function to find indexes that have not been used since the server started
+def unused_indexes(collection):
+    try:
+        stats = collection.aggregate([{"$indexStats": {}}]) # Needs the clusterMonitor role
+        return [row["name"] for row in stats if row["name"] != "_id_" and row["accesses"]["ops"] == 0]
+    except Exception: # Stats are optional, the report skips them
+        return []
+
+# Function to compare declared and live indexes, build the missing ones and report the rest
+def reconcile_indexes(db, app, collections=None, dry_run=False):
+    report = {"created": [], "failed": [], "mismatched": [], "undeclared": [], "redundant": [], "unused": []}
+    for collection_name, declared in INDEXES[app].items(): # For each collection of the app
+        if collections and collection_name not in collections: # Only the requested collections
+            continue
+        collection = db[collection_name]
+        live = live_indexes(collection)
+
+        declared_keys = set() # Keys of all declared indexes
+        for index in declared: # For each declared index
+            keys = key_tuple(index["keys"])
+            declared_keys.add(keys)
+            options = {key: value for key, value in index.items() if key != "keys"} # create_index options
+            if keys in live: # Already exists
+                if live[keys][1]["unique"] != options.get("unique", False): # Exists with other options
+                    report["mismatched"].append(f"{collection_name}.{live[keys][0]}")
+                continue
+            if dry_run: # Only report what would be built
+                report["created"].append(f"{collection_name}: {list(keys)}")
+                continue
+            try:
+                name = collection.create_index(list(keys), **options) # Build the missing index
+                report["created"].append(f"{collection_name}.{name}")
+            except Exception as err: # For example duplicates under a unique index
+                report["failed"].append(f"{collection_name}: {list(keys)} ({err})")
+
+        if report["created"] and not dry_run: # Reads the indexes again with the new ones
+            live = live_indexes(collection)
+        for keys, (name, options) in live.items(): # Live indexes nobody declared
+            if name != "_id_" and keys not in declared_keys:
+                report["undeclared"].append(f"{collection_name}.{name}")
+        for name, covered_by in redundant_indexes(live): # Prefixes of longer indexes
+            report["redundant"].append(f"{collection_name}.{name} (covered by {covered_by})")
+        for name in unused_indexes(collection): # Never used since the server started
+            report["unused"].append(f"{collection_name}.{name}")
+    return report
+
+# Function to print a reconciliation report
+def print_report(app, report):
+    for section, entries in report.items():
+        for entry in entries:
+            print(f"[indexes:{app}] {section}: {entry}")
+
+# Function used by the apps at startup, reconciles in a background thread
+def reconcile_indexes_in_background(db, app):
+    def run():
+        try:
+            print_report(app, reconcile_indexes(db, app))
+        except Exception as err: # Startup continues without the indexes
+            print(f"[indexes:{app}] reconciliation failed: {err}")
+    thread = threading.Thread(target=run, name=f"indexes-{app}", daemon=True)
+    thread.start()
+    return thread
+
+# Main function to reconcile the indexes from the command line
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile the declared MongoDB indexes")
+    parser.add_argument("app", choices=sorted(INDEXES), help="App whose indexes are reconciled")
+    parser.add_argument("--uri", default="mongodb://127.0.0.1:27017", help="MongoDB connection string")
+    parser.add_argument("--db", help="Database name, defaults to the app database")
+    parser.add_argument("--dry-run", action="store_true", help="Report without building indexes")
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    db = client[args.db or DEFAULT_DATABASES[args.app]]
+    print_report(args.app, reconcile_indexes(db, args.app, dry_run=args.dry_run))
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
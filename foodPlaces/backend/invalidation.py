@@ -0,0 +1,187 @@
+# Cache invalidation shared by every worker process
+#
+# Usage: python invalidation.py [--uri mongodb://127.0.0.1:27017/?replicaSet=rs0] [--db NAME]
+#
+# Each gunicorn worker keeps its own in-process caches, so a write served by one
+# worker has to reach the caches of all the others. start_invalidation_watcher runs a
+# background thread per process that follows a change stream on the database and
+# passes an event for every write to the cities, places, reviews, users or blacklist
+# collections to the listeners registered with register_listener:
+#
+#     {"collection": "places", "operation": "update", "id": "<_id>",
+#      "city_id": "<city _id or None>", "place_id": "<place _id or None>"}
+#
+# city_id and place_id are None when the change does not say, such as a deleted place,
+# and listeners should then drop everything that may depend on that collection. An
+# event with collection None asks listeners to drop everything.
+#
+# The resume token of the last event is kept in memory and, with token_path, in a
+# file, so the stream picks up where it stopped after a reconnect or a restart. The app
+# reads token_path from INVALIDATION_TOKEN_PATH and keeps the token in memory only
+# when it is unset. A token the server can't resume from is dropped, and the stream
+# reopens from now after asking listeners to drop everything. Change
+# streams need a replica set; against a standalone server, or while the stream is
+# down, entry_ttl() drops from STREAM_TTL to FALLBACK_TTL so caches expire entries
+# quickly instead of relying on events. A local single-node replica set is enough:
+#
+#     mongod --replSet rs0 --dbpath /tmp/rs0 && mongosh --eval "rs.initiate()"
+#
+# Running this file prints the events as they arrive, which is handy to check a setup.
+
+# Modules
+import argparse
+import os
+import threading
+import time
+from bson import json_util
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError, OperationFailure
+
+WATCHED_COLLECTIONS = ["foodPlacesDB", "places", "reviews", "users", "blacklist"] # Collections cached data comes from
+STREAM_TTL = 300 # Seconds a cache entry may live while events arrive
+FALLBACK_TTL = 5 # Seconds a cache entry may live without events
+RETRY_DELAY = 30 # Seconds between attempts to open the stream
+RESUME_TOKEN_ERRORS = { # Error codes when the stream can't resume from the token
+    260, # InvalidResumeToken
+    280, # ChangeStreamFatalError
+    286 # ChangeStreamHistoryLost, the token is older than the oplog
+}
+TOKEN_SAVE_INTERVAL = 1 # Most seconds between writes of the token file
+
+listeners = [] # Functions called with each event
+streaming = threading.Event() # Set while the change stream is open
+
+# Only the fields the events are built from are sent by the server
+CHANGE_PIPELINE = [
+    {"$match": {"ns.coll": {"$in": WATCHED_COLLECTIONS}}},
+    {"$project": {
+        "operationType": 1, "ns": 1, "documentKey": 1,
+        "fullDocument.city_id": 1, "fullDocument.place_id": 1
+    }}
+]
+
+# Function to register a function called with each invalidation event
+def register_listener(listener):
+    listeners.append(listener)
+
+# Function to pass an event to every listener, a failing listener does not stop the others
+def publish(event):
+    for listener in listeners:
+        try:
+            listener(event)
+        except Exception as e:
+            print(f"Invalidation listener failed: {e}")
+
+# Function to ask every listener to drop everything, used when events may have been missed
+def publish_flush():
+    publish({"collection": None, "operation": "flush", "id": None, "city_id": None, "place_id": None})
+
+# Function to give the lifetime of a new cache entry, short while no events arrive
+def entry_ttl():
+    return STREAM_TTL if streaming.is_set() else FALLBACK_TTL
+
+# Function to build the event of a change
+def change_event(change):
+    collection = change["ns"]["coll"]
+    document_id = change.get("documentKey", {}).get("_id")
+    document = change.get("fullDocument") or {} # Missing for deletes and documents deleted since
+    city_id, place_id = document.get("city_id"), None
+    if collection == "foodPlacesDB": # A city
+        city_id = document_id
+    elif collection == "places": # A place, city_id comes from the document
+        place_id = document_id
+    elif collection == "reviews": # A review, both references come from the document
+        place_id = document.get("place_id")
+    return {
+        "collection": collection,
+        "operation": change["operationType"],
+        "id": str(document_id) if document_id is not None else None,
+        "city_id": str(city_id) if city_id is not None else None,
+        "place_id": str(place_id) if place_id is not None else None
+    }
+
+# Function to save the resume token, written to a temporary file first so it is never left half written
+def save_token(path, token):
+    temporary = f"{path}.{os.getpid()}.tmp" # Workers may share the file
+    with open(temporary, "w") as file:
+        file.write(json_util.dumps(token))
+    os.replace(temporary, path)
+
+# Function to forget the resume token, in memory and on disk
+def drop_token(position, path):
+    position["token"] = None
+    if path and os.path.exists(path):
+        os.remove(path)
+
+# Function to read a saved resume token
+def load_token(path):
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path) as file:
+            return json_util.loads(file.read())
+    except ValueError: # Unreadable file, the stream starts from now
+        return None
+
+# Function to follow the change stream until it fails or is invalidated
+# position holds the resume token of the last event, kept across reconnects
+def follow_changes(db, position, token_path):
+    saved_at = 0 # When the token file was last written
+    with db.watch(CHANGE_PIPELINE, full_document="updateLookup", resume_after=position["token"]) as stream:
+        if not streaming.is_set():
+            streaming.set()
+            print("Cache invalidation stream open")
+        for change in stream:
+            if change["operationType"] == "invalidate": # Database dropped or renamed, the stream can't go on
+                position["token"] = None # Reopened from now
+                publish_flush()
+                return
+            publish(change_event(change))
+            position["token"] = stream.resume_token
+            if token_path and time.monotonic() - saved_at >= TOKEN_SAVE_INTERVAL: # Not on every event under heavy writes
+                save_token(token_path, position["token"])
+                saved_at = time.monotonic()
+
+# Function to keep the change stream open, reopening it after errors
+def watch_changes(db, token_path):
+    position = {"token": load_token(token_path)} # Resumes after the last event of a previous run
+    while True:
+        try:
+            follow_changes(db, position, token_path)
+            continue # Invalidated, reopened straight away
+        except OperationFailure as e:
+            if e.code in RESUME_TOKEN_ERRORS and position["token"] is not None: # Events may have been missed
+                drop_token(position, token_path) # Never retried, a restart doesn't load it again
+                publish_flush()
+                continue
+            print(f"Cache invalidation stream unavailable: {e}")
+        except PyMongoError as e:
+            print(f"Cache invalidation stream unavailable: {e}")
+        if streaming.is_set(): # Entries cached while the stream was open may now go stale
+            streaming.clear()
+            publish_flush()
+        time.sleep(RETRY_DELAY)
+
+# Function to start the watcher thread of this process
+# Call it in each worker, a thread started before gunicorn forks does not run in the workers.
+def start_invalidation_watcher(db, token_path=None):
+    thread = threading.Thread(target=watch_changes, args=(db, token_path), daemon=True, name="cache-invalidation")
+    thread.start()
+    return thread
+
+# Main function to print the events of a database
+def main():
+    parser = argparse.ArgumentParser(description="Print the cache invalidation events of a database")
+    parser.add_argument("--uri", default="mongodb://127.0.0.1:27017/?replicaSet=rs0", help="MongoDB connection string, must be a replica set")
+    parser.add_argument("--db", default="foodPlacesDB", help="Database name")
+    args = parser.parse_args()
+
+    register_listener(print)
+    try:
+        watch_changes(MongoClient(args.uri)[args.db], None)
+    except KeyboardInterrupt:
+        pass
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
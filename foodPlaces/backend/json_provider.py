@@ -0,0 +1,68 @@
+# JSON encoding of the API responses, with the BSON types MongoDB returns
+#
+# BSONJSONProvider is the JSON provider of the app, so jsonify encodes the values the
+# routes get from pymongo while it writes the response, instead of each route copying
+# its documents first to turn their ids into strings:
+#
+#     ObjectId    -> "6650f0c2e1b8a4d2c0a1b2c3"
+#     datetime    -> "2026-10-18T04:40:05.465994+00:00" (stored dates are UTC)
+#     Decimal128  -> "12.50"
+#     Binary      -> base64 string
+#
+# Output is compact, keys keep the order of the documents and text is sent as UTF-8.
+# When the orjson package is installed it writes the responses, otherwise the json
+# module does. Both give the same text.
+
+# Modules
+import base64
+import datetime
+import json
+from bson import ObjectId, Decimal128
+from flask.json.provider import DefaultJSONProvider
+
+try: # Optional, the json module is used without it
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson options matching the json module output: naive dates are UTC, int keys become strings
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+# Function to encode the values the json module and orjson don't know
+def bson_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None: # pymongo returns naive UTC dates
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value.isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal()) # Kept exact, as Decimal is
+    if isinstance(value, bytes): # Binary, and plain bytes
+        return base64.b64encode(value).decode()
+    return DefaultJSONProvider.default(value) # Decimal, UUID, dataclasses
+
+# Function to encode a value as JSON bytes, with orjson when it is installed
+def encode_json(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=bson_default, option=ORJSON_OPTIONS)
+    return json.dumps(value, default=bson_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+# Class that encodes the responses of the app
+class BSONJSONProvider(DefaultJSONProvider):
+    default = staticmethod(bson_default)
+    sort_keys = False # Document order, and no sorting cost
+    ensure_ascii = False # UTF-8, as orjson writes it
+    compact = True # Even in debug mode
+
+    def dumps(self, obj, **kwargs):
+        if not kwargs: # Same text as the responses
+            return encode_json(obj).decode()
+        kwargs.setdefault("separators", (",", ":"))
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        body = encode_json(self._prepare_response_obj(args, kwargs)) + b"\n" # Sent as bytes, not decoded and encoded again
+        return self._app.response_class(body, mimetype=self.mimetype)
@@ -12,13 +12,30 @@ from blueprints.auth.auth import auth_bp
 from blueprints.cities.cities import cities_bp
 from blueprints.places.places import places_bp
 from blueprints.reviews.reviews import reviews_bp
+from blueprints.export.export import export_bp
+from blueprints.cache.cache import cache_bp
+from indexes import reconcile_indexes_in_background
+from invalidation import start_invalidation_watcher
+from microcache import MicroCache
+from json_provider import BSONJSONProvider
+import globals
+import os
 
 app = Flask(__name__)
+app.json = BSONJSONProvider(app) # jsonify encodes ObjectIds and dates itself
 
 app.register_blueprint(auth_bp)
 app.register_blueprint(cities_bp)
 app.register_blueprint(places_bp)
 app.register_blueprint(reviews_bp)
+app.register_blueprint(export_bp)
+app.register_blueprint(cache_bp)
+app.wsgi_app = MicroCache(app.wsgi_app) # Whole GET responses kept compressed for a few seconds
+
+reconcile_indexes_in_background(globals.db, "foodPlaces") # Builds missing indexes without delaying startup
+start_invalidation_watcher( # Keeps the caches of this worker in step with writes from the others
+    globals.db, os.environ.get("INVALIDATION_TOKEN_PATH") # Resume token file, kept in memory when unset
+)
 
 if __name__ == "__main__":
     app.run(debug = True, port = 2000)
\ No newline at end of file
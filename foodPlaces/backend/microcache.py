@@ -0,0 +1,230 @@
+# WSGI micro-cache of whole GET responses, stored compressed
+#
+# MicroCache wraps the Flask WSGI app. A GET under /api/cities or /api/places is kept
+# for a few seconds, keyed on the path, the query string with its arguments sorted and
+# the auth headers, with its body already compressed as gzip (and brotli when the
+# brotli package is installed). A hit picks the encoding from Accept-Encoding and is
+# sent without going through Flask routing, the view, jsonify or compression.
+#
+# Other JSON responses of MIN_COMPRESS_SIZE bytes or more are compressed on the way
+# out. Streamed routes, such as the exports that gzip themselves, are passed through,
+# and so is any response the app sends without a Content-Length, such as the large
+# listing pages written while their cursor is read.
+#
+# A hit whose stored ETag or Last-Modified matches the request's If-None-Match or
+# If-Modified-Since is answered with a 304.
+#
+# Entries are tagged with the city id in their path. A successful write under a city
+# drops the entries of that city and the listings, writes from other workers do the
+# same through the invalidation stream.
+
+# Modules
+import gzip
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode
+from werkzeug.http import is_resource_modified
+from invalidation import register_listener, entry_ttl
+
+try: # Optional, gzip only without it
+    import brotli
+except ImportError:
+    brotli = None
+
+MICRO_CACHE_TTL = 5 # Seconds a response is kept
+MICRO_CACHE_MAX_BYTES = 32 * 1024 * 1024 # Total size of the stored bodies
+MICRO_CACHE_MAX_ENTRY_BYTES = 512 * 1024 # Larger responses are compressed but not kept
+MIN_COMPRESS_SIZE = 1024 # Smaller bodies are sent as they are
+CACHED_PREFIXES = ("/api/cities", "/api/places") # Read routes whose responses are kept
+STREAMED_PREFIXES = ("/api/export",) # Passed through untouched
+AUTH_HEADERS = ("HTTP_AUTHORIZATION", "HTTP_X_ACCESS_TOKEN") # Requests with other credentials get other entries
+LISTING_TAG = "listing" # Entries without a city id in their path
+CITY_PATH = re.compile(r"^/api/cities/([0-9a-fA-F]{24})") # City id in a path
+
+# Function to pick the response encoding a client accepts, brotli first
+def choose_encoding(accept_encoding, available):
+    accepted = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"): # Refused
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ("br", "gzip"):
+        if encoding in available and (encoding in accepted or "*" in accepted):
+            return encoding
+    return "identity"
+
+# Function to compress a body in every encoding available
+def compress_body(body):
+    bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=6)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(body, quality=5)
+    return bodies
+
+# Function to find the tag of a path
+def path_tag(path):
+    match = CITY_PATH.match(path)
+    return "city:" + match.group(1).lower() if match else LISTING_TAG
+
+# Class that wraps a WSGI app with the micro-cache
+class MicroCache:
+    def __init__(self, app, max_bytes=MICRO_CACHE_MAX_BYTES, ttl=MICRO_CACHE_TTL):
+        self.app, self.max_bytes, self.ttl = app, max_bytes, ttl
+        self.entries = OrderedDict() # key -> entry, least recently used first
+        self.size = 0 # Bytes used
+        self.generation = 0 # Moves on every purge
+        self.lock = threading.Lock()
+        register_listener(self.on_invalidation_event)
+
+    def __call__(self, environ, start_response):
+        path, method = environ.get("PATH_INFO", ""), environ["REQUEST_METHOD"]
+        if path.startswith(STREAMED_PREFIXES): # Streams are not buffered
+            return self.app(environ, start_response)
+        if method not in ("GET", "HEAD"):
+            return self.write(environ, start_response, path)
+        if not path.startswith(CACHED_PREFIXES):
+            return self.send(environ, start_response, *self.run(environ))
+
+        key = self.key(environ, path)
+        entry = self.get(key)
+        if entry is not None: # Sent without running the app
+            return self.send_entry(environ, start_response, entry, "HIT")
+
+        generation = self.generation # Data version the response is built from
+        status, headers, body = self.run(environ)
+        if method == "GET" and self.storable(status, headers, body): # HEAD responses have no body to keep
+            entry = {
+                "status": status,
+                "headers": [(name, value) for name, value in headers if name.lower() not in ("content-length", "content-encoding", "x-cache")],
+                "bodies": compress_body(body),
+                "expires": time.monotonic() + min(self.ttl, entry_ttl()),
+                "tag": path_tag(path)
+            }
+            entry["size"] = sum(len(variant) for variant in entry["bodies"].values())
+            self.put(key, entry, generation)
+            return self.send_entry(environ, start_response, entry, "MISS")
+        return self.send(environ, start_response, status, headers, body)
+
+    # Builds the cache key, query arguments are sorted and credentials are hashed
+    def key(self, environ, path):
+        query = urlencode(sorted(parse_qsl(environ.get("QUERY_STRING", ""), keep_blank_values=True)))
+        credentials = "|".join(environ.get(header, "") for header in AUTH_HEADERS)
+        return (path, query, hashlib.sha256(credentials.encode()).hexdigest() if credentials.strip("|") else "")
+
+    # Runs the app and collects its whole response, a streamed response is returned as its iterable
+    def run(self, environ):
+        captured, chunks = {}, []
+        def start_response(status, headers, exc_info=None):
+            captured["status"], captured["headers"] = status, headers
+            return chunks.append # Legacy write callable
+        result = self.app(environ, start_response)
+        if not any(name.lower() == "content-length" for name, _ in captured["headers"]): # Streamed, sent as it comes
+            return captured["status"], captured["headers"], result
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        return captured["status"], captured["headers"], b"".join(chunks)
+
+    # Checks whether a response can be kept
+    def storable(self, status, headers, body):
+        header_names = {name.lower(): value for name, value in headers}
+        return (
+            isinstance(body, bytes) # Not a stream
+            and status.startswith("200")
+            and header_names.get("content-type", "").startswith("application/json")
+            and "set-cookie" not in header_names
+            and "no-store" not in header_names.get("cache-control", "")
+            and "content-encoding" not in header_names
+            and len(body) <= MICRO_CACHE_MAX_ENTRY_BYTES
+        )
+
+    # Sends an uncached response, compressing large JSON bodies
+    def send(self, environ, start_response, status, headers, body):
+        if not isinstance(body, bytes): # A stream, passed on untouched
+            start_response(status, headers)
+            return body
+        header_names = {name.lower(): value for name, value in headers}
+        if (len(body) >= MIN_COMPRESS_SIZE and header_names.get("content-type", "").startswith("application/json")
+                and "content-encoding" not in header_names):
+            encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""), ("br", "gzip") if brotli else ("gzip",))
+            if encoding != "identity":
+                body = brotli.compress(body, quality=5) if encoding == "br" else gzip.compress(body, compresslevel=6)
+                headers = [(name, value) for name, value in headers if name.lower() != "content-length"]
+                headers += [("Content-Encoding", encoding), ("Content-Length", str(len(body))), ("Vary", "Accept-Encoding")]
+        start_response(status, headers)
+        return [] if environ["REQUEST_METHOD"] == "HEAD" else [body]
+
+    # Sends a stored response in the encoding the client accepts, or a 304 when the client has it
+    def send_entry(self, environ, start_response, entry, state):
+        validators = {name.lower(): value for name, value in entry["headers"] if name.lower() in ("etag", "last-modified")}
+        if validators and not is_resource_modified(environ, etag=validators.get("etag"), last_modified=validators.get("last-modified")):
+            start_response("304 NOT MODIFIED", [(name, value) for name, value in entry["headers"] if name.lower() in ("etag", "last-modified")]
+                           + [("Vary", "Accept-Encoding"), ("X-Micro-Cache", state)])
+            return []
+        encoding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""), entry["bodies"])
+        body = entry["bodies"][encoding]
+        headers = list(entry["headers"]) + [("Content-Length", str(len(body))), ("Vary", "Accept-Encoding"), ("X-Micro-Cache", state)]
+        if encoding != "identity":
+            headers.append(("Content-Encoding", encoding))
+        start_response(entry["status"], headers)
+        return [] if environ["REQUEST_METHOD"] == "HEAD" else [body]
+
+    # Runs a write and drops the entries it may change
+    def write(self, environ, start_response, path):
+        status, headers, body = self.run(environ)
+        if path.startswith(CACHED_PREFIXES) and int(status.split()[0]) < 400:
+            self.purge(path_tag(path))
+        return self.send(environ, start_response, status, headers, body)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry["expires"] <= time.monotonic(): # Too old
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key) # Most recently used
+            return entry
+
+    def put(self, key, entry, generation):
+        with self.lock:
+            if generation != self.generation: # Data changed while the response was built
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            self.size += entry["size"]
+            while self.size > self.max_bytes: # Evicts the least recently used entries
+                self.remove(next(iter(self.entries)))
+
+    # Removes an entry, called with the lock held
+    def remove(self, key):
+        self.size -= self.entries.pop(key)["size"]
+
+    # Drops the entries of a city tag and the listings, which show city stats
+    def purge(self, tag):
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, entry in self.entries.items() if entry["tag"] in (tag, LISTING_TAG)]:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    # Handles an event of the invalidation stream, for writes made by any worker
+    def on_invalidation_event(self, event):
+        if event["collection"] == "users": # Not in any cached response
+            return
+        if event["city_id"]:
+            self.purge("city:" + event["city_id"].lower())
+        else: # Flush, a revoked token, or a delete that doesn't say which city it was in
+            self.clear()
@@ -0,0 +1,39 @@
+# Adds the lower-case city_name_lc field used to search and sort cities by name
+#
+# Usage: python migrate_city_names.py
+#
+# New and renamed cities get city_name_lc from the city routes, this fills it in for
+# cities created before the field existed and builds the city name indexes.
+# The migration can be run again safely, it only touches cities without the field.
+
+# Modules
+import globals # Import globals.py
+from indexes import reconcile_indexes, print_report
+
+businesses = globals.db.foodPlacesDB # Cities collection
+
+# Function to create the indexes declared for the cities collection in indexes.py
+def create_city_indexes():
+    print_report("foodPlaces", reconcile_indexes(globals.db, "foodPlaces", collections=["foodPlacesDB"]))
+    print("Created indexes on the cities collection")
+
+# Function to fill in city_name_lc, same normalization as normalize_city_name in the city routes
+def add_city_name_lc():
+    result = businesses.update_many(
+        {"city_name_lc": {"$exists": False}, "city_name": {"$type": "string"}}, # Cities without the field
+        [{"$set": {"city_name_lc": {"$toLower": {"$trim": {"input": "$city_name"}}}}}] # Computed on the server
+    )
+    print(f"Added city_name_lc to {result.modified_count} cities")
+
+# Main function to run the migration
+def main():
+    try:
+        add_city_name_lc()
+        create_city_indexes()
+        print("City names migrated successfully!")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# Adds a GeoJSON point to every place so places can be searched by distance
+#
+# Usage: python migrate_place_locations.py
+#
+# Places store their position as location.coordinates.latitude/longitude, which a
+# 2dsphere index can't use. This copies them into location.geo as a GeoJSON Point,
+# the same way the place routes do on every write, and builds the 2dsphere index.
+# Places with missing or out of range coordinates are left without a point.
+# The migration can be run again safely, points are rebuilt from the coordinates.
+
+# Modules
+import globals # Import globals.py
+from indexes import reconcile_indexes, print_report
+from place_data import GEO_FIELD, GEO_POINT_STAGE
+
+places = globals.db.places # Places collection
+
+# Function to build the GeoJSON point of every place on the server
+def add_geo_points():
+    result = places.update_many(
+        {"location.coordinates": {"$exists": True}}, # Places with coordinates
+        [GEO_POINT_STAGE] # Point from the stored coordinates
+    )
+    print(f"Updated {result.modified_count} places")
+    missing = places.count_documents({GEO_FIELD: {"$exists": False}}) # Places that can't be found by distance
+    if missing:
+        print(f"{missing} places have no valid coordinates and were left without a point")
+
+# Function to create the indexes declared for the places collection in indexes.py
+def create_place_indexes():
+    print_report("foodPlaces", reconcile_indexes(globals.db, "foodPlaces", collections=["places"]))
+    print("Created indexes on the places collection")
+
+# Main function to run the migration
+def main():
+    try:
+        add_geo_points()
+        create_place_indexes()
+        print("Place locations migrated successfully!")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
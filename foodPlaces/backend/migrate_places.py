@@ -0,0 +1,103 @@
+# Moves the places embedded in city documents into the places collection
+#
+# Usage: python migrate_places.py [--batch-size 1000] [--keep-embedded]
+#
+# Run migrate_reviews.py first so the embedded reviews are copied while they are
+# still inside the city documents. Every place is copied into the places collection
+# with a city_id reference and keeps its _id, so review references stay valid. The
+# places array is then removed from the cities unless --keep-embedded is given.
+# The migration can be run again safely, places already copied are left untouched.
+
+# Modules
+import argparse
+from pymongo import UpdateOne
+import globals # Import globals.py
+from indexes import reconcile_indexes, print_report
+
+businesses = globals.db.foodPlacesDB # Cities collection
+places = globals.db.places # Places collection
+UNNAMED_PLACE_KEY = ["info.name", "location.address.full_address"] # Identify a place without place_id within its city
+
+# Function to create the indexes declared for the places collection in indexes.py
+def create_place_indexes():
+    print_report("foodPlaces", reconcile_indexes(globals.db, "foodPlaces", collections=["places"]))
+    print("Created indexes on the places collection")
+
+# Function to read every embedded place with its city
+def embedded_places():
+    pipeline = [
+        {"$match": {"places.0": {"$exists": True}}}, # Cities that still embed places
+        {"$unwind": "$places"}, # One document per place
+        {"$project": {"_id": 0, "city_id": "$_id", "place": "$places"}} # Place plus reference
+    ]
+    for row in businesses.aggregate(pipeline, allowDiskUse=True): # Streams from the cursor
+        place = row["place"] # Embedded place
+        place["city_id"] = row["city_id"] # City reference
+        yield place
+
+# Function to read a dotted field path from a place, None when it is missing
+def get_path(place, path):
+    value = place
+    for key in path.split("."):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+# Function to build the filter of a place without an ID from its city and place_id
+# Places without a place_id are matched on their name and address instead.
+def place_key(place):
+    key = {"city_id": place["city_id"]}
+    for field in (["place_id"] if "place_id" in place else UNNAMED_PLACE_KEY):
+        value = get_path(place, field)
+        key[field] = value if value is not None else {"$exists": False} # Missing fields match missing fields
+    return key
+
+# Function to copy the embedded places into the places collection
+def copy_places(batch_size):
+    operations = [] # Pending writes
+    copied = 0 # Number of places written
+    for place in embedded_places(): # For each embedded place
+        if "_id" in place: # Places with an ID are only inserted once
+            operations.append(UpdateOne({"_id": place["_id"]}, {"$setOnInsert": place}, upsert=True))
+        else: # Places without an ID are matched on their city and place_id
+            operations.append(UpdateOne(place_key(place), {"$setOnInsert": place}, upsert=True))
+
+        if len(operations) >= batch_size: # Writes a full batch
+            places.bulk_write(operations, ordered=False)
+            copied += len(operations)
+            operations = []
+            print(f"Copied {copied} places")
+
+    if operations: # Writes the last batch
+        places.bulk_write(operations, ordered=False)
+        copied += len(operations)
+    print(f"Copied {copied} places into the places collection")
+
+# Function to remove the embedded places from the cities
+def remove_embedded_places():
+    result = businesses.update_many(
+        {"places": {"$exists": True}}, # Cities with embedded places
+        {"$unset": {"places": ""}} # Remove the array
+    )
+    print(f"Removed embedded places from {result.modified_count} cities")
+
+# Main function to run the migration
+def main():
+    parser = argparse.ArgumentParser(description="Move embedded places into the places collection")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of places per bulk write")
+    parser.add_argument("--keep-embedded", action="store_true", help="Leave the places array in the cities")
+    args = parser.parse_args()
+
+    try:
+        create_place_indexes()
+        copy_places(args.batch_size)
+        if not args.keep_embedded:
+            remove_embedded_places()
+        print("Places migrated successfully!")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
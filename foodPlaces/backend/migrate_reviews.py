@@ -0,0 +1,103 @@
+# Moves the reviews embedded in city documents into the reviews collection
+#
+# Usage: python migrate_reviews.py [--batch-size 1000]
+#
+# Every review found in places.ratings.recent_reviews is copied into the reviews
+# collection with a reference to its place and city. The embedded array is then
+# trimmed to the newest RECENT_REVIEWS_LIMIT reviews so it only acts as a preview.
+# The migration can be run again safely, reviews already copied are left untouched.
+# Run it before migrate_places.py, which moves the places out of the cities.
+
+# Modules
+import argparse
+from pymongo import UpdateOne
+import globals # Import globals.py
+from indexes import reconcile_indexes, print_report
+from place_data import RECENT_REVIEWS_LIMIT
+
+businesses = globals.db.foodPlacesDB # Cities collection
+reviews = globals.db.reviews # Reviews collection
+REVIEW_KEY_FIELDS = ["author_name", "date_posted", "content"] # Identify a review without an ID within its place
+
+# Function to create the indexes declared for the reviews collection in indexes.py
+def create_review_indexes():
+    print_report("foodPlaces", reconcile_indexes(globals.db, "foodPlaces", collections=["reviews"]))
+    print("Created indexes on the reviews collection")
+
+# Function to read every embedded review with its place and city
+def embedded_reviews():
+    pipeline = [
+        {"$unwind": "$places"}, # One document per place
+        {"$unwind": "$places.ratings.recent_reviews"}, # One document per review
+        {"$project": { # Review fields plus references
+            "_id": 0,
+            "city_id": "$_id",
+            "place_id": "$places._id",
+            "review": "$places.ratings.recent_reviews"
+        }}
+    ]
+    for row in businesses.aggregate(pipeline, allowDiskUse=True): # Streams from the cursor
+        review = row["review"] # Embedded review
+        review["city_id"] = row["city_id"] # City reference
+        review["place_id"] = row["place_id"] # Place reference
+        yield review
+
+# Function to build the filter of a review without an ID from its place and content
+def review_key(review):
+    key = {"place_id": review["place_id"]}
+    for field in REVIEW_KEY_FIELDS:
+        key[field] = review[field] if field in review else {"$exists": False} # Missing fields match missing fields
+    return key
+
+# Function to copy the embedded reviews into the reviews collection
+def copy_reviews(batch_size):
+    operations = [] # Pending writes
+    copied = 0 # Number of reviews written
+    for review in embedded_reviews(): # For each embedded review
+        if "_id" in review: # Reviews with an ID are only inserted once
+            operations.append(UpdateOne({"_id": review["_id"]}, {"$setOnInsert": review}, upsert=True))
+        else: # Reviews without an ID are matched on their place, author, date and content
+            operations.append(UpdateOne(review_key(review), {"$setOnInsert": review}, upsert=True))
+
+        if len(operations) >= batch_size: # Writes a full batch
+            reviews.bulk_write(operations, ordered=False)
+            copied += len(operations)
+            operations = []
+            print(f"Copied {copied} reviews")
+
+    if operations: # Writes the last batch
+        reviews.bulk_write(operations, ordered=False)
+        copied += len(operations)
+    print(f"Copied {copied} reviews into the reviews collection")
+
+# Function to trim the embedded reviews to the newest ones
+def trim_recent_reviews():
+    result = businesses.update_many(
+        {"places.ratings.recent_reviews": {"$exists": True}}, # Cities with embedded reviews
+        {"$push": {
+            "places.$[].ratings.recent_reviews": {
+                "$each": [], # Nothing added, only sorted and sliced
+                "$sort": {"date_posted": -1}, # Newest first
+                "$slice": RECENT_REVIEWS_LIMIT # Keep only the last N reviews
+            }
+        }}
+    )
+    print(f"Trimmed recent reviews in {result.modified_count} cities")
+
+# Main function to run the migration
+def main():
+    parser = argparse.ArgumentParser(description="Move embedded reviews into the reviews collection")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of reviews per bulk write")
+    args = parser.parse_args()
+
+    try:
+        create_review_indexes()
+        copy_reviews(args.batch_size)
+        trim_recent_reviews()
+        print("Reviews migrated successfully!")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+# Entry point for the script
+if __name__ == '__main__':
+    main()
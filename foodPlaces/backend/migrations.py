@@ -0,0 +1,159 @@
+# Batched, resumable runner for data migrations
+#
+# A migration is a function that takes a document and returns the write to apply to
+# it (UpdateOne, DeleteOne...), a list of writes, or None to leave it alone:
+#
+#     def add_status(place):
+#         return UpdateOne({"_id": place["_id"]}, {"$set": {"info.status": "open"}})
+#
+#     run_migration_from_command_line(places, add_status, "add_status", projection={"_id": 1})
+#
+# run_migration splits the collection into _id ranges and walks them in parallel with
+# _id-sorted cursors. The writes of each batch go out in one unordered bulk_write, the
+# last _id done in every range is saved to a checkpoint file after each batch, and an
+# interrupted migration carries on from there when it is run again. --rate limits the
+# number of writes per second so a migration can run next to live traffic.
+#
+# Checkpoints are written to MIGRATION_CHECKPOINT_DIR, the working directory by
+# default, as <name>.checkpoint. --checkpoint picks another file.
+
+# Modules
+import argparse
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bson import json_util
+
+CHECKPOINT_DIR = os.environ.get("MIGRATION_CHECKPOINT_DIR", ".") # Where checkpoints are written by default
+
+# Function to split the _id space of the matching documents into ranges of similar size
+# The first range has no lower bound and the last no upper bound, so documents inserted
+# while the migration runs still fall into a range.
+def partition_ids(collection, query, partitions):
+    if partitions < 2:
+        return [{"lower": None, "upper": None, "last": None, "done": False}]
+    buckets = list(collection.aggregate([
+        {"$match": query},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": partitions}} # Bounds from the _id index
+    ], allowDiskUse=True))
+    bounds = [None] + [bucket["_id"]["min"] for bucket in buckets[1:]] + [None]
+    return [{"lower": bounds[i], "upper": bounds[i + 1], "last": None, "done": False} for i in range(len(bounds) - 1)]
+
+# Class that limits the number of writes per second across all workers
+class Throttle:
+    def __init__(self, rate):
+        self.rate = rate # Writes per second, None for no limit
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def wait(self, writes):
+        if not self.rate:
+            return
+        with self.lock: # Reserves time for these writes
+            start = max(self.next_time, time.monotonic())
+            self.next_time = start + writes / self.rate
+        time.sleep(max(0, start - time.monotonic()))
+
+# Class that keeps the state of every range and saves it after each batch
+class Checkpoint:
+    def __init__(self, path, name, partitions):
+        self.path, self.name, self.partitions = path, name, partitions
+        self.lock = threading.Lock()
+        self.processed = 0 # Documents read in this run
+
+    @classmethod
+    def load(cls, path, name):
+        if not path or not os.path.exists(path):
+            return None
+        with open(path) as file:
+            state = json_util.loads(file.read())
+        if state["name"] != name: # Checkpoint of another migration
+            raise ValueError(f"Checkpoint {path} belongs to migration {state['name']}")
+        return cls(path, name, state["partitions"])
+
+    def update(self, partition, last_id, count, done=False):
+        with self.lock:
+            partition["last"], partition["done"] = last_id, done
+            self.processed += count
+            if self.path: # Written to a temporary file first so it is never left half written
+                with open(self.path + ".tmp", "w") as file:
+                    file.write(json_util.dumps({"name": self.name, "partitions": self.partitions}))
+                os.replace(self.path + ".tmp", self.path)
+
+# Function to apply a migration to one _id range
+def migrate_partition(collection, migration, query, projection, partition, batch_size, throttle, checkpoint, total):
+    id_range = {}
+    if partition["last"] is not None: # Resumes after the last document done
+        id_range["$gt"] = partition["last"]
+    elif partition["lower"] is not None:
+        id_range["$gte"] = partition["lower"]
+    if partition["upper"] is not None:
+        id_range["$lt"] = partition["upper"]
+    range_query = {"$and": [query, {"_id": id_range}]} if id_range else query
+
+    batch, last_id = [], partition["last"]
+    cursor = collection.find(range_query, projection).sort("_id", 1).batch_size(batch_size)
+    for document in cursor:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            last_id = apply_batch(collection, migration, batch, partition, throttle, checkpoint, total)
+            batch = []
+    if batch:
+        last_id = apply_batch(collection, migration, batch, partition, throttle, checkpoint, total)
+    checkpoint.update(partition, last_id, 0, done=True)
+
+# Function to build and write the updates of a batch of documents, returns the last _id of the batch
+def apply_batch(collection, migration, batch, partition, throttle, checkpoint, total):
+    writes = []
+    for document in batch:
+        result = migration(document)
+        if result is None: # Document left as it is
+            continue
+        writes.extend(result if isinstance(result, list) else [result])
+    if writes:
+        throttle.wait(len(writes))
+        collection.bulk_write(writes, ordered=False) # One round trip for the whole batch
+    checkpoint.update(partition, batch[-1]["_id"], len(batch))
+    print(f"Migrated {checkpoint.processed} of about {total} documents")
+    return batch[-1]["_id"]
+
+# Function to run a migration over a collection
+def run_migration(collection, migration, name, query=None, projection=None, batch_size=1000, workers=4,
+                  rate=None, checkpoint_path=None, restart=False):
+    query = query or {}
+    checkpoint = None if restart else Checkpoint.load(checkpoint_path, name)
+    if checkpoint: # Carries on from the saved ranges
+        print(f"Resuming migration {name} from {checkpoint_path}")
+    else:
+        checkpoint = Checkpoint(checkpoint_path, name, partition_ids(collection, query, workers))
+
+    total = collection.count_documents(query) if query else collection.estimated_document_count()
+    throttle = Throttle(rate)
+    with ThreadPoolExecutor(max_workers=workers) as pool: # One cursor per range
+        futures = [
+            pool.submit(migrate_partition, collection, migration, query, projection, partition, batch_size, throttle, checkpoint, total)
+            for partition in checkpoint.partitions if not partition["done"]
+        ]
+        for future in futures:
+            future.result() # Raises the error of a failed range
+
+    if checkpoint_path and os.path.exists(checkpoint_path): # Finished, a new run starts over
+        os.remove(checkpoint_path)
+    print(f"Migration {name} finished, {checkpoint.processed} documents processed")
+
+# Function to run a migration with the batch size, workers, rate and restart options read from the command line
+def run_migration_from_command_line(collection, migration, name, query=None, projection=None):
+    parser = argparse.ArgumentParser(description=f"Run the {name} migration")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of documents per bulk write")
+    parser.add_argument("--workers", type=int, default=4, help="Number of _id ranges migrated in parallel")
+    parser.add_argument("--rate", type=float, help="Most writes per second")
+    parser.add_argument("--checkpoint", default=os.path.join(CHECKPOINT_DIR, f"{name}.checkpoint"), help="File that records progress")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start over")
+    args = parser.parse_args()
+
+    try:
+        run_migration(collection, migration, name, query, projection, args.batch_size, args.workers,
+                      args.rate, args.checkpoint, args.restart)
+    except Exception as e:
+        print(f"An error occurred: {e}")
@@ -0,0 +1,176 @@
+# Pagination helpers shared by the listing routes
+#
+# Listings support two modes:
+# - page mode with pn (page number) and ps (page size), kept for compatibility
+# - cursor mode with cursor and ps, where cursor is the 'next' token of the previous page
+#
+# A cursor holds the sort key and _id of the last document of a page. The next page
+# starts right after it, so deep pages cost the same as the first one and results do
+# not shift when documents are added or removed in between.
+#
+# Listings also take count=exact|estimated|none to choose how total_items is worked out.
+#
+# The largest listings stream their pages: read_page sends pages of up to
+# BUFFERED_PAGE_SIZE through find_page, and opens larger ones with stream_page, which
+# reads the page from a cursor as the response is written and works out the next cursor
+# on the way. count_total counts their matches before the response starts.
+
+# Modules
+import base64
+from collections.abc import Mapping
+from bson import json_util
+from raw_json import RawDocuments, Deferred, BUFFERED_PAGE_SIZE
+
+DEFAULT_PAGE_SIZE = 10 # Page size when ps is not given
+MAX_PAGE_SIZE = 100 # Largest page size a client can ask for
+MAX_STREAMED_PAGE_SIZE = 5000 # Largest page size of the listings that stream their pages
+
+# Function to validate the page number and page size
+def validate_pagination_params(page_num, page_size, max_page_size=MAX_PAGE_SIZE):
+    page_num = int(page_num) if page_num else 1 # Defaults to the first page
+    page_size = int(page_size) if page_size else DEFAULT_PAGE_SIZE # Defaults to 10 items
+    if page_num < 1: # Pages start at 1
+        raise ValueError("Page number must be at least 1")
+    if not 1 <= page_size <= max_page_size: # Page size must be within limits
+        raise ValueError(f"Page size must be between 1 and {max_page_size}")
+    return page_num, page_size
+
+# Function to read a dotted field path such as 'info.name' from a document
+def get_field(document, path):
+    value = document
+    for key in path.split('.'): # Walks down each level
+        if not isinstance(value, Mapping): # Path does not exist, raw documents are mappings too
+            return None
+        value = value.get(key)
+    return value
+
+# Function to build the opaque cursor that points after a document
+def encode_cursor(document, sort_field, sort_direction):
+    cursor = { # Sort key plus _id as tie-breaker
+        "f": sort_field,
+        "d": sort_direction,
+        "v": get_field(document, sort_field),
+        "id": document["_id"]
+    }
+    return base64.urlsafe_b64encode(json_util.dumps(cursor).encode()).decode()
+
+# Function to read a cursor back, it must match the requested sort
+def decode_cursor(token, sort_field, sort_direction):
+    try:
+        cursor = json_util.loads(base64.urlsafe_b64decode(token.encode()))
+        value, last_id = cursor["v"], cursor["id"]
+        same_sort = cursor["f"] == sort_field and cursor["d"] == sort_direction
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not same_sort: # Cursor was issued for a different sort
+        raise ValueError("Cursor does not match the requested sort order")
+    return value, last_id
+
+# Function to restrict a query to the documents after the cursor
+def apply_cursor(query, token, sort_field, sort_direction):
+    value, last_id = decode_cursor(token, sort_field, sort_direction)
+    operator = "$gt" if sort_direction == 1 else "$lt" # Direction of the walk
+    after_cursor = {"$or": [ # Strictly after the last sort key, or same key with a later _id
+        {sort_field: {operator: value}},
+        {sort_field: value, "_id": {operator: last_id}}
+    ]}
+    if not query: # No other filters
+        return after_cursor
+    return {"$and": [query, after_cursor]}
+
+# Function to build the sort specification with _id as tie-breaker
+def keyset_sort(sort_field, sort_direction):
+    return [(sort_field, sort_direction), ("_id", sort_direction)]
+
+# Function to split one extra fetched document off a page and build the next cursor
+def next_page(documents, page_size, sort_field, sort_direction):
+    if len(documents) <= page_size: # Last page
+        return documents, None
+    documents = documents[:page_size] # Drop the look-ahead document
+    return documents, encode_cursor(documents[-1], sort_field, sort_direction)
+
+COUNT_MODES = ['exact', 'estimated', 'none'] # How the total number of items is worked out
+
+# Function to validate the count parameter
+def validate_count_mode(count_mode):
+    count_mode = (count_mode or 'exact').lower() # Defaults to an exact count
+    if count_mode not in COUNT_MODES: # Must be a known mode
+        raise ValueError(f"Count must be one of: {COUNT_MODES}")
+    return count_mode
+
+# Function to read one page of documents and the total number of matches
+#
+# The page is an indexed find: the sort and the cursor bounds are served by the listing
+# index, and only page_size + 1 documents are read, so next_page can find the next
+# cursor. The total is counted separately by count_total, see count_mode there.
+def find_page(collection, query, page_query, sort, page_start, page_size, projection=None, count_mode='exact', estimate_allowed=False):
+    documents = list(collection.find(page_query, projection) \
+        .sort(sort) \
+        .skip(page_start) \
+        .limit(page_size + 1)) # One extra to find the next page
+    return documents, count_total(collection, query, count_mode, estimate_allowed)
+
+# Function to work out the number of pages, None when the total was not counted
+def total_pages(total, page_size):
+    if total is None:
+        return None
+    return (total + page_size - 1) // page_size
+
+# Class that yields a page of documents from a cursor and works out the next cursor on the way
+# The first document is read when the page is opened, so query errors and empty pages
+# are known before a response starts.
+class PageStream:
+    def __init__(self, cursor, page_size, sort_field, sort_direction):
+        self.cursor = cursor
+        self.page_size = page_size
+        self.sort_field, self.sort_direction = sort_field, sort_direction
+        self.first = next(cursor, None) # None when the page is empty
+        self.next_cursor = None # Set once the look-ahead document is reached
+
+    def __iter__(self):
+        document, sent, last = self.first, 0, None
+        while document is not None:
+            if sent == self.page_size: # Look-ahead document, there is a next page
+                self.next_cursor = encode_cursor(last, self.sort_field, self.sort_direction)
+                break
+            yield document
+            document, sent, last = next(self.cursor, None), sent + 1, document
+
+# Function to open a page of documents as a stream, read by the response as it is written
+def stream_page(collection, page_query, sort, page_start, page_size, projection=None):
+    sort_field, sort_direction = sort[0] # keyset_sort puts the sort field first
+    cursor = collection.find(page_query, projection) \
+        .sort(sort) \
+        .skip(page_start) \
+        .limit(page_size + 1) # One extra to find the next page
+    return PageStream(cursor, page_size, sort_field, sort_direction)
+
+# Function to count the matches of a listing, None with count_mode 'none'
+# count_mode 'estimated' uses the collection metadata count when the query has no
+# filters (estimate_allowed), otherwise it falls back to an exact count.
+def count_total(collection, query, count_mode, estimate_allowed=False):
+    if count_mode == 'none':
+        return None
+    if count_mode == 'estimated' and estimate_allowed: # Metadata count
+        return collection.estimated_document_count()
+    return collection.count_documents(query) # Uses the same index as the page
+
+# Function to read a listing page, whole for small pages and as a stream for large ones
+#
+# Returns the documents, the total and the next cursor, or None documents when the page
+# is empty. Pages of up to BUFFERED_PAGE_SIZE come from find_page, whole, for
+# the page and the total. Larger pages are opened on raw_collection and returned as
+# RawDocuments with a Deferred next cursor, for page_response to stream; their total is
+# counted here, so a failed count is reported before the response starts.
+def read_page(collection, raw_collection, query, page_query, sort, page_start, page_size, projection=None, count_mode='exact', estimate_allowed=False):
+    sort_field, sort_direction = sort[0] # keyset_sort puts the sort field first
+    if page_size <= BUFFERED_PAGE_SIZE:
+        documents, total = find_page(collection, query, page_query, sort, page_start, page_size, projection, count_mode, estimate_allowed)
+        documents, next_cursor = next_page(documents, page_size, sort_field, sort_direction)
+        return documents or None, total, next_cursor
+
+    page = stream_page(raw_collection, page_query, sort, page_start, page_size, projection)
+    if page.first is None: # Empty, not counted
+        return None, None, None
+    total = count_total(collection, query, count_mode, estimate_allowed)
+    return RawDocuments(page), total, Deferred(lambda: page.next_cursor) # Known once the page was written
@@ -0,0 +1,54 @@
+# Shapes of the stored city, place and review data, shared by the routes and the data scripts
+#
+# The blueprints, import_data.py, generate_data.py and the migrations all build or fix up
+# the same fields. Keeping the helpers here, away from the blueprints, lets the scripts
+# use them without a Flask app or a database connection.
+
+GEO_FIELD = 'location.geo' # GeoJSON point built from location.coordinates, has a 2dsphere index
+RECENT_REVIEWS_LIMIT = 10 # Number of reviews kept in ratings.recent_reviews of a place
+
+# Service options that can be filtered on and their paths
+SERVICE_FILTERS = {
+    'dining': {
+        'dine_in': 'service_options.dining.dine_in',
+        'takeaway': 'service_options.dining.takeaway',
+        'reservations': 'service_options.dining.reservations',
+        'outdoor_seating': 'service_options.dining.outdoor_seating',
+        'group_bookings': 'service_options.dining.group_bookings'
+    },
+    'meals': {
+        'breakfast': 'service_options.meals.breakfast',
+        'lunch': 'service_options.meals.lunch',
+        'dinner': 'service_options.meals.dinner',
+        'brunch': 'service_options.meals.brunch'
+    }
+}
+
+# Function to build the lower-case name stored next to city_name for searching and sorting
+def normalize_city_name(city_name):
+    return city_name.strip().lower()
+
+# Function to build the GeoJSON point of a place, None when the coordinates can't be indexed
+def geo_point(coordinates):
+    latitude, longitude = coordinates.get('latitude'), coordinates.get('longitude')
+    if not all(isinstance(value, (int, float)) for value in (latitude, longitude)): # Both must be numbers
+        return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180): # Outside the range 2dsphere accepts
+        return None
+    return {"type": "Point", "coordinates": [longitude, latitude]} # GeoJSON order is longitude, latitude
+
+# Update pipeline stage that rebuilds the GeoJSON point from the stored coordinates, same rules as geo_point
+LATITUDE, LONGITUDE = "$location.coordinates.latitude", "$location.coordinates.longitude"
+GEO_POINT_STAGE = {"$set": {GEO_FIELD: {"$cond": [
+    {"$and": [
+        {"$isNumber": LATITUDE}, {"$isNumber": LONGITUDE},
+        {"$gte": [LATITUDE, -90]}, {"$lte": [LATITUDE, 90]},
+        {"$gte": [LONGITUDE, -180]}, {"$lte": [LONGITUDE, 180]}
+    ]},
+    {"type": "Point", "coordinates": [LONGITUDE, LATITUDE]},
+    "$$REMOVE" # No point for missing or invalid coordinates
+]}}}
+
+# Builds the copy of a review that is cached on the place
+def to_recent_review(review):
+    return {key: value for key, value in review.items() if key not in ("place_id", "city_id")}
@@ -0,0 +1,29 @@
+# Field selection shared by the GET routes
+#
+# GET routes take fields=a,b.c to return only some fields of each document. The paths
+# are checked against an allowlist for the route and turned into a Mongo projection,
+# so the fields that were not asked for are neither read nor sent. Without fields the
+# routes return whole documents as before.
+
+# Function to turn the fields parameter into an inclusion projection, None when not given
+#
+# allowed lists the top-level fields a client may ask for, any dotted path below them
+# is accepted too, as long as no part of it is empty or starts with $. required lists fields the route needs whatever was asked for, such
+# as the sort field used to build the next cursor.
+def parse_fields(fields, allowed, required=()):
+    if not fields: # Whole documents
+        return None
+    paths = [path.strip() for path in fields.split(',') if path.strip()] # Requested paths
+    if not paths: # Only commas or spaces
+        raise ValueError("Fields must list at least one field")
+    for path in paths: # Each path must be in or below an allowed field
+        parts = path.split('.')
+        if parts[0] not in allowed or any(not part or part.startswith('$') for part in parts): # Empty or operator parts
+            raise ValueError(f"Unknown field '{path}', fields must be within: {sorted(allowed)}")
+
+    projection = {}
+    for path in sorted(set(paths) | set(required), key=len): # Shorter paths first
+        if any(path.startswith(kept + '.') for kept in projection): # Already covered by a parent path
+            continue
+        projection[path] = 1
+    return projection
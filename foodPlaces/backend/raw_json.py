@@ -0,0 +1,122 @@
+# Raw BSON read path and streamed JSON bodies for the routes that only pass documents on
+#
+# Routes such as show_one_city and show_one_place don't look inside the documents they
+# return. They read them through raw_collection, whose cursors hand back
+# RawBSONDocuments: the BSON bytes as received, split per document but not decoded.
+# raw_response then builds the JSON body, decoding each document just before its JSON
+# is written and dropping it straight after, so only the small response envelope and
+# one document at a time are ever Python objects. The shaping those routes used to do
+# in Python, such as leaving out fields, is done by the projection on the server.
+#
+# A request never holds the decoded object graph of all its documents, which keeps
+# memory flat and spares the garbage collector most of its work on large responses:
+# benchmark_json.py compares both paths.
+#
+# stream_response writes the same body as a chunked response while a cursor is read,
+# for the listings: the envelope up to the documents goes out first, then the
+# documents as the cursor yields them, then the rest of the envelope. Values wrapped
+# in Deferred, such as the next cursor of a page, are worked out when they are reached,
+# after the documents before them were sent, so they must not need the database.
+# page_response sends large listing pages this way and smaller ones whole, so those
+# can still be cached.
+
+# Modules
+import uuid
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from flask import current_app, stream_with_context
+from json_provider import encode_json
+
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument) # Documents left as BSON bytes
+STREAM_CHUNK_SIZE = 64 * 1024 # Bytes gathered before a chunk is sent
+BUFFERED_PAGE_SIZE = 100 # Listing pages up to this size are sent whole
+
+# Class that marks a cursor or list of documents in a response, written as a JSON array one document at a time
+class RawDocuments:
+    def __init__(self, documents):
+        self.documents = documents
+
+# Class that marks a value of a response worked out when it is written, after the values before it
+class Deferred:
+    def __init__(self, build):
+        self.build = build
+
+# Function to give a collection handle whose reads return raw documents
+# It shares the connection pool of the collection, only the decoding differs.
+def raw_collection(collection):
+    return collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+
+# Function to encode one raw document as JSON bytes
+def encode_raw(document):
+    return encode_json(bson.decode(document.raw)) # Decoded only for the time it takes to encode it
+
+# Function to encode one document of a list, raw or already decoded
+def encode_document(document):
+    return encode_raw(document) if isinstance(document, RawBSONDocument) else encode_json(document)
+
+# Function to replace the raw documents of a response with placeholder strings, collected in fragments
+def mark_raw(value, token, fragments):
+    if isinstance(value, (RawBSONDocument, RawDocuments, Deferred)):
+        fragments.append(value)
+        return f"{token}{len(fragments) - 1}"
+    if isinstance(value, dict):
+        return {key: mark_raw(item, token, fragments) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [mark_raw(item, token, fragments) for item in value]
+    return value
+
+# Function to yield the JSON of a raw document, a list of documents or a deferred value
+def fragment_chunks(fragment):
+    if isinstance(fragment, RawBSONDocument):
+        yield encode_raw(fragment)
+        return
+    if isinstance(fragment, Deferred):
+        yield encode_json(fragment.build())
+        return
+    yield b"["
+    for number, document in enumerate(fragment.documents):
+        if number:
+            yield b","
+        yield encode_document(document)
+    yield b"]"
+
+# Function to yield the JSON body of a payload holding raw documents, lists of documents or deferred values
+def json_chunks(payload):
+    token = f"raw-{uuid.uuid4().hex}-" # Can't be met in the payload's own strings
+    fragments = []
+    envelope = encode_json(mark_raw(payload, token, fragments)) # Small, without the documents
+    first = True
+    for part in envelope.split(f'"{token}'.encode()): # Each placeholder is '"<token><number>"'
+        if not first: # Part after a placeholder
+            number, part = part.split(b'"', 1)
+            yield from fragment_chunks(fragments[int(number)])
+        first = False
+        yield part
+    yield b"\n" # As jsonify ends its bodies
+
+# Function to gather small chunks into chunks of about STREAM_CHUNK_SIZE bytes
+def gather_chunks(chunks):
+    gathered, size = [], 0
+    for chunk in chunks:
+        gathered.append(chunk)
+        size += len(chunk)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b"".join(gathered)
+            gathered, size = [], 0
+    if gathered:
+        yield b"".join(gathered)
+
+# Function to build a JSON response whose payload holds raw documents, sent whole
+def raw_response(payload, status=200):
+    return current_app.response_class(b"".join(json_chunks(payload)), status=status, mimetype="application/json")
+
+# Function to build a chunked JSON response, written while its cursors are read
+def stream_response(payload, status=200):
+    return current_app.response_class(stream_with_context(gather_chunks(json_chunks(payload))), status=status, mimetype="application/json")
+
+# Function to send a listing page, streamed when it is larger than BUFFERED_PAGE_SIZE
+def page_response(payload, page_size, status=200):
+    if page_size > BUFFERED_PAGE_SIZE: # Memory and first byte don't depend on the page size
+        return stream_response(payload, status)
+    return raw_response(payload, status) # Whole, so the result cache can keep it
@@ -0,0 +1,180 @@
+# In-process cache of read route responses
+#
+# GET routes decorated with @cached keep their 200 and 404 responses in a bounded LRU
+# cache keyed on the route, its URL arguments and the sorted query arguments, so
+# repeated browsing of the same city or place is answered without touching MongoDB.
+# 404s are kept for a short NEGATIVE_TTL, so lookups of ids that don't exist are cheap
+# too. Entries are tagged with the city and place they belong to.
+#
+# Write routes decorated with @invalidates_cache drop the entries of the city and
+# place they changed, plus the city listing whose stats they move. Writes made by
+# other workers arrive through the change stream listener in invalidation.py; while
+# that stream is down, entries live for invalidation.entry_ttl() at most.
+#
+# The hit, miss, eviction and invalidation counters are served by the cache blueprint.
+
+# Modules
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response, current_app, g
+from invalidation import register_listener, entry_ttl
+
+CACHE_MAX_BYTES = 64 * 1024 * 1024 # Total size of the cached responses
+CACHE_MAX_ENTRY_BYTES = 1024 * 1024 # Larger responses are not cached
+NEGATIVE_TTL = 10 # Seconds a 404 is kept
+ENTRY_OVERHEAD = 256 # Bytes counted per entry on top of the body and key
+CITY_LISTING_TAG = "cities" # Tag of the city listing, moved by any write
+
+# Class that holds the cached responses in least recently used order
+class ResultCache:
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> entry, least recently used first
+        self.tags = {} # tag -> keys of the entries with that tag
+        self.size = 0 # Bytes used
+        self.generation = 0 # Moves on every invalidation
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "negative_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["expires"] <= time.monotonic(): # Too old
+                self.remove(key)
+                self.counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key) # Most recently used
+            self.counters["negative_hits" if entry["status"] == 404 else "hits"] += 1
+            return entry
+
+    def put(self, key, entry, generation):
+        with self.lock:
+            if generation != self.generation: # Data changed while the response was built
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = entry
+            self.size += entry["size"]
+            for tag in entry["tags"]:
+                self.tags.setdefault(tag, set()).add(key)
+            self.counters["stores"] += 1
+            while self.size > self.max_bytes: # Evicts the least recently used entries
+                self.remove(next(iter(self.entries)))
+                self.counters["evictions"] += 1
+
+    # Removes an entry, called with the lock held
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry["size"]
+        for tag in entry["tags"]:
+            keys = self.tags.get(tag)
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def invalidate(self, *tags):
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self.tags.get(tag, ())):
+                    self.remove(key)
+                    self.counters["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.counters["invalidations"] += len(self.entries)
+            self.entries.clear()
+            self.tags.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["negative_hits"] + self.counters["misses"]
+            return dict(self.counters, entries=len(self.entries), bytes=self.size, max_bytes=self.max_bytes,
+                        hit_ratio=round((lookups - self.counters["misses"]) / lookups, 3) if lookups else None)
+
+results = ResultCache() # Cache shared by the routes of this process
+
+# Function to build the tags of an entry from the URL arguments of its route
+def entry_tags(view_args):
+    tags = set()
+    if view_args.get("city_id"):
+        tags.add("city:" + view_args["city_id"].lower()) # Ids are compared in lower case
+    if view_args.get("place_id"):
+        tags.add("place:" + view_args["place_id"].lower())
+    return tags or {CITY_LISTING_TAG}
+
+# Function to build the cache key of a request, the order of query arguments doesn't matter
+# Routes behind @conditional add the version of their document, so an entry built from
+# an older version is never sent with the ETag of a newer one.
+def cache_key(route, view_args):
+    arguments = tuple(sorted((name, tuple(sorted(request.args.getlist(name)))) for name in request.args))
+    return (route, tuple(sorted(view_args.items())), arguments, g.get("document_version"))
+
+# Function to drop the entries a write to a city or place can change
+def invalidate(city_id=None, place_id=None):
+    tags = [CITY_LISTING_TAG] # Listings show city stats
+    if city_id:
+        tags.append("city:" + str(city_id).lower()) # The city, its places and their reviews
+    if place_id:
+        tags.append("place:" + str(place_id).lower())
+    results.invalidate(*tags)
+
+# Function to handle an event of the invalidation stream, for writes made by any worker
+def on_invalidation_event(event):
+    if event["collection"] in ("users", "blacklist"): # Not in any cached response
+        return
+    if event["city_id"]:
+        invalidate(event["city_id"], event["place_id"])
+    else: # Flush, or a delete that doesn't say which city it was in
+        results.clear()
+
+register_listener(on_invalidation_event)
+
+# Decorator to cache the 200 and 404 responses of a GET route for ttl seconds
+def cached(route, ttl):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = cache_key(route, kwargs)
+            entry = results.get(key)
+            if entry is not None: # Answered from the cache
+                response = current_app.response_class(entry["body"], status=entry["status"], headers=entry["headers"]) # Stored Content-Type kept
+                response.headers["X-Cache"] = "HIT"
+                return response
+
+            generation = results.generation # Data version the response is built from
+            response = make_response(view(*args, **kwargs))
+            if response.status_code in (200, 404) and not response.is_streamed:
+                body = response.get_data()
+                size = len(body) + len(repr(key)) + ENTRY_OVERHEAD
+                if size <= CACHE_MAX_ENTRY_BYTES:
+                    lifetime = min(ttl, entry_ttl()) if response.status_code == 200 else min(NEGATIVE_TTL, entry_ttl())
+                    results.put(key, {
+                        "body": body,
+                        "status": response.status_code,
+                        "headers": [(name, value) for name, value in response.headers if name not in ("Content-Length", "X-Cache")],
+                        "expires": time.monotonic() + lifetime,
+                        "size": size,
+                        "tags": entry_tags(kwargs)
+                    }, generation)
+            response.headers["X-Cache"] = "MISS"
+            return response
+        return wrapper
+    return decorator
+
+# Decorator to drop the cached responses of the city and place a write route changed
+def invalidates_cache(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        if response.status_code < 400: # Some routes report errors with 200, dropping entries is harmless
+            invalidate(kwargs.get("city_id"), kwargs.get("place_id"))
+        return response
+    return wrapper
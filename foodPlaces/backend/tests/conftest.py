@@ -0,0 +1,98 @@
+# Shared setup for the backend tests
+#
+# The blueprints read globals.db when they are imported, so the fixtures here set it to
+# a fresh database on the test server first and only then import them. The app they
+# build has the cities, places and reviews blueprints and the same indexes as main_app.
+#
+# Tests run against a real MongoDB server at MONGODB_TEST_URI, mongodb://127.0.0.1:27017
+# by default, and are skipped when none answers.
+
+# Modules
+import os
+import sys
+import types
+import uuid
+import bson
+import pytest
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # Backend modules
+import globals # Import globals.py
+
+TEST_URI = os.environ.get("MONGODB_TEST_URI", "mongodb://127.0.0.1:27017")
+
+# Function to leave a route unchanged, stands in for the auth decorators
+def pass_through(func):
+    return func
+
+# The blueprints import jwt_required and admin_required, the routes under test don't use
+# them. When decorators.py can't provide them they are replaced by pass-through versions.
+try:
+    from decorators import jwt_required, admin_required
+except ImportError:
+    sys.modules["decorators"] = types.ModuleType("decorators")
+    sys.modules["decorators"].jwt_required = pass_through
+    sys.modules["decorators"].admin_required = pass_through
+
+# Class that adds up the size of the replies of the commands it sees
+class ReplySizes(monitoring.CommandListener):
+    def __init__(self):
+        self.bytes = 0
+        self.commands = []
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.bytes += len(bson.encode(event.reply))
+        self.commands.append(event.command_name)
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        self.bytes = 0
+        self.commands = []
+
+# Fixture with the listener of every command the tests send
+@pytest.fixture(scope="session")
+def reply_sizes():
+    return ReplySizes()
+
+# Fixture that connects to the test server, or skips the tests without one
+@pytest.fixture(scope="session")
+def mongo_client(reply_sizes):
+    client = MongoClient(TEST_URI, serverSelectionTimeoutMS=2000, event_listeners=[reply_sizes])
+    try:
+        client.admin.command("ping")
+    except PyMongoError as e:
+        client.close()
+        pytest.skip(f"No MongoDB server at {TEST_URI}: {e}")
+    yield client
+    client.close()
+
+# Fixture with a database of its own for the session, set as globals.db
+# One per session, the blueprints keep the collections of the first database they see.
+@pytest.fixture(scope="session")
+def test_db(mongo_client):
+    name = f"test_{uuid.uuid4().hex[:8]}"
+    globals.db = mongo_client[name] # Read by the blueprints when they are imported, so set first
+    yield globals.db
+    mongo_client.drop_database(name)
+
+# Fixture with a Flask app serving the city, place and review routes from test_db
+@pytest.fixture(scope="session")
+def app(test_db):
+    from flask import Flask
+    from blueprints.cities.cities import cities_bp
+    from blueprints.places.places import places_bp
+    from blueprints.reviews.reviews import reviews_bp
+    from json_provider import BSONJSONProvider
+    from indexes import reconcile_indexes
+    app = Flask(__name__)
+    app.json = BSONJSONProvider(app)
+    for blueprint in (cities_bp, places_bp, reviews_bp):
+        app.register_blueprint(blueprint)
+    reconcile_indexes(test_db, "foodPlaces") # Same indexes as the app
+    return app
@@ -0,0 +1,86 @@
+# Regression test for the bytes each single city, place and review route reads from MongoDB
+#
+# Usage: python -m pytest tests/test_read_sizes.py
+#
+# Two cities are loaded, a small one and one with a hundred times more places and
+# reviews. Every route is called on a place of each city while a pymongo CommandListener
+# adds up the size of the server replies. A route that loads a whole city, or all the
+# reviews of a place, reads far more from the large city and fails the test.
+#
+# Needs a MongoDB server, see conftest.py. The test is skipped without one.
+
+# Modules
+import random
+from types import SimpleNamespace
+import pytest
+from place_data import RECENT_REVIEWS_LIMIT
+
+SMALL_PLACES = 5 # Places of the small city
+LARGE_PLACES = 500 # Places of the large city
+GROWTH_ALLOWED = 2 # Most a route may read from the large city, as a multiple of the small one
+OTHER_REVIEWS_MAX = 20 # Most reviews of the other places
+PLACE_TYPE = "Read Size Test" # Type of the measured place only, so filtered reads match one place
+
+# Function to load a city with its places, the measured place gets review_count reviews
+def load_city(db, number, place_count, review_count):
+    from generate_data import generate_city, generate_place, zipf_weights, TOWNS
+    args = SimpleNamespace(seed=1, places_min=place_count, places_max=place_count, words_min=20, words_max=20)
+    documents = {"cities": [], "places": [], "reviews": []}
+    for kind, document in generate_city(number, args, zipf_weights(OTHER_REVIEWS_MAX + 1, 1.1)):
+        documents[kind].append(document)
+    city = documents["cities"][0]
+
+    # Measured place, the same in both cities apart from its number of reviews
+    always = [0] * review_count + [1] # Cumulative weights that always draw review_count
+    rng = random.Random(f"measured place {number}")
+    measured = list(generate_place(rng, city["_id"], "Belfast", TOWNS["Belfast"], "measured", args, always))
+    place = measured[-1][1]
+    place["info"]["type"] = [PLACE_TYPE]
+    documents["places"].append(place)
+    documents["reviews"].extend(document for kind, document in measured[:-1])
+
+    db.foodPlacesDB.insert_many(documents["cities"])
+    db.places.insert_many(documents["places"])
+    db.reviews.insert_many(documents["reviews"])
+    return SimpleNamespace(city_id=str(city["_id"]), place_id=str(place["_id"]), review_ids=[str(review["_id"]) for _, review in measured[:-1]])
+
+# Function to call each route on a city and return the reply bytes read by each
+def measure_routes(client, listener, city):
+    city_url = f"/api/cities/{city.city_id}"
+    place_url = f"{city_url}/places/{city.place_id}"
+    calls = [
+        ("show_one_city", "get", city_url, None),
+        ("show_one_city filtered", "get", f"{city_url}?include_places=true&place_type={PLACE_TYPE}", None),
+        ("show_one_place", "get", place_url, None),
+        ("show_one_review", "get", f"{place_url}/reviews/{city.review_ids[0]}", None),
+        ("update_review", "put", f"{place_url}/reviews/{city.review_ids[0]}", {"rating": 4, "content": "Updated"}),
+        ("delete_review", "delete", f"{place_url}/reviews/{city.review_ids[1]}", None),
+        ("delete_place", "delete", place_url, None)
+    ]
+    sizes = {}
+    for name, method, url, body in calls:
+        listener.reset()
+        response = getattr(client, method)(url, json=body) if body else getattr(client, method)(url)
+        assert response.status_code == 200, f"{name}: {response.status_code} {response.get_data(as_text=True)}"
+        sizes[name] = (listener.bytes, listener.commands)
+    return sizes
+
+# Fixture that loads the two cities and measures every route on both
+@pytest.fixture(scope="module")
+def read_sizes(app, test_db, reply_sizes):
+    small = load_city(test_db, 0, SMALL_PLACES, RECENT_REVIEWS_LIMIT + 2) # Full preview in both cities
+    large = load_city(test_db, 1, LARGE_PLACES, (RECENT_REVIEWS_LIMIT + 2) * 100)
+    client = app.test_client()
+    return measure_routes(client, reply_sizes, small), measure_routes(client, reply_sizes, large)
+
+# Test that no route reads more from a city a hundred times larger
+@pytest.mark.parametrize("route", [
+    "show_one_city", "show_one_city filtered", "show_one_place", "show_one_review",
+    "update_review", "delete_review", "delete_place"
+])
+def test_reply_size_does_not_grow_with_the_city(read_sizes, route):
+    small, large = read_sizes
+    small_bytes, small_commands = small[route]
+    large_bytes, large_commands = large[route]
+    assert large_commands == small_commands, f"{route} sent other commands to the large city: {large_commands}"
+    assert large_bytes <= small_bytes * GROWTH_ALLOWED, f"{route} read {large_bytes} bytes from the large city, {small_bytes} from the small one"
@@ -0,0 +1,78 @@
+# Version counters of cities and places, used for conditional GETs
+#
+# Every write to a city or place adds one to its _v field and sets updated_at. The
+# single city and place routes send an ETag built from _v and a Last-Modified from
+# updated_at, and a request with a matching If-None-Match or a later If-Modified-Since
+# gets a 304 after a point read of those two fields, without running the route.
+#
+# A city's version also moves when its places, their reviews or its stats change,
+# because show_one_city returns them. Documents written before the fields existed
+# count as version 0 and have no Last-Modified.
+
+# Modules
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from bson import ObjectId
+from flask import request, make_response, g
+from werkzeug.http import is_resource_modified
+
+VERSION_FIELD = "_v" # Number of writes to the document
+UPDATED_FIELD = "updated_at" # Time of the last write
+VERSION_PROJECTION = {VERSION_FIELD: 1, UPDATED_FIELD: 1} # Fields read to answer a conditional GET
+
+# Update operators that move the version, merged into a write's own operators
+VERSION_UPDATE = {"$inc": {VERSION_FIELD: 1}, "$currentDate": {UPDATED_FIELD: True}}
+
+# Pipeline update stage that moves the version
+VERSION_STAGE = {"$set": {VERSION_FIELD: {"$add": [{"$ifNull": ["$" + VERSION_FIELD, 0]}, 1]}, UPDATED_FIELD: "$$NOW"}}
+
+# Function to set the first version of a new document
+def new_version(document):
+    document[VERSION_FIELD] = 1
+    document[UPDATED_FIELD] = datetime.now(timezone.utc)
+    return document
+
+# Function to add the version operators to an update document
+def with_version(update):
+    update = dict(update)
+    for operator, fields in VERSION_UPDATE.items():
+        update[operator] = {**update.get(operator, {}), **fields}
+    return update
+
+# Function to build the ETag of a document version, query arguments change the representation
+def version_etag(version):
+    arguments = sorted((name, value) for name, values in request.args.lists() for value in values)
+    digest = hashlib.sha1(repr(arguments).encode()).hexdigest()[:8]
+    return f"{version}-{digest}"
+
+# Decorator to answer conditional GETs of a single document route
+# document_query builds the filter of the document from the route arguments
+def conditional(collection, document_query):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not all(ObjectId.is_valid(value) for value in kwargs.values()): # The route reports bad ids
+                return view(*args, **kwargs)
+            document = collection.find_one(document_query(**kwargs), VERSION_PROJECTION) # Point read on _id
+            if document is None: # The route reports missing documents
+                return view(*args, **kwargs)
+
+            g.document_version = document.get(VERSION_FIELD, 0) # Part of the result cache key
+            etag = version_etag(g.document_version)
+            updated_at = document.get(UPDATED_FIELD)
+            if updated_at is not None and updated_at.tzinfo is None: # Stored dates are UTC
+                updated_at = updated_at.replace(tzinfo=timezone.utc)
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=updated_at): # If-None-Match first, then If-Modified-Since
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200: # Only a sent document has a version
+                    return response
+            response.set_etag(etag) # Version read before the route ran, never newer than the body
+            if updated_at is not None:
+                response.last_modified = updated_at
+            return response
+        return wrapper
+    return decorator